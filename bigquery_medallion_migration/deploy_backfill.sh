@@ -0,0 +1,88 @@
+#!/bin/bash
+
+# Deploy the Backfill Coordinator and its Cloud Tasks queue
+# Shards are dispatched to refresh-silver-layer / refresh-gold-layer, which run them as workers.
+
+set -e
+
+PROJECT_ID="junoplus-dev"
+REGION="us-central1"
+FUNCTION_NAME="pipeline-backfill"
+QUEUE_NAME="pipeline-backfill"
+SERVICE_ACCOUNT="refresh-functions@${PROJECT_ID}.iam.gserviceaccount.com"
+MAX_CONCURRENT_SHARDS=8
+
+echo "🚀 Deploying Backfill Coordinator"
+echo "================================="
+echo ""
+
+# 1. Task queue: concurrency cap and retry policy for shards
+echo "1️⃣  Creating Cloud Tasks queue: ${QUEUE_NAME}"
+gcloud services enable cloudtasks.googleapis.com --project=${PROJECT_ID}
+gcloud tasks queues create ${QUEUE_NAME} \
+  --location=${REGION} \
+  --max-concurrent-dispatches=${MAX_CONCURRENT_SHARDS} \
+  --max-dispatches-per-second=2 \
+  --max-attempts=5 \
+  --min-backoff=30s \
+  --max-backoff=600s \
+  --project=${PROJECT_ID} 2>/dev/null || \
+gcloud tasks queues update ${QUEUE_NAME} \
+  --location=${REGION} \
+  --max-concurrent-dispatches=${MAX_CONCURRENT_SHARDS} \
+  --max-dispatches-per-second=2 \
+  --max-attempts=5 \
+  --min-backoff=30s \
+  --max-backoff=600s \
+  --project=${PROJECT_ID}
+
+# 2. The coordinator enqueues tasks that act as the refresh service account
+echo ""
+echo "2️⃣  Granting Cloud Tasks roles"
+gcloud projects add-iam-policy-binding ${PROJECT_ID} \
+  --member="serviceAccount:${SERVICE_ACCOUNT}" \
+  --role="roles/cloudtasks.enqueuer" \
+  --condition=None --quiet > /dev/null
+gcloud iam service-accounts add-iam-policy-binding ${SERVICE_ACCOUNT} \
+  --member="serviceAccount:${SERVICE_ACCOUNT}" \
+  --role="roles/iam.serviceAccountUser" \
+  --project=${PROJECT_ID} --quiet > /dev/null
+for service in refresh-silver-layer refresh-gold-layer; do
+  gcloud run services add-iam-policy-binding ${service} \
+    --region=${REGION} \
+    --member="serviceAccount:${SERVICE_ACCOUNT}" \
+    --role="roles/run.invoker" \
+    --project=${PROJECT_ID} --quiet > /dev/null
+done
+
+# 3. Deploy the coordinator
+echo ""
+echo "3️⃣  Deploying Cloud Function: ${FUNCTION_NAME}"
+function_url() {
+  gcloud functions describe "$1" --gen2 --region=${REGION} --project=${PROJECT_ID} \
+    --format="value(serviceConfig.uri)"
+}
+gcloud functions deploy ${FUNCTION_NAME} \
+  --gen2 \
+  --runtime=python311 \
+  --region=${REGION} \
+  --source=./functions/backfill \
+  --entry-point=main \
+  --trigger-http \
+  --no-allow-unauthenticated \
+  --timeout=540s \
+  --memory=256MB \
+  --service-account=${SERVICE_ACCOUNT} \
+  --set-env-vars="BACKFILL_QUEUE=${QUEUE_NAME},SILVER_FUNCTION_URL=$(function_url refresh-silver-layer),GOLD_FUNCTION_URL=$(function_url refresh-gold-layer)" \
+  --project=${PROJECT_ID}
+
+BACKFILL_URL=$(function_url ${FUNCTION_NAME})
+echo ""
+echo "✅ Deployment Complete!"
+echo ""
+echo "🧪 Reprocess a date range of silver_therapy_sessions in 30-day shards:"
+echo "   curl -X POST -H \"Authorization: Bearer \$(gcloud auth print-identity-token)\" -H 'Content-Type: application/json' \\"
+echo "     -d '{\"action\": \"start\", \"layer\": \"silver\", \"tables\": [\"silver_therapy_sessions\"], \"shard_by\": \"date\", \"start_date\": \"2025-01-01\", \"end_date\": \"2026-01-01\"}' \\"
+echo "     ${BACKFILL_URL}"
+echo ""
+echo "📋 Progress: POST {\"action\": \"status\", \"backfill_id\": \"...\"} to ${BACKFILL_URL}"
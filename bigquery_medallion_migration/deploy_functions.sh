@@ -82,6 +82,17 @@ gcloud pubsub topics create refresh-gold --project=$PROJECT_ID 2>/dev/null && ec
 gcloud pubsub topics create quality-check --project=$PROJECT_ID 2>/dev/null && echo "  ✅ Created quality-check topic" || echo "  ℹ️  quality-check topic already exists"
 echo ""
 
+# refresh_silver / refresh_gold import functions/shared/pipeline_jobs.py, so they are
+# deployed from a staging copy of their directory plus the shared modules
+BUILD_ROOT=$(mktemp -d)
+trap 'rm -rf "$BUILD_ROOT"' EXIT
+stage_function() {
+    mkdir -p "$BUILD_ROOT/$1"
+    cp -r "functions/$1"/. "$BUILD_ROOT/$1"/
+    cp functions/shared/*.py "$BUILD_ROOT/$1"/
+    echo "$BUILD_ROOT/$1"
+}
+
 # 1. Deploy Silver Refresh Function
 echo "="*80
 echo "1️⃣  Deploying refresh-silver-layer function..."
@@ -90,7 +101,7 @@ gcloud functions deploy refresh-silver-layer \
   --gen2 \
   --runtime=python311 \
   --region=$REGION \
-  --source=functions/refresh_silver \
+  --source="$(stage_function refresh_silver)" \
   --entry-point=refresh_silver \
   --trigger-topic=refresh-silver \
   --timeout=540s \
@@ -115,7 +126,7 @@ gcloud functions deploy refresh-gold-layer \
   --gen2 \
   --runtime=python311 \
   --region=$REGION \
-  --source=functions/refresh_gold \
+  --source="$(stage_function refresh_gold)" \
   --entry-point=refresh_gold \
   --trigger-topic=refresh-gold \
   --memory=1024MB \
@@ -0,0 +1,103 @@
+#!/bin/bash
+
+# Deploy the Pipeline Orchestrator
+# Runs silver → gold → snapshot → quality daily, skipping steps whose sources are unchanged.
+# Replaces the independent silver / gold / snapshot schedules (quality keeps its hourly job).
+
+set -e
+
+PROJECT_ID="junoplus-dev"
+REGION="us-central1"
+FUNCTION_NAME="pipeline-orchestrator"
+SERVICE_ACCOUNT="refresh-functions@${PROJECT_ID}.iam.gserviceaccount.com"
+
+echo "🚀 Deploying Pipeline Orchestrator"
+echo "=================================="
+echo ""
+
+# 1. Resolve the step function URLs (HTTP entry points of the already deployed functions)
+echo "1️⃣  Resolving step function URLs"
+function_url() {
+  gcloud functions describe "$1" --gen2 --region=${REGION} --project=${PROJECT_ID} \
+    --format="value(serviceConfig.uri)"
+}
+SILVER_URL=$(function_url refresh-silver-layer)
+GOLD_URL=$(function_url refresh-gold-layer)
+SNAPSHOT_URL=$(function_url create-ml-snapshot)
+QUALITY_URL=$(function_url quality-check)
+echo "   silver:   ${SILVER_URL}"
+echo "   gold:     ${GOLD_URL}"
+echo "   snapshot: ${SNAPSHOT_URL}"
+echo "   quality:  ${QUALITY_URL}"
+
+# 2. Allow the orchestrator's service account to invoke them
+echo ""
+echo "2️⃣  Granting Cloud Run invoker role"
+for service in refresh-silver-layer refresh-gold-layer create-ml-snapshot quality-check; do
+  gcloud run services add-iam-policy-binding ${service} \
+    --region=${REGION} \
+    --member="serviceAccount:${SERVICE_ACCOUNT}" \
+    --role="roles/run.invoker" \
+    --project=${PROJECT_ID} --quiet > /dev/null
+done
+
+# 3. Deploy the orchestrator (HTTP, steps can take up to an hour in total)
+echo ""
+echo "3️⃣  Deploying Cloud Function: ${FUNCTION_NAME}"
+gcloud functions deploy ${FUNCTION_NAME} \
+  --gen2 \
+  --runtime=python311 \
+  --region=${REGION} \
+  --source=./functions/orchestrator \
+  --entry-point=main \
+  --trigger-http \
+  --no-allow-unauthenticated \
+  --timeout=3600s \
+  --memory=256MB \
+  --service-account=${SERVICE_ACCOUNT} \
+  --set-env-vars="SILVER_FUNCTION_URL=${SILVER_URL},GOLD_FUNCTION_URL=${GOLD_URL},SNAPSHOT_FUNCTION_URL=${SNAPSHOT_URL},QUALITY_FUNCTION_URL=${QUALITY_URL}" \
+  --project=${PROJECT_ID}
+
+ORCHESTRATOR_URL=$(function_url ${FUNCTION_NAME})
+gcloud functions add-invoker-policy-binding ${FUNCTION_NAME} \
+  --gen2 \
+  --region=${REGION} \
+  --member="serviceAccount:${SERVICE_ACCOUNT}" \
+  --project=${PROJECT_ID} > /dev/null
+
+# 4. Schedule the orchestrator (daily 2 AM UTC)
+echo ""
+echo "4️⃣  Creating Cloud Scheduler job"
+gcloud scheduler jobs create http pipeline-orchestrator-daily \
+  --location=${REGION} \
+  --schedule="0 2 * * *" \
+  --uri="${ORCHESTRATOR_URL}" \
+  --http-method=POST \
+  --message-body='{}' \
+  --oidc-service-account-email=${SERVICE_ACCOUNT} \
+  --attempt-deadline=30m \
+  --time-zone="UTC" \
+  --description="Change-detecting pipeline run (daily 2 AM UTC)" \
+  --project=${PROJECT_ID} 2>/dev/null || \
+gcloud scheduler jobs update http pipeline-orchestrator-daily \
+  --location=${REGION} \
+  --schedule="0 2 * * *" \
+  --uri="${ORCHESTRATOR_URL}" \
+  --project=${PROJECT_ID}
+
+# 5. Pause the schedules the orchestrator replaces
+echo ""
+echo "5️⃣  Pausing independent step schedules"
+for job in refresh-silver-daily refresh-gold-weekly create-ml-snapshot-weekly; do
+  gcloud scheduler jobs pause ${job} --location=${REGION} --project=${PROJECT_ID} 2>/dev/null \
+    && echo "   ⏸️  ${job} paused" || echo "   ℹ️  ${job} not found"
+done
+
+echo ""
+echo "✅ Deployment Complete!"
+echo ""
+echo "🧪 Dry run (decisions only):"
+echo "   curl -X POST -H \"Authorization: Bearer \$(gcloud auth print-identity-token)\" -H 'Content-Type: application/json' -d '{\"dry_run\": true}' ${ORCHESTRATOR_URL}"
+echo ""
+echo "📋 Lineage:"
+echo "   SELECT * FROM \`${PROJECT_ID}.junoplus_analytics_quality.pipeline_lineage\` ORDER BY started_at DESC LIMIT 50"
@@ -0,0 +1,431 @@
+"""
+Cloud Function to coordinate sharded refreshes / backfills
+Triggered by: HTTP (manual)
+Runtime: Python 3.11
+
+Splits a silver or gold rebuild into date-range or user_id-hash shards and
+enqueues one Cloud Tasks task per shard to refresh_silver / refresh_gold, which
+process them as backfill workers (process_backfill in functions/shared/pipeline_jobs.py).
+The queue caps concurrency and retries failed shards; workers checkpoint each shard in
+quality.backfill_checkpoints, so retries and re-submits are idempotent.
+
+Modes:
+    in_place  shards replace their rows in the live table (reprocess a date range)
+    rebuild   shards fill a staging table whose rows `finalize` swaps in (the table is only
+              replaced when its schema changed)
+
+Request body (JSON):
+    {"action": "start", "layer": "silver", "tables": ["silver_therapy_sessions"],
+     "shard_by": "date", "start_date": "2025-01-01", "end_date": "2026-10-01", "days_per_shard": 30}
+    {"action": "start", "layer": "gold", "tables": ["user_analytics_v1"], "shard_by": "user",
+     "buckets": 32, "mode": "rebuild"}
+    {"action": "status", "backfill_id": "..."}
+    {"action": "resume", "backfill_id": "..."}      re-enqueue shards that are not done
+    {"action": "finalize", "backfill_id": "..."}    rebuild mode, once every shard is done and the
+                                                    staging row counts match the source ("force": true
+                                                    skips that check)
+
+Local (in-memory queue instead of Cloud Tasks, workers run with functions-framework):
+    PYTHONPATH=functions/shared functions-framework --source functions/refresh_silver/main.py --target main --port 8081
+    python functions/backfill/main.py silver silver_therapy_sessions --shard-by user --buckets 8 \\
+        --worker-url http://localhost:8081 --concurrency 4
+"""
+import functions_framework
+from google.cloud import bigquery
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROJECT_ID = os.environ.get('PROJECT_ID', 'junoplus-dev')
+REGION = os.environ.get('REGION', 'us-central1')
+DATASET_QUALITY = os.environ.get('QUALITY_DATASET_ID', 'junoplus_analytics_quality_dev')
+TASK_QUEUE = os.environ.get('BACKFILL_QUEUE', 'pipeline-backfill')
+SERVICE_ACCOUNT = os.environ.get('TASKS_SERVICE_ACCOUNT', f'refresh-functions@{PROJECT_ID}.iam.gserviceaccount.com')
+WORKER_URL_ENV = {'silver': 'SILVER_FUNCTION_URL', 'gold': 'GOLD_FUNCTION_URL'}
+MAX_SHARDS = 2000
+
+CHECKPOINT_TABLE = f"{PROJECT_ID}.{DATASET_QUALITY}.backfill_checkpoints"
+
+
+def plan_shards(backfill_id, layer, tables, shard_by, mode='in_place', start_date=None, end_date=None,
+                days_per_shard=30, buckets=16):
+    """
+    Worker tasks covering every table: [start, end) date ranges or user_id hash buckets.
+    A rebuild with date shards gets one more shard per table for the rows outside the range
+    (NULL dates included), so its staging table holds every row of the live table.
+    """
+    shards = []
+    for table in tables:
+        base = {'action': 'shard', 'backfill_id': backfill_id, 'layer': layer, 'table': table, 'mode': mode}
+        if shard_by == 'date':
+            first, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+            start = first
+            while start < end:
+                stop = min(start + timedelta(days=int(days_per_shard)), end)
+                shards.append({**base, 'kind': 'date', 'start': start.isoformat(), 'end': stop.isoformat(),
+                               'shard_id': f"{table}-d{start:%Y%m%d}"})
+                start = stop
+            if mode == 'rebuild':
+                shards.append({**base, 'kind': 'date_outside', 'start': first.isoformat(), 'end': end.isoformat(),
+                               'shard_id': f"{table}-doutside"})
+        elif shard_by == 'user':
+            for bucket in range(int(buckets)):
+                shards.append({**base, 'kind': 'user', 'bucket': bucket, 'buckets': int(buckets),
+                               'shard_id': f"{table}-u{bucket:04d}of{int(buckets)}"})
+        else:
+            raise ValueError(f"shard_by must be 'date' or 'user', got {shard_by!r}")
+    if len(shards) > MAX_SHARDS:
+        raise ValueError(f"{len(shards)} shards exceeds the limit of {MAX_SHARDS}")
+    return shards
+
+
+def post(url, payload, auth=True, timeout=600):
+    """POST JSON to a worker (with an ID token for its URL unless auth=False)"""
+    import requests
+
+    headers = {}
+    if auth:
+        import google.auth.transport.requests
+        import google.oauth2.id_token
+        token = google.oauth2.id_token.fetch_id_token(google.auth.transport.requests.Request(), url)
+        headers['Authorization'] = f'Bearer {token}'
+    response = requests.post(url, json=payload, headers=headers, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+class CloudTasksQueue:
+    """Shards as named Cloud Tasks HTTP tasks; retries and the concurrency cap are queue settings"""
+
+    def __init__(self, queue_name=TASK_QUEUE):
+        from google.cloud import tasks_v2
+
+        self.client = tasks_v2.CloudTasksClient()
+        self.queue_name = queue_name
+        self.parent = self.client.queue_path(PROJECT_ID, REGION, queue_name)
+        self.post_method = tasks_v2.HttpMethod.POST
+
+    def enqueue(self, url, payload, task_id):
+        from google.api_core.exceptions import AlreadyExists
+
+        task = {
+            'name': self.client.task_path(PROJECT_ID, REGION, self.queue_name, task_id),
+            'http_request': {
+                'http_method': self.post_method,
+                'url': url,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps({'backfill': payload}).encode(),
+                'oidc_token': {'service_account_email': SERVICE_ACCOUNT, 'audience': url},
+            },
+            'dispatch_deadline': {'seconds': 1800},
+        }
+        try:
+            self.client.create_task(request={'parent': self.parent, 'task': task})
+        except AlreadyExists:
+            logger.info(f"  ℹ️  Task {task_id} already enqueued")
+
+    def join(self):
+        """Cloud Tasks dispatches asynchronously; progress is read with action=status"""
+        return None
+
+
+class LocalTaskQueue:
+    """In-memory stand-in for Cloud Tasks: bounded worker threads, retries with exponential backoff"""
+
+    def __init__(self, concurrency=4, max_attempts=3, backoff_seconds=2.0, auth=False):
+        self.tasks = queue.Queue()
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.auth = auth
+        self.results = {}
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(concurrency)]
+        for thread in self.threads:
+            thread.start()
+
+    def enqueue(self, url, payload, task_id):
+        self.tasks.put((url, payload, task_id))
+
+    def _work(self):
+        while True:
+            url, payload, task_id = self.tasks.get()
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    result = post(url, {'backfill': payload}, auth=self.auth)
+                    break
+                except Exception as e:
+                    result = {'status': 'error', 'error': str(e), 'attempts': attempt}
+                    logger.warning(f"  ⚠️  {task_id} attempt {attempt}/{self.max_attempts} failed: {str(e)[:200]}")
+                    if attempt < self.max_attempts:
+                        time.sleep(self.backoff_seconds * 2 ** (attempt - 1))
+            with self.lock:
+                self.results[task_id] = result
+            self.tasks.task_done()
+
+    def join(self):
+        """Block until every task finished (or exhausted its attempts); {task_id: worker response}"""
+        self.tasks.join()
+        return dict(self.results)
+
+
+def record_pending(client, shards, staging_tables):
+    """One 'pending' checkpoint row per planned shard (the backfill's manifest)"""
+    rows = [{
+        'backfill_id': s['backfill_id'],
+        'shard_id': s['shard_id'],
+        'layer': s['layer'],
+        'table_name': s['table'],
+        'mode': s['mode'],
+        'kind': s['kind'],
+        'range_start': s.get('start'),
+        'range_end': s.get('end'),
+        'bucket': s.get('bucket'),
+        'buckets': s.get('buckets'),
+        'staging_table': staging_tables.get(s['table']),
+        'status': 'pending',
+    } for s in shards]
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('rows', 'STRING', json.dumps(rows)),
+    ])
+    client.query(f"""
+        INSERT INTO `{CHECKPOINT_TABLE}`
+          (backfill_id, shard_id, layer, table_name, mode, kind, range_start, range_end,
+           bucket, buckets, staging_table, status, recorded_at)
+        SELECT
+          JSON_VALUE(r, '$.backfill_id'), JSON_VALUE(r, '$.shard_id'), JSON_VALUE(r, '$.layer'),
+          JSON_VALUE(r, '$.table_name'), JSON_VALUE(r, '$.mode'), JSON_VALUE(r, '$.kind'),
+          DATE(JSON_VALUE(r, '$.range_start')), DATE(JSON_VALUE(r, '$.range_end')),
+          CAST(JSON_VALUE(r, '$.bucket') AS INT64), CAST(JSON_VALUE(r, '$.buckets') AS INT64),
+          JSON_VALUE(r, '$.staging_table'), 'pending', CURRENT_TIMESTAMP()
+        FROM UNNEST(JSON_QUERY_ARRAY(@rows)) as r
+    """, job_config=job_config).result()
+
+
+def load_shards(client, backfill_id):
+    """Planned shards of a backfill with their current status ('done' wins over later rows)"""
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('backfill_id', 'STRING', backfill_id),
+    ])
+    rows = client.query(f"""
+        SELECT
+          shard_id,
+          ARRAY_AGG(IF(status = 'pending', STRUCT(layer, table_name, mode, kind, range_start, range_end,
+                                                  bucket, buckets, staging_table), NULL)
+                    IGNORE NULLS LIMIT 1)[SAFE_OFFSET(0)] as plan,
+          IF(LOGICAL_OR(status = 'done'), 'done',
+             ARRAY_AGG(status ORDER BY recorded_at DESC LIMIT 1)[OFFSET(0)]) as status,
+          ARRAY_AGG(error IGNORE NULLS ORDER BY recorded_at DESC LIMIT 1) as errors,
+          COUNTIF(status = 'failed') as failures
+        FROM `{CHECKPOINT_TABLE}`
+        WHERE backfill_id = @backfill_id
+        GROUP BY shard_id
+    """, job_config=job_config).result()
+    shards = []
+    for row in rows:
+        plan = row.plan
+        if plan is None:
+            continue
+        shard = {
+            'action': 'shard', 'backfill_id': backfill_id, 'shard_id': row.shard_id,
+            'layer': plan['layer'], 'table': plan['table_name'], 'mode': plan['mode'], 'kind': plan['kind'],
+            'staging_table': plan['staging_table'],
+            'status': row.status, 'failures': row.failures, 'error': row.errors[0] if row.errors else None,
+        }
+        if plan['kind'] in ('date', 'date_outside'):
+            shard.update(start=plan['range_start'].isoformat(), end=plan['range_end'].isoformat())
+        else:
+            shard.update(bucket=plan['bucket'], buckets=plan['buckets'])
+        shards.append(shard)
+    return shards
+
+
+def summarize(shards):
+    counts = {}
+    for shard in shards:
+        counts[shard['status']] = counts.get(shard['status'], 0) + 1
+    return {
+        'shards': len(shards),
+        'counts': counts,
+        'complete': bool(shards) and all(s['status'] == 'done' for s in shards),
+        'failed': [{'shard_id': s['shard_id'], 'failures': s['failures'], 'error': s['error']}
+                   for s in shards if s['status'] == 'failed'][:50],
+    }
+
+
+def worker_url(layer):
+    url = os.environ.get(WORKER_URL_ENV.get(layer, ''))
+    if not url:
+        raise ValueError(f"No worker URL for layer {layer!r} (set {WORKER_URL_ENV.get(layer, 'its URL env var')})")
+    return url
+
+
+def _task_payload(shard):
+    return {k: v for k, v in shard.items() if k not in ('status', 'failures', 'error', 'staging_table')}
+
+
+def start(client, task_queue, url, layer, tables, shard_by, mode='in_place', auth=True, **shard_args):
+    """Plan, checkpoint and enqueue a backfill; returns its id and shard count"""
+    if mode not in ('in_place', 'rebuild'):
+        raise ValueError(f"mode must be 'in_place' or 'rebuild', got {mode!r}")
+    backfill_id = f"bf-{datetime.now(timezone.utc):%Y%m%dt%H%M%S}-{uuid.uuid4().hex[:6]}"
+    shards = plan_shards(backfill_id, layer, tables, shard_by, mode, **shard_args)
+
+    staging_tables = {}
+    if mode == 'rebuild':
+        for table in tables:
+            prepared = post(url, {'backfill': {'action': 'prepare', 'backfill_id': backfill_id,
+                                               'table': table, 'mode': mode}}, auth=auth)
+            staging_tables[table] = prepared['staging_table']
+            logger.info(f"  📦 Staging table ready: {prepared['staging_table']}")
+
+    record_pending(client, shards, staging_tables)
+    for shard in shards:
+        # Task names are unique per backfill: Cloud Tasks rejects a name it still remembers
+        task_queue.enqueue(url, _task_payload(shard), f"{backfill_id}-{shard['shard_id']}")
+    logger.info(f"✅ Backfill {backfill_id}: {len(shards)} shard(s) enqueued for {', '.join(tables)}")
+    return {'backfill_id': backfill_id, 'shards': len(shards), 'mode': mode, 'staging_tables': staging_tables}
+
+
+def resume(client, task_queue, url, backfill_id):
+    """Re-enqueue every shard that is not done (new task names, so Cloud Tasks accepts them)"""
+    suffix = f"{int(time.time())}"
+    pending = [s for s in load_shards(client, backfill_id) if s['status'] != 'done']
+    for shard in pending:
+        task_queue.enqueue(url, _task_payload(shard), f"{backfill_id}-{shard['shard_id']}-r{suffix}")
+    logger.info(f"🔁 Backfill {backfill_id}: {len(pending)} shard(s) re-enqueued")
+    return {'backfill_id': backfill_id, 'reenqueued': len(pending)}
+
+
+def swap_in(client, live, staging):
+    """
+    Replace live's rows with staging's. With an unchanged schema the rows are swapped in one
+    transaction, so the table (and materialized views over it) survives; a new schema needs
+    the table replaced, after which its materialized views must be recreated.
+    processed_at is set to the swap time, so state folded by load time (gold
+    user_session_state) picks up every swapped row.
+    """
+    from google.api_core.exceptions import NotFound
+
+    try:
+        same_schema = client.get_table(live).schema == client.get_table(staging).schema
+    except NotFound:
+        same_schema = False
+    stamped = any(field.name == 'processed_at' for field in client.get_table(staging).schema)
+    if same_schema:
+        rows = "* REPLACE (CURRENT_TIMESTAMP() as processed_at)" if stamped else "*"
+        client.query(f"""
+            BEGIN TRANSACTION;
+            DELETE FROM `{live}` WHERE TRUE;
+            INSERT INTO `{live}` SELECT {rows} FROM `{staging}`;
+            COMMIT TRANSACTION;
+        """).result()
+    else:
+        client.query(f"CREATE OR REPLACE TABLE `{live}` COPY `{staging}`").result()
+        if stamped:
+            client.query(f"UPDATE `{live}` SET processed_at = CURRENT_TIMESTAMP() WHERE TRUE").result()
+        logger.warning(f"  ⚠️  {live} was replaced (new schema): recreate materialized views over it "
+                       f"(sql/gold_materialized_views.sql)")
+
+
+def finalize(client, backfill_id, url, auth=True, force=False):
+    """
+    Rebuild mode: replace each live table's rows with its fully populated staging table.
+    The worker first compares each staging table's row count with the table's query;
+    nothing is swapped if any differs (unless force).
+    """
+    shards = load_shards(client, backfill_id)
+    summary = summarize(shards)
+    if not summary['complete']:
+        raise RuntimeError(f"Backfill {backfill_id} is not complete: {summary['counts']}")
+    staged = sorted({(s['table'], s['staging_table']) for s in shards if s['staging_table']})
+    for table, staging in staged:
+        counts = post(url, {'backfill': {'action': 'verify', 'backfill_id': backfill_id, 'table': table,
+                                         'mode': 'rebuild'}}, auth=auth)
+        if counts['staging_rows'] != counts['source_rows']:
+            message = (f"{staging} has {counts['staging_rows']:,} rows, the query for {table} "
+                       f"{counts['source_rows']:,}")
+            if not force:
+                raise RuntimeError(f"Row counts differ, nothing swapped: {message}. Resume or re-run the "
+                                   f"backfill, or finalize with force if the source changed meanwhile")
+            logger.warning(f"  ⚠️  {message} (forced)")
+    swapped = []
+    for table, staging in staged:
+        live = staging.rsplit('__backfill_', 1)[0]
+        swap_in(client, live, staging)
+        client.delete_table(staging, not_found_ok=True)
+        swapped.append(live)
+        logger.info(f"  🔀 {live} replaced from {staging}")
+    return {'backfill_id': backfill_id, 'finalized': swapped}
+
+
+@functions_framework.http
+def main(request):
+    """Start, inspect, resume or finalize a sharded backfill"""
+
+    body = request.get_json(silent=True) or {}
+    action = body.get('action', 'status')
+    client = bigquery.Client(project=PROJECT_ID)
+
+    try:
+        if action == 'start':
+            layer = body['layer']
+            return start(client, CloudTasksQueue(), worker_url(layer), layer, body['tables'], body['shard_by'],
+                         mode=body.get('mode', 'in_place'),
+                         start_date=body.get('start_date'), end_date=body.get('end_date'),
+                         days_per_shard=body.get('days_per_shard', 30), buckets=body.get('buckets', 16))
+        if action == 'status':
+            return {'backfill_id': body['backfill_id'], **summarize(load_shards(client, body['backfill_id']))}
+        if action == 'resume':
+            shards = load_shards(client, body['backfill_id'])
+            if not shards:
+                return {'error': f"Unknown backfill {body['backfill_id']}"}, 404
+            return resume(client, CloudTasksQueue(), worker_url(shards[0]['layer']), body['backfill_id'])
+        if action == 'finalize':
+            shards = load_shards(client, body['backfill_id'])
+            if not shards:
+                return {'error': f"Unknown backfill {body['backfill_id']}"}, 404
+            return finalize(client, body['backfill_id'], worker_url(shards[0]['layer']), force=body.get('force', False))
+        return {'error': f"Unknown action {action!r}"}, 400
+    except (KeyError, ValueError) as e:
+        return {'error': f"Invalid request: {str(e)}"}, 400
+    except Exception as e:
+        logger.error(f"❌ Backfill {action} failed: {str(e)}")
+        return {'error': str(e)}, 500
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a sharded backfill with the in-memory task queue')
+    parser.add_argument('layer', choices=sorted(WORKER_URL_ENV))
+    parser.add_argument('tables', nargs='+')
+    parser.add_argument('--worker-url', required=True, help='refresh_silver / refresh_gold URL (e.g. local functions-framework)')
+    parser.add_argument('--shard-by', choices=['date', 'user'], default='user')
+    parser.add_argument('--start-date')
+    parser.add_argument('--end-date', default=date.today().isoformat())
+    parser.add_argument('--days-per-shard', type=int, default=30)
+    parser.add_argument('--buckets', type=int, default=16)
+    parser.add_argument('--mode', choices=['in_place', 'rebuild'], default='in_place')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--auth', action='store_true', help='Send ID tokens (deployed workers)')
+    args = parser.parse_args()
+
+    client = bigquery.Client(project=PROJECT_ID)
+    local_queue = LocalTaskQueue(concurrency=args.concurrency, max_attempts=args.max_attempts, auth=args.auth)
+    started = start(client, local_queue, args.worker_url, args.layer, args.tables, args.shard_by, mode=args.mode,
+                    auth=args.auth, start_date=args.start_date, end_date=args.end_date,
+                    days_per_shard=args.days_per_shard, buckets=args.buckets)
+    local_queue.join()
+    summary = summarize(load_shards(client, started['backfill_id']))
+    print(json.dumps({'backfill_id': started['backfill_id'], **summary}, indent=2, default=str))
+    if args.mode == 'rebuild' and summary['complete']:
+        print(json.dumps(finalize(client, started['backfill_id'], args.worker_url, auth=args.auth), indent=2))
@@ -0,0 +1,313 @@
+"""
+Cloud Function to orchestrate the data pipeline with change detection
+Triggered by: Cloud Scheduler (daily 2 AM UTC)
+Runtime: Python 3.11
+
+Runs silver → gold → snapshot → quality in order, but only the steps whose
+source tables changed since the step last consumed them. Source change is read
+from table metadata (last_modified_time, free) and, for changed tables, from
+INFORMATION_SCHEMA.PARTITIONS. Every decision is written to
+quality.pipeline_lineage; a step's consumed watermark only advances when it
+succeeds, so failed steps are retried on the next run.
+
+Request body (optional JSON):
+    {"force": ["gold"]}   run these steps regardless of change detection
+    {"dry_run": true}     report decisions without running anything
+"""
+import functions_framework
+from google.cloud import bigquery
+import json
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROJECT_ID = os.environ.get('PROJECT_ID', 'junoplus-dev')
+DATASET_BRONZE = os.environ.get('BRONZE_DATASET_ID', 'junoplus_analytics_dev')
+DATASET_SILVER = os.environ.get('SILVER_DATASET_ID', 'junoplus_analytics_silver_dev')
+DATASET_GOLD = os.environ.get('GOLD_DATASET_ID', 'junoplus_analytics_gold_dev')
+DATASET_QUALITY = os.environ.get('QUALITY_DATASET_ID', 'junoplus_analytics_quality_dev')
+STEP_TIMEOUT_SECONDS = int(os.environ.get('STEP_TIMEOUT_SECONDS', '900'))
+SNAPSHOT_MIN_INTERVAL_HOURS = int(os.environ.get('SNAPSHOT_MIN_INTERVAL_HOURS', '144'))
+MAX_PARTITION_IDS = 100
+
+LINEAGE_TABLE = f"{PROJECT_ID}.{DATASET_QUALITY}.pipeline_lineage"
+
+
+def _silver(name):
+    return f"{PROJECT_ID}.{DATASET_SILVER}.{name}"
+
+
+def _gold(name):
+    return f"{PROJECT_ID}.{DATASET_GOLD}.{name}"
+
+
+# In dependency order; a step's targets are the next steps' sources
+STEPS = [
+    {
+        'name': 'silver',
+        'url_env': 'SILVER_FUNCTION_URL',
+        'sources': [f"{PROJECT_ID}.{DATASET_BRONZE}.{t}" for t in (
+            'therapy_sessions_data_raw_changelog',
+            'user_health_data_raw_changelog',
+            'medications_data_raw_changelog',
+            'period_tracking_data_raw_latest',
+        )],
+        'targets': [_silver(t) for t in (
+            'silver_therapy_sessions', 'silver_user_profiles', 'silver_medications', 'silver_period_tracking',
+        )],
+    },
+    {
+        'name': 'gold',
+        'url_env': 'GOLD_FUNCTION_URL',
+        'payload': {'snapshot': False},
+        'sources': [_silver('silver_therapy_sessions'), _silver('silver_user_profiles'),
+                    _silver('silver_period_tracking')],
+        # gold.user_cycle_index_v1 is also rebuilt, but is not a target: its failure must not
+        # fail the step and skip the snapshot (refresh_gold reports it in its response)
+        'targets': [_gold('user_analytics_v1'), _gold('ml_training_base_v2')],
+    },
+    {
+        'name': 'snapshot',
+        'url_env': 'SNAPSHOT_FUNCTION_URL',
+        'sources': [_gold('ml_training_base_v2')],
+        'targets': [],
+        'min_interval_hours': SNAPSHOT_MIN_INTERVAL_HOURS,
+    },
+    {
+        'name': 'quality',
+        'url_env': 'QUALITY_FUNCTION_URL',
+        'sources': [
+            _silver('silver_therapy_sessions'), _silver('silver_user_profiles'),
+            _silver('silver_medications'), _silver('silver_period_tracking'),
+            _gold('user_analytics_v1'), _gold('ml_training_base_v2'),
+        ],
+        'targets': [],
+    },
+]
+
+
+def consumed_watermarks(client):
+    """{(step, source_table): last_modified consumed by the step's latest successful run}"""
+    query = f"""
+        SELECT step, source_table, MAX(source_last_modified) as consumed
+        FROM `{LINEAGE_TABLE}`
+        WHERE status = 'success'
+        GROUP BY step, source_table
+    """
+    try:
+        return {(row.step, row.source_table): row.consumed for row in client.query(query).result()}
+    except Exception as e:
+        logger.warning(f"⚠️  No lineage yet ({str(e)[:100]}), treating every step as stale")
+        return {}
+
+
+def last_snapshot_at(client):
+    """Creation time of the newest registered ML snapshot (fallback before lineage exists)"""
+    query = f"SELECT MAX(created_at) as created_at FROM `{_gold('dataset_registry')}`"
+    try:
+        return next(iter(client.query(query).result())).created_at
+    except Exception:
+        return None
+
+
+def last_success_at(client, step):
+    query = f"""
+        SELECT MAX(finished_at) as finished_at
+        FROM `{LINEAGE_TABLE}`
+        WHERE step = @step AND status = 'success'
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('step', 'STRING', step),
+    ])
+    try:
+        return next(iter(client.query(query, job_config=job_config).result())).finished_at
+    except Exception:
+        return None
+
+
+def changed_partitions(client, table_id, since):
+    """Partition ids of table_id modified after `since` (all partitions if since is None)"""
+    project, dataset, table = table_id.split('.')
+    query = f"""
+        SELECT partition_id
+        FROM `{project}.{dataset}.INFORMATION_SCHEMA.PARTITIONS`
+        WHERE table_name = @table
+          AND (@since IS NULL OR last_modified_time > @since)
+        ORDER BY partition_id
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('table', 'STRING', table),
+        bigquery.ScalarQueryParameter('since', 'TIMESTAMP', since),
+    ])
+    try:
+        return [row.partition_id or '__UNPARTITIONED__' for row in client.query(query, job_config=job_config).result()]
+    except Exception as e:
+        logger.warning(f"⚠️  Partition metadata unavailable for {table_id}: {str(e)[:100]}")
+        return []
+
+
+def inspect_sources(client, step, watermarks):
+    """One lineage record per source: its current last_modified and what changed since consumption"""
+    sources = []
+    for table_id in step['sources']:
+        try:
+            modified = client.get_table(table_id).modified
+        except Exception as e:
+            logger.warning(f"⚠️  Cannot read metadata of {table_id}: {str(e)[:100]}")
+            modified = None
+        consumed = watermarks.get((step['name'], table_id))
+        changed = modified is not None and (consumed is None or modified > consumed)
+        partitions = changed_partitions(client, table_id, consumed) if changed else []
+        sources.append({
+            'source_table': table_id,
+            'source_last_modified': modified,
+            'consumed_last_modified': consumed,
+            'changed': changed,
+            'changed_partitions': len(partitions),
+            'changed_partition_ids': partitions[:MAX_PARTITION_IDS],
+        })
+    return sources
+
+
+def decide(client, step, sources, force):
+    """(run?, reason) for a step"""
+    if step['name'] in force:
+        return True, 'forced'
+    changed = [s['source_table'].split('.')[-1] for s in sources if s['changed']]
+    if not changed:
+        return False, 'sources unchanged'
+    if step.get('min_interval_hours'):
+        previous = last_success_at(client, step['name'])
+        if previous is None and step['name'] == 'snapshot':
+            previous = last_snapshot_at(client)
+        if previous and datetime.now(timezone.utc) - previous < timedelta(hours=step['min_interval_hours']):
+            return False, f"changed ({', '.join(changed)}) but last run {previous:%Y-%m-%d %H:%M} is within {step['min_interval_hours']}h"
+    return True, f"changed: {', '.join(changed)}"
+
+
+def call_function(url, payload):
+    """POST to a pipeline function with an ID token for its URL; returns the parsed response"""
+    import google.auth.transport.requests
+    import google.oauth2.id_token
+    import requests
+
+    token = google.oauth2.id_token.fetch_id_token(google.auth.transport.requests.Request(), url)
+    response = requests.post(url, json=payload, timeout=STEP_TIMEOUT_SECONDS,
+                             headers={'Authorization': f'Bearer {token}'})
+    response.raise_for_status()
+    try:
+        return response.json()
+    except ValueError:
+        return {'response': response.text[:1000]}
+
+
+def run_step(client, step):
+    """Invoke the step's function and check that every target table was rewritten"""
+    url = os.environ.get(step['url_env'])
+    if not url:
+        raise RuntimeError(f"{step['url_env']} is not set")
+    started = datetime.now(timezone.utc)
+    response = call_function(url, step.get('payload', {}))
+    stale_targets = []
+    for table_id in step['targets']:
+        modified = client.get_table(table_id).modified
+        if modified is None or modified < started:
+            stale_targets.append(table_id.split('.')[-1])
+    if stale_targets:
+        raise RuntimeError(f"targets not refreshed: {', '.join(stale_targets)}")
+    return response
+
+
+def lineage_rows(run_id, step, sources, status, reason, started_at, finished_at, response=None):
+    return [{
+        'run_id': run_id,
+        'step': step['name'],
+        'status': status,
+        'reason': reason[:1000],
+        'source_table': s['source_table'],
+        'source_last_modified': s['source_last_modified'].isoformat() if s['source_last_modified'] else None,
+        'consumed_last_modified': s['consumed_last_modified'].isoformat() if s['consumed_last_modified'] else None,
+        'changed_partitions': s['changed_partitions'],
+        'changed_partition_ids': s['changed_partition_ids'],
+        'target_tables': step['targets'],
+        'started_at': started_at.isoformat(),
+        'finished_at': finished_at.isoformat(),
+        'response': json.dumps(response, default=str) if response is not None else None,
+    } for s in sources]
+
+
+@functions_framework.http
+def main(request):
+    """Run the stale pipeline steps in dependency order and record lineage"""
+
+    body = request.get_json(silent=True) or {}
+    force = set(body.get('force', []))
+    dry_run = bool(body.get('dry_run', False))
+
+    client = bigquery.Client(project=PROJECT_ID)
+    run_id = f"orchestrator-{datetime.now(timezone.utc):%Y%m%dt%H%M%S}-{uuid.uuid4().hex[:8]}"
+    start_time = datetime.now()
+
+    logger.info(f"🔄 Starting pipeline run {run_id}{' (dry run)' if dry_run else ''}")
+
+    watermarks = consumed_watermarks(client)
+    results = []
+    lineage = []
+    failed = None
+
+    for step in STEPS:
+        step_start = datetime.now(timezone.utc)
+        # Read metadata only now, so upstream steps that just ran are seen as changes
+        sources = inspect_sources(client, step, watermarks)
+
+        if failed:
+            should_run, reason = False, f"upstream step {failed} failed"
+        else:
+            should_run, reason = decide(client, step, sources, force)
+
+        if not should_run or dry_run:
+            status = 'would_run' if should_run else 'skipped'
+            logger.info(f"  ⏭️  {step['name']}: {status} ({reason})")
+            results.append({'step': step['name'], 'status': status, 'reason': reason})
+            lineage.extend(lineage_rows(run_id, step, sources, status, reason, step_start, datetime.now(timezone.utc)))
+            continue
+
+        logger.info(f"  → Running {step['name']} ({reason})...")
+        try:
+            response = run_step(client, step)
+            status = 'success'
+            logger.info(f"  ✅ {step['name']} complete")
+        except Exception as e:
+            response = {'error': str(e)}
+            status = 'error'
+            failed = step['name']
+            logger.error(f"  ❌ {step['name']} failed: {str(e)}")
+
+        results.append({'step': step['name'], 'status': status, 'reason': reason})
+        lineage.extend(lineage_rows(run_id, step, sources, status, reason, step_start,
+                                    datetime.now(timezone.utc), response))
+
+    if lineage:
+        try:
+            errors = client.insert_rows_json(LINEAGE_TABLE, lineage)
+            if errors:
+                logger.warning(f"⚠️  Lineage insert errors: {errors[:3]}")
+        except Exception as e:
+            logger.error(f"❌ Could not record lineage: {str(e)}")
+
+    duration = (datetime.now() - start_time).total_seconds()
+    ran = sum(1 for r in results if r['status'] in ('success', 'error'))
+    logger.info(f"✅ Pipeline run complete: {ran}/{len(STEPS)} steps ran ({duration:.1f}s)")
+
+    return {
+        'status': 'error' if failed else 'completed',
+        'run_id': run_id,
+        'dry_run': dry_run,
+        'steps': results,
+        'duration_seconds': duration,
+        'timestamp': datetime.now().isoformat()
+    }
@@ -182,6 +182,83 @@ def main(request):
     except Exception as e:
         logger.error(f"  ❌ Error checking anomalies: {str(e)}")
     
+    # Check prediction API drift (sketch windows flushed by the API today)
+    try:
+        logger.info("  → Checking prediction drift...")
+        
+        drift_query = f"""
+            SELECT
+              JSON_VALUE(alert, '$.type') as alert_type,
+              JSON_VALUE(alert, '$.metric') as metric_name,
+              model_version,
+              MAX(JSON_VALUE(alert, '$.status')) as status,
+              MAX(CAST(JSON_VALUE(alert, '$.value') AS FLOAT64)) as psi,
+              MAX(CAST(JSON_VALUE(alert, '$.ks') AS FLOAT64)) as ks,
+              COUNT(*) as windows
+            FROM `{PROJECT_ID}.{DATASET_QUALITY}.prediction_drift`,
+              UNNEST(JSON_QUERY_ARRAY(alerts)) as alert
+            WHERE DATE(flushed_at) = CURRENT_DATE()
+            GROUP BY alert_type, metric_name, model_version
+        """
+        
+        drift_results = client.query(drift_query).result()
+        
+        for row in drift_results:
+            alert_msg = f"{'❌' if row.status == 'FAIL' else '⚠️ '} DRIFT {row.status}: {row.metric_name} PSI = {row.psi:.3f}, KS = {row.ks:.3f} ({row.windows} window(s), {row.model_version})"
+            logger.warning(alert_msg)
+            results['alerts'].append({
+                'type': row.alert_type,
+                'table': 'predict-tens-level',
+                'metric': row.metric_name,
+                'status': row.status,
+                'value': row.psi,
+                'ks': row.ks,
+                'model_version': row.model_version,
+                'message': alert_msg
+            })
+        
+        if not any(a['type'] in ('feature_drift', 'prediction_drift') for a in results['alerts']):
+            logger.info("  ✅ No prediction drift")
+        
+    except Exception as e:
+        logger.error(f"  ❌ Error checking prediction drift: {str(e)}")
+    
+    # Check pipeline job performance regressions (latest run of each step vs its baseline)
+    try:
+        logger.info("  → Checking pipeline job regressions...")
+        
+        regression_query = f"""
+            SELECT function_name, step, run_id, metric, latest_value, baseline_value,
+                   baseline_runs, change_pct, status
+            FROM `{PROJECT_ID}.{DATASET_QUALITY}.pipeline_job_regressions`
+            WHERE status IN ('FAIL', 'WARN')
+            AND DATE(created_at) = CURRENT_DATE()
+        """
+        
+        regression_results = client.query(regression_query).result()
+        
+        for row in regression_results:
+            change = f"{row.change_pct:+.0f}%" if row.change_pct is not None else "new"
+            alert_msg = f"{'❌' if row.status == 'FAIL' else '⚠️ '} REGRESSION {row.status}: {row.function_name}.{row.step} {row.metric} = {row.latest_value:,} vs median {row.baseline_value:,} ({change}, {row.baseline_runs} baseline runs)"
+            logger.warning(alert_msg)
+            results['alerts'].append({
+                'type': 'pipeline_regression',
+                'table': f"{row.function_name}.{row.step}",
+                'metric': row.metric,
+                'status': row.status,
+                'value': row.latest_value,
+                'baseline': row.baseline_value,
+                'change_pct': row.change_pct,
+                'run_id': row.run_id,
+                'message': alert_msg
+            })
+        
+        if not any(a['type'] == 'pipeline_regression' for a in results['alerts']):
+            logger.info("  ✅ No pipeline job regressions")
+        
+    except Exception as e:
+        logger.error(f"  ❌ Error checking pipeline regressions: {str(e)}")
+    
     # Generate summary
     end_time = datetime.now()
     duration = (end_time - start_time).total_seconds()
@@ -191,6 +268,8 @@ def main(request):
         'stale_tables': sum(1 for a in results['alerts'] if a['type'] == 'stale_data'),
         'quality_issues': sum(1 for a in results['alerts'] if a['type'] == 'quality_metric'),
         'anomalies': sum(1 for a in results['alerts'] if a['type'] == 'row_count_anomaly'),
+        'drift_alerts': sum(1 for a in results['alerts'] if a['type'] in ('feature_drift', 'prediction_drift')),
+        'pipeline_regressions': sum(1 for a in results['alerts'] if a['type'] == 'pipeline_regression'),
         'duration_seconds': duration,
         'timestamp': end_time.isoformat()
     }
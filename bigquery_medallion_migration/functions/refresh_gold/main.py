@@ -7,93 +7,283 @@ import functions_framework
 from google.cloud import bigquery
 import logging
 import os
-from datetime import datetime
+import uuid
+from datetime import datetime, timezone
+
+from pipeline_jobs import process_backfill, run_step, save_job_stats, split_query
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+# Per-user running state behind user_analytics_v1: metric -> silver_therapy_sessions column
+USER_STATE_METRICS = {
+    'duration': 'duration_minutes',
+    'effectiveness': 'pain_reduction_pct',
+    'heat': 'final_heat',
+    'tens': 'final_tens',
+}
+
+# Users whose user_analytics_v1 row is compared with the full query on every run
+USER_STATE_CHECK_USERS = 100
+
+# user_analytics_v1 columns derived from the state
+USER_STATS = {
+    'total_sessions': 'SUM(session_count)',
+    'avg_duration': 'SAFE_DIVIDE(SUM(duration_sum), SUM(duration_count))',
+    'avg_effectiveness': 'SAFE_DIVIDE(SUM(effectiveness_sum), SUM(effectiveness_count))',
+    'preferred_heat': 'SAFE_DIVIDE(SUM(heat_sum), SUM(heat_count))',
+    'preferred_tens': 'SAFE_DIVIDE(SUM(tens_sum), SUM(tens_count))',
+}
+
+
+def user_state_columns(indent=12):
+    """Mergeable per-user aggregates of silver sessions: counts, sums and sums of squares"""
+    columns = ['COUNT(*) as session_count']
+    for metric, column in USER_STATE_METRICS.items():
+        columns += [
+            f"COUNT({column}) as {metric}_count",
+            f"SUM(CAST({column} AS FLOAT64)) as {metric}_sum",
+            f"SUM(POW(CAST({column} AS FLOAT64), 2)) as {metric}_sumsq",
+        ]
+    columns += ['MIN(start_time) as first_session_at', 'MAX(start_time) as last_session_at',
+                'MAX(processed_at) as loaded_through']
+    return (',\n' + ' ' * indent).join(columns)
+
+
+def user_analytics_incremental(project_id, dataset_gold, dataset_silver, full_query):
+    """
+    Script that refolds gold.user_session_state for the users whose sessions were loaded,
+    changed or removed since the last run, and rebuilds user_analytics_v1 from the state,
+    so each run reads those users' sessions instead of every user's lifetime history.
+    silver_therapy_sessions is updated in place, so processed_at only moves for new or
+    changed sessions; removed ones show as a lower session count.
+    A sample of users is checked against full_query first; on any difference the whole
+    state is rebuilt from silver. The script returns the sampled and mismatched user counts.
+    The first run (no state table) aggregates all sessions once; to rebuild the state from
+    scratch, drop the table.
+    """
+    state = f"{project_id}.{dataset_gold}.user_session_state"
+    sessions = f"{project_id}.{dataset_silver}.silver_therapy_sessions"
+    _, _, full_body = split_query(full_query)
+    totals = ',\n            '.join(f"{expression} as {name}" for name, expression in USER_STATS.items())
+    sampled_totals = totals.replace('\n', '\n  ')
+    # Float sums and AVG differ in the last bits, so averages match within a relative 1e-9
+    same = '\n                AND '.join(
+        ['i.total_sessions = f.total_sessions'] + [
+            f"((i.{name} IS NULL AND f.{name} IS NULL) OR "
+            f"ABS(i.{name} - f.{name}) <= 1e-9 * GREATEST(1, ABS(f.{name})))"
+            for name in USER_STATS if name != 'total_sessions'
+        ])
+
+    def refold(indent):
+        """INSERT of the recomputed state rows, up to its WHERE clause"""
+        pad = ' ' * indent
+        return (f"INSERT INTO `{state}`\n{pad}SELECT\n{pad}  user_id,\n"
+                f"{pad}  {user_state_columns(indent + 2)},\n{pad}  CURRENT_TIMESTAMP() as updated_at\n"
+                f"{pad}FROM `{sessions}`\n{pad}WHERE user_id IS NOT NULL")
+
+    return f"""
+        DECLARE watermark TIMESTAMP;
+        DECLARE sampled INT64;
+        DECLARE mismatched INT64;
+
+        -- A state folded by session date (no loaded_through column) is rebuilt too
+        IF NOT EXISTS (
+          SELECT 1 FROM `{project_id}.{dataset_gold}.INFORMATION_SCHEMA.COLUMNS`
+          WHERE table_name = 'user_session_state' AND column_name = 'loaded_through'
+        ) THEN
+          CREATE OR REPLACE TABLE `{state}`
+          CLUSTER BY user_id
+          AS
+          SELECT
+            user_id,
+            {user_state_columns()},
+            CURRENT_TIMESTAMP() as updated_at
+          FROM `{sessions}`
+          WHERE user_id IS NOT NULL
+          GROUP BY user_id;
+        END IF;
+
+        SET watermark = (SELECT MAX(loaded_through) FROM `{state}`);
+
+        CREATE TEMP TABLE changed_users AS
+        SELECT user_id
+        FROM (
+          SELECT
+            user_id,
+            COUNT(*) as session_count,
+            LOGICAL_OR(IFNULL(processed_at > watermark, TRUE)) as loaded
+          FROM `{sessions}`
+          WHERE user_id IS NOT NULL
+          GROUP BY user_id
+        ) c
+        FULL OUTER JOIN (SELECT user_id, session_count FROM `{state}`) s USING (user_id)
+        WHERE IFNULL(c.loaded, FALSE) OR c.session_count IS DISTINCT FROM s.session_count;
+
+        BEGIN TRANSACTION;
+        DELETE FROM `{state}` WHERE user_id IN (SELECT user_id FROM changed_users);
+        {refold(8)}
+          AND user_id IN (SELECT user_id FROM changed_users)
+        GROUP BY user_id;
+        COMMIT TRANSACTION;
+
+        CREATE TEMP TABLE sampled_users AS
+        SELECT user_id FROM `{state}` ORDER BY RAND() LIMIT {USER_STATE_CHECK_USERS};
+
+        SET (sampled, mismatched) = (
+          WITH incremental AS (
+            SELECT
+              user_id,
+              {sampled_totals}
+            FROM `{state}`
+            WHERE user_id IN (SELECT user_id FROM sampled_users)
+            GROUP BY user_id
+          )
+          SELECT AS STRUCT
+            COUNT(*),
+            COUNTIF(NOT IFNULL(
+                {same},
+                FALSE))
+          FROM incremental i
+          FULL OUTER JOIN (
+            SELECT user_id, {', '.join(USER_STATS)}
+            FROM ({full_body})
+            WHERE user_id IN (SELECT user_id FROM sampled_users)
+          ) f USING (user_id)
+        );
+
+        IF mismatched > 0 THEN
+          BEGIN TRANSACTION;
+          DELETE FROM `{state}` WHERE TRUE;
+          {refold(10)}
+          GROUP BY user_id;
+          COMMIT TRANSACTION;
+        END IF;
+
+        CREATE OR REPLACE TABLE `{project_id}.{dataset_gold}.user_analytics_v1`
+        CLUSTER BY user_id, user_segment
+        AS
+        WITH user_stats AS (
+          SELECT
+            user_id,
+            {totals}
+          FROM `{state}`
+          GROUP BY user_id
+        ),
+        user_details AS (
+          SELECT
+            user_id,
+            age,
+            CASE
+              WHEN age < 25 THEN '18-24'
+              WHEN age < 35 THEN '25-34'
+              WHEN age < 45 THEN '35-44'
+              WHEN age < 55 THEN '45-54'
+              ELSE '55+'
+            END as age_group
+          FROM `{project_id}.{dataset_silver}.silver_user_profiles`
+        )
+        SELECT
+          s.*,
+          d.age,
+          d.age_group,
+          CASE
+            WHEN s.total_sessions < 5 THEN 'New User'
+            WHEN s.total_sessions < 20 THEN 'Regular User'
+            ELSE 'Power User'
+          END as user_segment,
+          CURRENT_TIMESTAMP() AS processed_at
+        FROM user_stats s
+        LEFT JOIN user_details d ON s.user_id = d.user_id;
+
+        SELECT sampled as sampled_users, mismatched as mismatched_users;
+    """
+
+
 @functions_framework.http
 def main(request):
     """Refresh all Gold layer tables in dependency order"""
     
+    # The orchestrator sends {"snapshot": false} and runs create_ml_snapshot itself
+    # only when ml_training_base_v2 changed
+    create_snapshot = (request.get_json(silent=True) or {}).get('snapshot', True)
+    
     PROJECT_ID = os.environ.get('PROJECT_ID', 'junoplus-dev')
     DATASET_GOLD = os.environ.get('GOLD_DATASET_ID', 'junoplus_analytics_gold_dev')
     DATASET_SILVER = os.environ.get('SILVER_DATASET_ID', '{DATASET_SILVER}_dev')
-    DATASET_SEMANTIC = 'junoplus_analytics_semantic'
+    DATASET_QUALITY = os.environ.get('QUALITY_DATASET_ID', 'junoplus_analytics_quality_dev')
     
     client = bigquery.Client(project=PROJECT_ID)
     start_time = datetime.now()
+    run_id = f"refresh_gold-{datetime.now(timezone.utc):%Y%m%dt%H%M%S}-{uuid.uuid4().hex[:8]}"
+    ledger = []
     
     logger.info(f"🔄 Starting Gold layer refresh at {start_time}")
     
-    # Tables must be refreshed in order due to dependencies
+    user_analytics_query = f"""
+            CREATE OR REPLACE TABLE `{PROJECT_ID}.{DATASET_GOLD}.user_analytics_v1`
+            CLUSTER BY user_id, user_segment
+            AS
+            WITH user_stats AS (
+              SELECT 
+                user_id,
+                COUNT(*) as total_sessions,
+                AVG(duration_minutes) as avg_duration,
+                AVG(pain_reduction_pct) as avg_effectiveness,
+                AVG(final_heat) as preferred_heat,
+                AVG(final_tens) as preferred_tens
+              FROM `{PROJECT_ID}.{DATASET_SILVER}.silver_therapy_sessions`
+              WHERE user_id IS NOT NULL
+              GROUP BY user_id
+            ),
+            user_details AS (
+              SELECT 
+                user_id,
+                age,
+                CASE 
+                  WHEN age < 25 THEN '18-24'
+                  WHEN age < 35 THEN '25-34'
+                  WHEN age < 45 THEN '35-44'
+                  WHEN age < 55 THEN '45-54'
+                  ELSE '55+'
+                END as age_group
+              FROM `{PROJECT_ID}.{DATASET_SILVER}.silver_user_profiles`
+            )
+            SELECT 
+              s.*,
+              d.age,
+              d.age_group,
+              CASE 
+                WHEN s.total_sessions < 5 THEN 'New User'
+                WHEN s.total_sessions < 20 THEN 'Regular User'
+                ELSE 'Power User'
+              END as user_segment,
+              CURRENT_TIMESTAMP() AS processed_at
+            FROM user_stats s
+            LEFT JOIN user_details d ON s.user_id = d.user_id
+        """
+
+    # Tables must be refreshed in order due to dependencies.
+    # daily_metrics_v1 and semantic.user_health_dashboard_v1 are materialized /
+    # logical views kept fresh by BigQuery (sql/gold_materialized_views.sql); they rely
+    # on refresh_silver updating silver_therapy_sessions in place
     tables_config = [
         {
             'name': 'user_analytics_v1',
-            'query': f"""
-                CREATE OR REPLACE TABLE `{PROJECT_ID}.{DATASET_GOLD}.user_analytics_v1`
-                CLUSTER BY user_id, user_segment
-                AS
-                WITH user_stats AS (
-                  SELECT 
-                    user_id,
-                    COUNT(*) as total_sessions,
-                    AVG(duration_minutes) as avg_duration,
-                    AVG(pain_reduction_pct) as avg_effectiveness,
-                    AVG(final_heat) as preferred_heat,
-                    AVG(final_tens) as preferred_tens
-                  FROM `{PROJECT_ID}.{DATASET_SILVER}.silver_therapy_sessions`
-                  GROUP BY user_id
-                ),
-                user_details AS (
-                  SELECT 
-                    user_id,
-                    age,
-                    CASE 
-                      WHEN age < 25 THEN '18-24'
-                      WHEN age < 35 THEN '25-34'
-                      WHEN age < 45 THEN '35-44'
-                      WHEN age < 55 THEN '45-54'
-                      ELSE '55+'
-                    END as age_group
-                  FROM `{PROJECT_ID}.{DATASET_SILVER}.silver_user_profiles`
-                )
-                SELECT 
-                  s.*,
-                  d.age,
-                  d.age_group,
-                  CASE 
-                    WHEN s.total_sessions < 5 THEN 'New User'
-                    WHEN s.total_sessions < 20 THEN 'Regular User'
-                    ELSE 'Power User'
-                  END as user_segment,
-                  CURRENT_TIMESTAMP() AS processed_at
-                FROM user_stats s
-                LEFT JOIN user_details d ON s.user_id = d.user_id
-            """
-        },
-        {
-            'name': 'daily_metrics_v1',
-            'query': f"""
-                CREATE OR REPLACE TABLE `{PROJECT_ID}.{DATASET_GOLD}.daily_metrics_v1`
-                PARTITION BY session_date
-                CLUSTER BY session_date
-                AS
-                SELECT 
-                  session_date,
-                  COUNT(*) as session_count,
-                  COUNT(DISTINCT user_id) as active_users,
-                  AVG(duration_minutes) as avg_duration,
-                  AVG(pain_reduction_pct) as avg_effectiveness,
-                  AVG(final_heat) as avg_heat,
-                  AVG(final_tens) as avg_tens,
-                  CURRENT_TIMESTAMP() AS processed_at
-                FROM `{PROJECT_ID}.{DATASET_SILVER}.silver_therapy_sessions`
-                GROUP BY session_date
-            """
+            'shard_columns': {'user': 'user_id'},
+            # Scheduled refreshes maintain it from user_session_state; the full query is
+            # what backfill shards recompute and what sampled users are checked against
+            'incremental': user_analytics_incremental(PROJECT_ID, DATASET_GOLD, DATASET_SILVER,
+                                                      user_analytics_query),
+            'query': user_analytics_query,
+            # Dropped by backfill shards, so the next scheduled run rebuilds it from silver
+            # instead of overwriting the backfilled table from a stale state
+            'state_tables': [f"{PROJECT_ID}.{DATASET_GOLD}.user_session_state"],
         },
         {
             'name': 'ml_training_base_v2',
+            'shard_columns': {'date': 'session_date', 'user': 'user_id'},
             'query': f"""
                 CREATE OR REPLACE TABLE `{PROJECT_ID}.{DATASET_GOLD}.ml_training_base_v2`
                 PARTITION BY session_date
@@ -133,31 +323,69 @@ def main(request):
                   ON s.user_id = u.user_id
                 WHERE s.has_feedback = TRUE
             """
+        },
+        {
+            # Exported to the prediction API's cycle index (tens_prediction_api/cycle_index.py).
+            # The latest period start is the newer of the last tracked period (a day logged with
+            # its cycle day) and the profile's lastPeriodDate; lengths outside the API's accepted
+            # ranges are left NULL. Not needed by the ML snapshot, so its failure does not block it
+            'name': 'user_cycle_index_v1',
+            'shard_columns': {'user': 'user_id'},
+            'gates_snapshot': False,
+            'query': f"""
+                CREATE OR REPLACE TABLE `{PROJECT_ID}.{DATASET_GOLD}.user_cycle_index_v1`
+                CLUSTER BY user_id
+                AS
+                WITH tracked AS (
+                  SELECT
+                    user_id,
+                    MAX(DATE_SUB(date, INTERVAL cycle_day - 1 DAY)) as tracked_period_start,
+                    MAX(date) as last_tracked_date
+                  FROM `{PROJECT_ID}.{DATASET_SILVER}.silver_period_tracking`
+                  WHERE user_id IS NOT NULL
+                    AND date IS NOT NULL
+                    AND cycle_day BETWEEN 1 AND 45
+                  GROUP BY user_id
+                ),
+                profiles AS (
+                  SELECT
+                    user_id,
+                    DATE(last_period_date) as profile_period_start,
+                    cycle_length,
+                    period_length
+                  FROM `{PROJECT_ID}.{DATASET_SILVER}.silver_user_profiles`
+                  WHERE user_id IS NOT NULL
+                )
+                SELECT
+                  COALESCE(p.user_id, t.user_id) as user_id,
+                  GREATEST(
+                    COALESCE(t.tracked_period_start, p.profile_period_start),
+                    COALESCE(p.profile_period_start, t.tracked_period_start)
+                  ) as last_period_start,
+                  IF(p.profile_period_start IS NULL OR t.tracked_period_start > p.profile_period_start,
+                     'period_tracking', 'profile') as period_start_source,
+                  t.last_tracked_date,
+                  IF(p.cycle_length BETWEEN 21 AND 45, p.cycle_length, NULL) as cycle_length,
+                  IF(p.period_length BETWEEN 2 AND 10, p.period_length, NULL) as period_length,
+                  CURRENT_TIMESTAMP() as processed_at
+                FROM profiles p
+                FULL OUTER JOIN tracked t ON p.user_id = t.user_id
+                WHERE COALESCE(t.tracked_period_start, p.profile_period_start) IS NOT NULL
+            """
         }
     ]
-    
-    # Also refresh semantic layer
-    semantic_config = {
-        'name': 'user_health_dashboard_v1',
-        'query': f"""
-            CREATE OR REPLACE TABLE `{PROJECT_ID}.{DATASET_SEMANTIC}.user_health_dashboard_v1`
-            AS
-            SELECT
-              ua.user_id,
-              ua.age_group,
-              ua.total_sessions,
-              ua.avg_duration,
-              ua.avg_effectiveness,
-              ua.user_segment,
-              CASE
-                WHEN ua.avg_effectiveness >= 0.7 THEN 'Highly Effective'
-                WHEN ua.avg_effectiveness >= 0.5 THEN 'Effective'
-                ELSE 'Needs Improvement'
-              END as effectiveness_level,
-              CURRENT_TIMESTAMP() as refreshed_at
-            FROM `{PROJECT_ID}.{DATASET_GOLD}.user_analytics_v1` ua
-        """
-    }
+
+    # Backfill worker invocation (task from functions/backfill)
+    backfill = (request.get_json(silent=True) or {}).get('backfill')
+    if backfill:
+        try:
+            result, status = process_backfill(client, backfill, tables_config,
+                                              f"{PROJECT_ID}.{DATASET_QUALITY}.backfill_checkpoints", 'refresh_gold', ledger), 200
+        except Exception as e:
+            logger.error(f"❌ Backfill task failed: {str(e)}")
+            result, status = {'status': 'error', 'error': str(e)}, 500
+        save_job_stats(client, f"{PROJECT_ID}.{DATASET_QUALITY}.pipeline_job_stats", ledger)
+        return result, status
     
     results = []
     
@@ -167,8 +395,15 @@ def main(request):
         try:
             logger.info(f"  → Refreshing gold.{table_name}...")
             
-            job = client.query(table_config['query'])
-            job.result()
+            job = run_step(client, table_config.get('incremental', table_config['query']),
+                           'refresh_gold', table_name, run_id, ledger)
+            if 'incremental' in table_config:
+                # Incremental scripts end by reporting their sample check against the full query
+                check = next(iter(job.result()))
+                if check.mismatched_users:
+                    logger.warning(f"  ⚠️  user_session_state differed from the full query for "
+                                   f"{check.mismatched_users} of {check.sampled_users} sampled users; "
+                                   f"rebuilt from silver")
             
             table_ref = client.get_table(f"{PROJECT_ID}.{DATASET_GOLD}.{table_name}")
             row_count = table_ref.num_rows
@@ -177,7 +412,8 @@ def main(request):
             results.append({
                 'table': f"gold.{table_name}",
                 'status': 'success',
-                'rows': row_count
+                'rows': row_count,
+                'gates_snapshot': table_config.get('gates_snapshot', True)
             })
             
         except Exception as e:
@@ -185,45 +421,25 @@ def main(request):
             results.append({
                 'table': f"gold.{table_name}",
                 'status': 'error',
-                'error': str(e)
+                'error': str(e),
+                'gates_snapshot': table_config.get('gates_snapshot', True)
             })
     
-    # Refresh Semantic table
-    try:
-        logger.info(f"  → Refreshing semantic.{semantic_config['name']}...")
-        
-        job = client.query(semantic_config['query'])
-        job.result()
-        
-        table_ref = client.get_table(f"{PROJECT_ID}.{DATASET_SEMANTIC}.{semantic_config['name']}")
-        row_count = table_ref.num_rows
-        
-        logger.info(f"  ✅ semantic.{semantic_config['name']} refreshed ({row_count:,} rows)")
-        results.append({
-            'table': f"semantic.{semantic_config['name']}",
-            'status': 'success',
-            'rows': row_count
-        })
-        
-    except Exception as e:
-        logger.error(f"  ❌ Error refreshing semantic.{semantic_config['name']}: {str(e)}")
-        results.append({
-            'table': f"semantic.{semantic_config['name']}",
-            'status': 'error',
-            'error': str(e)
-        })
-    
     end_time = datetime.now()
     duration = (end_time - start_time).total_seconds()
     
     success_count = sum(1 for r in results if r['status'] == 'success')
     total_count = len(results)
+    # Tables the snapshot does not depend on (gates_snapshot False) may fail without blocking it
+    snapshot_blocked = any(r['status'] != 'success' for r in results if r['gates_snapshot'])
     
     logger.info(f"✅ Gold layer refresh complete: {success_count}/{total_count} tables successful ({duration:.1f}s)")
     
     # Create weekly ML snapshot after successful gold refresh
     snapshot_info = None
-    if success_count == total_count:  # Only create snapshot if all tables refreshed successfully
+    if not create_snapshot:
+        logger.info(f"⏭️  Snapshot not requested")
+    elif not snapshot_blocked:  # Only create snapshot if the tables it depends on refreshed successfully
         try:
             logger.info(f"")
             logger.info(f"📸 Creating weekly ML snapshot...")
@@ -244,7 +460,7 @@ def main(request):
             FROM `{PROJECT_ID}.{DATASET_GOLD}.ml_training_base_v2`
             """
             
-            client.query(snapshot_query).result()
+            run_step(client, snapshot_query, 'refresh_gold', 'ml_snapshot', run_id, ledger)
             
             # Get snapshot stats
             table_ref = client.get_table(f"{PROJECT_ID}.{DATASET_GOLD}.{snapshot_table}")
@@ -270,7 +486,7 @@ def main(request):
             WHERE snapshot_id = '{snapshot_name}'
             """
             
-            client.query(registry_query).result()
+            run_step(client, registry_query, 'refresh_gold', 'dataset_registry', run_id, ledger)
             
             logger.info(f"✅ Snapshot created: {snapshot_table}")
             logger.info(f"   Rows: {snapshot_rows:,}")
@@ -289,8 +505,11 @@ def main(request):
     else:
         logger.warning(f"⚠️  Skipping snapshot creation due to table refresh failures")
     
+    save_job_stats(client, f"{PROJECT_ID}.{DATASET_QUALITY}.pipeline_job_stats", ledger)
+    
     return {
         'status': 'completed',
+        'run_id': run_id,
         'duration_seconds': duration,
         'tables_processed': total_count,
         'tables_successful': success_count,
@@ -3,11 +3,70 @@ from google.cloud import bigquery
 import json
 import logging
 import os
+import uuid
+from datetime import datetime, timezone
+
+from pipeline_jobs import in_place_refresh, process_backfill, run_step, save_job_stats
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def compaction_query(changelog, latest, lookback_hours):
+    """
+    Script folding newly appended changelog rows into latest (one row per document_id).
+    Only rows from lookback_hours before the newest compacted timestamp are read (late
+    streaming inserts), so the dedupe scales with changes, not history. The first run
+    creates latest from the whole changelog.
+    """
+    return f"""
+        DECLARE since TIMESTAMP;
+        CREATE TABLE IF NOT EXISTS `{latest}`
+        CLUSTER BY document_id
+        AS SELECT * FROM `{changelog}` WHERE FALSE;
+        SET since = (
+          SELECT COALESCE(TIMESTAMP_SUB(MAX(timestamp), INTERVAL {int(lookback_hours)} HOUR), TIMESTAMP '1970-01-01')
+          FROM `{latest}`
+        );
+        CREATE TEMP TABLE changed AS
+        SELECT * EXCEPT(rn)
+        FROM (
+          SELECT *, ROW_NUMBER() OVER (PARTITION BY document_id ORDER BY timestamp DESC) as rn
+          FROM `{changelog}`
+          WHERE timestamp >= since
+            AND operation IN ('CREATE', 'UPDATE')
+            AND data IS NOT NULL
+        )
+        WHERE rn = 1;
+        BEGIN TRANSACTION;
+        DELETE FROM `{latest}` l
+        WHERE EXISTS (SELECT 1 FROM changed c WHERE c.document_id = l.document_id AND c.timestamp >= l.timestamp);
+        INSERT INTO `{latest}`
+        SELECT * FROM changed c
+        WHERE NOT EXISTS (SELECT 1 FROM `{latest}` l WHERE l.document_id = c.document_id);
+        COMMIT TRANSACTION;
+    """
+
+
+def compact_changelog(client, project_id, dataset_bronze, collection, lookback_hours, retention_days, run_id, ledger):
+    """Compact {collection}_raw_changelog into {collection}_raw_latest, then expire old changelog partitions"""
+    changelog = f"{project_id}.{dataset_bronze}.{collection}_raw_changelog"
+    latest = f"{project_id}.{dataset_bronze}.{collection}_raw_latest"
+    run_step(client, compaction_query(changelog, latest, lookback_hours),
+             'refresh_silver', f"compact_{collection}", run_id, ledger)
+    logger.info(f"🗜️  Compacted {collection}_raw_changelog into {collection}_raw_latest")
+    # Only after a successful compaction: every expiring row is already folded into latest
+    if retention_days > 0:
+        try:
+            client.query(f"""
+                ALTER TABLE `{changelog}`
+                SET OPTIONS (partition_expiration_days = {int(retention_days)})
+            """).result()
+        except Exception as e:
+            logger.warning(f"⚠️  Could not set partition expiration on {changelog}: {str(e)}")
+
+
 @functions_framework.http
 def main(request):
     """
@@ -18,11 +77,27 @@ def main(request):
     project_id = os.environ.get('PROJECT_ID', 'junoplus-dev')
     dataset_silver = os.environ.get('SILVER_DATASET_ID', 'junoplus_analytics_silver_dev')
     dataset_bronze = os.environ.get('BRONZE_DATASET_ID', 'junoplus_analytics_dev')
+    dataset_quality = os.environ.get('QUALITY_DATASET_ID', 'junoplus_analytics_quality_dev')
+    # Late-arriving changelog rows re-read on each compaction; changelog partitions older
+    # than the retention are dropped by BigQuery (0 keeps them forever)
+    compaction_lookback_hours = int(os.environ.get('COMPACTION_LOOKBACK_HOURS', '24'))
+    changelog_retention_days = int(os.environ.get('CHANGELOG_RETENTION_DAYS', '90'))
+    run_id = f"refresh_silver-{datetime.now(timezone.utc):%Y%m%dt%H%M%S}-{uuid.uuid4().hex[:8]}"
+    ledger = []
+
+    # Firebase changelogs compacted to one row per document before the silver queries
+    # (period_tracking_data_raw_latest is maintained by the Firebase extension)
+    changelog_collections = ['therapy_sessions_data', 'user_health_data', 'medications_data']
     
     # Configure tables to refresh with enhanced logic
     tables_config = [
         {
             "name": "silver_therapy_sessions",
+            "shard_columns": {'date': 'session_date', 'user': 'user_id'},
+            # Applied in place by scheduled runs (in_place_refresh, below): the gold materialized
+            # views over this table (sql/gold_materialized_views.sql) are invalidated when the
+            # table is dropped and recreated, and processed_at then marks changed sessions
+            "key": "session_id",
             "query": f"""
                 CREATE OR REPLACE TABLE `{project_id}.{dataset_silver}.silver_therapy_sessions`
                 PARTITION BY session_date
@@ -49,14 +124,12 @@ def main(request):
                     -- Feedback
                     CAST(JSON_VALUE(data, '$.feedback.painLevelBefore') AS INT64) as pain_before,
                     CAST(JSON_VALUE(data, '$.feedback.painLevelAfter') AS INT64) as pain_after,
-                    CAST(JSON_VALUE(data, '$.feedback.feedbackCompleted') AS BOOL) as has_feedback,
-                    ROW_NUMBER() OVER (PARTITION BY document_id ORDER BY timestamp DESC) as rn
-                  FROM `{project_id}.{dataset_bronze}.therapy_sessions_data_raw_changelog`
-                  WHERE operation IN ('CREATE', 'UPDATE')
-                    AND data IS NOT NULL
+                    CAST(JSON_VALUE(data, '$.feedback.feedbackCompleted') AS BOOL) as has_feedback
+                  FROM `{project_id}.{dataset_bronze}.therapy_sessions_data_raw_latest`
+                  WHERE data IS NOT NULL
                 )
                 SELECT
-                  * EXCEPT(rn),
+                  *,
                   -- Effectiveness metrics
                   CASE 
                     WHEN pain_before IS NOT NULL AND pain_after IS NOT NULL 
@@ -83,12 +156,12 @@ def main(request):
                     ELSE FALSE 
                   END as user_adjusted,
                   CURRENT_TIMESTAMP() as processed_at
-                FROM session_data
-                WHERE rn = 1;
+                FROM session_data;
             """
         },
         {
             "name": "silver_user_profiles",
+            "shard_columns": {'user': 'user_id'},
             "query": f"""
                 CREATE OR REPLACE TABLE `{project_id}.{dataset_silver}.silver_user_profiles`
                 CLUSTER BY user_id
@@ -105,9 +178,8 @@ def main(request):
                     CAST(JSON_VALUE(data, '$.healthData.periodLength') AS INT64) as period_length,
                     TIMESTAMP_SECONDS(CAST(JSON_VALUE(data, '$.healthData.lastPeriodDate._seconds') AS INT64)) as last_period_date,
                     ROW_NUMBER() OVER (PARTITION BY JSON_VALUE(data, '$.uid') ORDER BY timestamp DESC) as rn
-                  FROM `{project_id}.{dataset_bronze}.user_health_data_raw_changelog`
-                  WHERE operation IN ('CREATE', 'UPDATE')
-                    AND data IS NOT NULL
+                  FROM `{project_id}.{dataset_bronze}.user_health_data_raw_latest`
+                  WHERE data IS NOT NULL
                     AND JSON_VALUE(data, '$.uid') IS NOT NULL
                 )
                 SELECT
@@ -120,6 +192,7 @@ def main(request):
         },
         {
             "name": "silver_medications",
+            "shard_columns": {'user': 'user_id'},
             "query": f"""
                 CREATE OR REPLACE TABLE `{project_id}.{dataset_silver}.silver_medications`
                 CLUSTER BY user_id
@@ -129,9 +202,8 @@ def main(request):
                     document_id as user_id,
                     JSON_EXTRACT_ARRAY(data, '$.medications') as meds,
                     timestamp
-                  FROM `{project_id}.{dataset_bronze}.medications_data_raw_changelog`
-                  WHERE operation IN ('CREATE', 'UPDATE')
-                    AND data IS NOT NULL
+                  FROM `{project_id}.{dataset_bronze}.medications_data_raw_latest`
+                  WHERE data IS NOT NULL
                 ),
                 flat_meds AS (
                   SELECT
@@ -161,6 +233,7 @@ def main(request):
         },
         {
             "name": "silver_period_tracking",
+            "shard_columns": {'user': 'user_id'},
             "query": f"""
                 CREATE OR REPLACE TABLE `{project_id}.{dataset_silver}.silver_period_tracking`
                 CLUSTER BY user_id
@@ -168,6 +241,13 @@ def main(request):
                 SELECT
                   JSON_VALUE(path_params, '$.userId') as user_id,
                   document_id as cycle_id,
+                  -- Logged day and its cycle day (ISO string or Firestore timestamp); NULL when not logged
+                  COALESCE(
+                    DATE(SAFE.TIMESTAMP(JSON_VALUE(data, '$.date'))),
+                    DATE(TIMESTAMP_SECONDS(SAFE_CAST(JSON_VALUE(data, '$.date._seconds') AS INT64)))
+                  ) as date,
+                  COALESCE(SAFE_CAST(JSON_VALUE(data, '$.cycle_day') AS INT64),
+                           SAFE_CAST(JSON_VALUE(data, '$.cycleDay') AS INT64)) as cycle_day,
                   JSON_VALUE(data, '$.status') as cycle_status,
                   TIMESTAMP_SECONDS(CAST(JSON_VALUE(data, '$.lastUpdate._seconds') AS INT64)) as last_update,
                   CURRENT_TIMESTAMP() as processed_at
@@ -177,14 +257,36 @@ def main(request):
         }
     ]
 
+    # Backfill worker invocation (task from functions/backfill)
+    backfill = (request.get_json(silent=True) or {}).get('backfill')
+    if backfill:
+        try:
+            result, status = process_backfill(client, backfill, tables_config,
+                                              f"{project_id}.{dataset_quality}.backfill_checkpoints", 'refresh_silver', ledger), 200
+        except Exception as e:
+            logger.error(f"❌ Backfill task failed: {str(e)}")
+            result, status = {'status': 'error', 'error': str(e)}, 500
+        save_job_stats(client, f"{project_id}.{dataset_quality}.pipeline_job_stats", ledger)
+        return result, status
+
+    for collection in changelog_collections:
+        try:
+            compact_changelog(client, project_id, dataset_bronze, collection, compaction_lookback_hours,
+                              changelog_retention_days, run_id, ledger)
+        except Exception as e:
+            # The silver tables below then read the previous compaction
+            logger.error(f"❌ Error compacting {collection}_raw_changelog: {str(e)}")
+            continue
+
     for table in tables_config:
         try:
             logger.info(f"Refreshing silver table: {table['name']}")
-            query_job = client.query(table['query'])
-            query_job.result()  
+            query = in_place_refresh(table['query'], table['key']) if 'key' in table else table['query']
+            run_step(client, query, 'refresh_silver', table['name'], run_id, ledger)
             logger.info(f"Successfully refreshed {table['name']}")
         except Exception as e:
             logger.error(f"Error refreshing {table['name']}: {str(e)}")
             continue
 
+    save_job_stats(client, f"{project_id}.{dataset_quality}.pipeline_job_stats", ledger)
     return ('Silver layer refresh complete', 200)
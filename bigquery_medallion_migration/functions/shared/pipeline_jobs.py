@@ -0,0 +1,304 @@
+"""
+Query job helpers shared by the refresh_silver and refresh_gold Cloud Functions:
+- run_step / job_stats / save_job_stats: labelled pipeline queries and their
+  quality.pipeline_job_stats rows
+- in_place_refresh: a table's query applied to the existing table without replacing it
+- process_backfill: the backfill worker for shards sent by functions/backfill
+
+deploy_functions.sh copies this module next to each function's main.py. For local
+runs, put functions/shared on PYTHONPATH.
+"""
+from google.cloud import bigquery
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import date, datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# partitions_total needs an INFORMATION_SCHEMA.PARTITIONS query (a billed job) per dataset;
+# it is run once per run and dataset, and only when enabled
+PARTITION_TOTALS = os.environ.get('JOB_PARTITION_TOTALS', 'off') == 'on'
+
+_session = None
+_partition_totals = {}  # (run_id, project, dataset) -> {table_name: partitions}
+
+
+def job_statistics(job):
+    """
+    statistics.query of a job from the BigQuery jobs.get REST resource. The client library's
+    QueryJob has no public property for some statistics (totalPartitionsProcessed).
+    """
+    global _session
+    if _session is None:
+        import google.auth
+        from google.auth.transport.requests import AuthorizedSession
+        credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/bigquery.readonly'])
+        _session = AuthorizedSession(credentials)
+    response = _session.get(
+        f"https://bigquery.googleapis.com/bigquery/v2/projects/{job.project}/jobs/{job.job_id}",
+        params={'location': job.location}, timeout=30)
+    response.raise_for_status()
+    return response.json().get('statistics', {}).get('query', {})
+
+
+def dataset_partition_totals(client, project, dataset, run_id):
+    """{table_name: partitions} of a dataset, queried once per run"""
+    key = (run_id, project, dataset)
+    if key not in _partition_totals:
+        if any(cached_run != run_id for cached_run, _, _ in _partition_totals):
+            _partition_totals.clear()  # a new run (warm function instance)
+        rows = client.query(f"""
+            SELECT table_name, COUNT(*) as partitions
+            FROM `{project}.{dataset}.INFORMATION_SCHEMA.PARTITIONS`
+            WHERE partition_id IS NOT NULL AND partition_id != '__UNPARTITIONED__'
+            GROUP BY table_name
+        """).result()
+        _partition_totals[key] = {row.table_name: row.partitions for row in rows}
+    return _partition_totals[key]
+
+
+def partition_counts(client, job, run_id):
+    """
+    (total, processed) partitions of the partitioned tables a query job read; None when unknown.
+    processed comes from the job statistics; total (JOB_PARTITION_TOTALS=on) counts the
+    referenced tables' partitions in INFORMATION_SCHEMA.PARTITIONS, so total - processed is
+    what partition pruning skipped.
+    """
+    tables = job.referenced_tables or []  # empty for scripts: their child jobs read the tables
+    if not tables:
+        return None, None
+    processed = job_statistics(job).get('totalPartitionsProcessed')
+    if processed is None:
+        return None, None
+    if not PARTITION_TOTALS:
+        return None, int(processed)
+    total = sum(dataset_partition_totals(client, table.project, table.dataset_id, run_id).get(table.table_id, 0)
+                for table in tables)
+    return total, int(processed)
+
+
+def _label(value):
+    """BigQuery label value: lowercase letters, digits, _ and -, at most 63 characters"""
+    value = re.sub(r'[^a-z0-9_-]', '_', str(value).lower())
+    if len(value) > 63:
+        value = f"{value[:54]}-{hashlib.sha1(value.encode()).hexdigest()[:8]}"
+    return value
+
+
+def job_stats(job, function_name, step, run_id, error=None, client=None):
+    """pipeline_job_stats row for a finished (or failed) query job"""
+    now = datetime.now(timezone.utc)
+    plan = (job.query_plan or []) if job else []
+    partitions_total, partitions_processed = None, None
+    if job and client and not error:
+        try:
+            partitions_total, partitions_processed = partition_counts(client, job, run_id)
+        except Exception as e:
+            logger.warning(f"⚠️  Could not count partitions of job {job.job_id}: {str(e)}")
+    stages = [{
+        'name': s.name,
+        'status': s.status,
+        'duration_ms': int((s.end - s.start).total_seconds() * 1000) if s.start and s.end else None,
+        'slot_ms': s.slot_ms,
+        'wait_ms_avg': s.wait_ms_avg,
+        'read_ms_avg': s.read_ms_avg,
+        'compute_ms_avg': s.compute_ms_avg,
+        'write_ms_avg': s.write_ms_avg,
+        'records_read': s.records_read,
+        'records_written': s.records_written,
+        'shuffle_output_bytes': s.shuffle_output_bytes,
+        'shuffle_output_bytes_spilled': s.shuffle_output_bytes_spilled,
+    } for s in plan]
+    started, ended = (job.started, job.ended) if job else (None, None)
+    return {
+        'run_id': run_id,
+        'function_name': function_name,
+        'step': step,
+        'job_id': job.job_id if job else None,
+        'status': 'error' if error else 'success',
+        'error': str(error)[:1000] if error else None,
+        'statement_type': job.statement_type if job else None,
+        'created_at': (job.created if job and job.created else now).isoformat(),
+        'started_at': started.isoformat() if started else None,
+        'ended_at': ended.isoformat() if ended else None,
+        'duration_ms': int((ended - started).total_seconds() * 1000) if started and ended else None,
+        'slot_ms': job.slot_millis if job else None,
+        'bytes_processed': job.total_bytes_processed if job else None,
+        'bytes_billed': job.total_bytes_billed if job else None,
+        'bytes_shuffled': sum(s.shuffle_output_bytes or 0 for s in plan),
+        'bytes_spilled': sum(s.shuffle_output_bytes_spilled or 0 for s in plan),
+        'cache_hit': bool(job.cache_hit) if job else None,
+        'partitions_total': partitions_total,
+        'partitions_processed': partitions_processed,
+        'partitions_pruned': max(partitions_total - partitions_processed, 0) if partitions_total is not None else None,
+        'stages': json.dumps(stages),
+        'recorded_at': now.isoformat(),
+    }
+
+
+def run_step(client, query, function_name, step, run_id, ledger):
+    """Run a pipeline query labelled with its function / step and append its stats to ledger"""
+    job_config = bigquery.QueryJobConfig(labels={
+        'pipeline_function': _label(function_name),
+        'pipeline_step': _label(step),
+        'pipeline_run': _label(run_id),
+    })
+    job = None
+    try:
+        job = client.query(query, job_config=job_config)
+        job.result()
+    except Exception as e:
+        ledger.append(job_stats(job, function_name, step, run_id, error=e))
+        raise
+    ledger.append(job_stats(job, function_name, step, run_id, client=client))
+    return job
+
+
+def save_job_stats(client, table_id, ledger):
+    """Stream the run's job statistics to quality.pipeline_job_stats (never fails the refresh)"""
+    if not ledger:
+        return
+    try:
+        errors = client.insert_rows_json(table_id, ledger)
+        if errors:
+            logger.warning(f"⚠️  Job stats insert errors: {errors[:3]}")
+        else:
+            logger.info(f"📊 Recorded stats for {len(ledger)} job(s) in {table_id}")
+    except Exception as e:
+        logger.warning(f"⚠️  Could not record job stats: {str(e)}")
+
+
+def split_query(query):
+    """(target table, PARTITION/CLUSTER options, SELECT body) of a CREATE OR REPLACE TABLE ... AS query"""
+    match = re.match(r'\s*CREATE OR REPLACE TABLE\s+`([^`]+)`(.*?)^\s*AS\s*$(.*)', query, re.S | re.M)
+    if not match:
+        raise ValueError("Query is not a CREATE OR REPLACE TABLE ... AS statement")
+    return match.group(1), match.group(2).strip(), match.group(3).strip().rstrip(';')
+
+
+def in_place_refresh(query, key):
+    """
+    Script applying a CREATE OR REPLACE TABLE ... AS query to the existing table in place:
+    rows whose values changed (every column but processed_at, which must be the query's
+    last column) or that are new are deleted and re-inserted, rows gone from the source
+    are deleted, and unchanged rows keep their processed_at. The table is never dropped,
+    so materialized views over it stay valid, and processed_at is the load time of each
+    row's current version. The first run creates the table. Schema changes need a
+    rebuild backfill (functions/backfill) or a manual CREATE OR REPLACE.
+    """
+    target, options, body = split_query(query)
+    return f"""
+        CREATE TABLE IF NOT EXISTS `{target}` {options} AS SELECT * FROM ({body}) WHERE FALSE;
+        CREATE TEMP TABLE incoming AS SELECT * EXCEPT(processed_at) FROM ({body});
+        CREATE TEMP TABLE changed AS
+          SELECT * FROM incoming
+          EXCEPT DISTINCT
+          SELECT * EXCEPT(processed_at) FROM `{target}`;
+        CREATE TEMP TABLE removed AS
+          SELECT {key} FROM `{target}`
+          EXCEPT DISTINCT
+          SELECT {key} FROM incoming;
+        BEGIN TRANSACTION;
+        DELETE FROM `{target}`
+        WHERE {key} IN (SELECT {key} FROM changed) OR {key} IN (SELECT {key} FROM removed);
+        INSERT INTO `{target}` SELECT *, CURRENT_TIMESTAMP() as processed_at FROM changed;
+        COMMIT TRANSACTION;
+    """
+
+
+def _shard_predicate(shard, columns):
+    """SQL filter selecting one shard's rows; values are parsed, never interpolated raw"""
+    if shard['kind'] == 'date' and 'date' in columns:
+        start, end = date.fromisoformat(shard['start']), date.fromisoformat(shard['end'])
+        return f"{columns['date']} >= DATE '{start}' AND {columns['date']} < DATE '{end}'"
+    if shard['kind'] == 'date_outside' and 'date' in columns:
+        # The rows no [start, end) date shard of a rebuild covers
+        start, end = date.fromisoformat(shard['start']), date.fromisoformat(shard['end'])
+        return (f"({columns['date']} IS NULL OR {columns['date']} < DATE '{start}' "
+                f"OR {columns['date']} >= DATE '{end}')")
+    if shard['kind'] == 'user' and 'user' in columns:
+        buckets, bucket = int(shard['buckets']), int(shard['bucket'])
+        return f"ABS(MOD(FARM_FINGERPRINT(IFNULL({columns['user']}, '')), {buckets})) = {bucket}"
+    raise ValueError(f"Shard kind '{shard['kind']}' is not supported for {shard['table']}")
+
+
+def _checked_id(value):
+    if not re.fullmatch(r'[A-Za-z0-9_-]{1,200}', str(value)):
+        raise ValueError(f"Invalid id: {value!r}")
+    return value
+
+
+def _staging_table(target, backfill_id):
+    return f"{target}__backfill_{backfill_id.replace('-', '_')}"
+
+
+def process_backfill(client, task, tables_config, checkpoint_table, function_name, ledger):
+    """
+    Backfill worker: 'prepare' creates the empty staging table of a rebuild,
+    'shard' replaces one shard's rows in the live (in_place) or staging (rebuild) table,
+    'verify' counts the rows of the table's query and of the target (before finalize).
+    Tables listed in the config's 'state_tables' (incremental state derived from the same
+    sources) are dropped after each shard, so scheduled runs cannot undo the backfill.
+    A shard's rows and its 'done' checkpoint commit in one transaction, so redelivered
+    tasks are skipped and a failed attempt leaves nothing behind.
+    """
+    configs = {t['name']: t for t in tables_config}
+    if task.get('table') not in configs:
+        raise ValueError(f"Unknown table: {task.get('table')}")
+    config = configs[task['table']]
+    backfill_id = _checked_id(task['backfill_id'])
+    target, options, body = split_query(config['query'])
+    if task.get('mode') == 'rebuild':
+        target = _staging_table(target, backfill_id)
+
+    if task['action'] == 'prepare':
+        client.query(f"CREATE TABLE IF NOT EXISTS `{target}` {options} AS SELECT * FROM ({body}) WHERE FALSE").result()
+        return {'status': 'prepared', 'table': task['table'], 'staging_table': target}
+
+    if task['action'] == 'verify':
+        counts = next(iter(client.query(f"""
+            SELECT
+              (SELECT COUNT(*) FROM ({body})) as source_rows,
+              (SELECT COUNT(*) FROM `{target}`) as staging_rows
+        """).result()))
+        return {'table': task['table'], 'staging_table': target,
+                'source_rows': counts.source_rows, 'staging_rows': counts.staging_rows}
+
+    shard_id = _checked_id(task['shard_id'])
+    done_query = f"""
+        SELECT COUNT(*) as done FROM `{checkpoint_table}`
+        WHERE backfill_id = '{backfill_id}' AND shard_id = '{shard_id}' AND status = 'done'
+    """
+    if next(iter(client.query(done_query).result())).done:
+        logger.info(f"⏭️  Shard {shard_id} already done")
+        return {'status': 'skipped', 'shard_id': shard_id}
+
+    predicate = _shard_predicate(task, config.get('shard_columns', {}))
+    script = f"""
+        BEGIN TRANSACTION;
+        DELETE FROM `{target}` WHERE {predicate};
+        INSERT INTO `{target}` SELECT * FROM ({body}) WHERE {predicate};
+        INSERT INTO `{checkpoint_table}` (backfill_id, shard_id, table_name, status, recorded_at)
+        VALUES ('{backfill_id}', '{shard_id}', '{task['table']}', 'done', CURRENT_TIMESTAMP());
+        COMMIT TRANSACTION;
+    """
+    try:
+        run_step(client, script, function_name, f"backfill_{task['table']}", backfill_id, ledger)
+    except Exception as e:
+        failed = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter('error', 'STRING', str(e)[:1000])])
+        try:
+            client.query(f"""
+                INSERT INTO `{checkpoint_table}` (backfill_id, shard_id, table_name, status, error, recorded_at)
+                VALUES ('{backfill_id}', '{shard_id}', '{task['table']}', 'failed', @error, CURRENT_TIMESTAMP())
+            """, job_config=failed).result()
+        except Exception as checkpoint_error:
+            logger.warning(f"⚠️  Could not record failed shard {shard_id}: {str(checkpoint_error)}")
+        raise
+    for state_table in config.get('state_tables', []):
+        client.delete_table(state_table, not_found_ok=True)
+        logger.info(f"🗑️  Dropped {state_table}; the next scheduled run rebuilds it")
+    logger.info(f"✅ Shard {shard_id} done ({task['table']}: {predicate})")
+    return {'status': 'done', 'shard_id': shard_id}
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Dashboard Query Benchmark
+Runs the queries a Looker Studio dashboard issues against daily_metrics_v1 and
+semantic.user_health_dashboard_v1 and records latency, bytes processed/billed
+and slot time (query cache disabled, median of --runs).
+
+Run once against the weekly tables, apply sql/gold_materialized_views.sql, run
+again, then compare:
+
+Usage:
+    python scripts/benchmark_dashboard.py --label before
+    python scripts/benchmark_dashboard.py --label after
+    python scripts/benchmark_dashboard.py --compare
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+from datetime import datetime
+
+PROJECT = "junoplus-dev"
+GOLD = f"{PROJECT}.junoplus_analytics_gold"
+SEMANTIC = f"{PROJECT}.junoplus_analytics_semantic"
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_dashboard.json")
+
+DASHBOARD_QUERIES = {
+    'daily_trend_90d': f"""
+        SELECT session_date, session_count, active_users, avg_effectiveness
+        FROM `{GOLD}.daily_metrics_v1`
+        WHERE session_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 90 DAY)
+        ORDER BY session_date
+    """,
+    'active_users_28d': f"""
+        SELECT HLL_COUNT.MERGE(users_sketch) as active_users
+        FROM `{GOLD}.daily_metrics_v1`
+        WHERE session_date > DATE_SUB(CURRENT_DATE(), INTERVAL 28 DAY)
+    """,
+    'kpi_totals': f"""
+        SELECT SUM(session_count) as sessions, AVG(avg_effectiveness) as effectiveness,
+               AVG(avg_heat) as heat, AVG(avg_tens) as tens
+        FROM `{GOLD}.daily_metrics_v1`
+    """,
+    'segment_breakdown': f"""
+        SELECT user_segment, effectiveness_level, COUNT(*) as users,
+               AVG(avg_effectiveness) as effectiveness
+        FROM `{SEMANTIC}.user_health_dashboard_v1`
+        GROUP BY user_segment, effectiveness_level
+    """,
+    'age_groups': f"""
+        SELECT age_group, COUNT(*) as users, AVG(total_sessions) as sessions,
+               MAX(refreshed_at) as refreshed_at
+        FROM `{SEMANTIC}.user_health_dashboard_v1`
+        GROUP BY age_group
+    """,
+}
+
+
+def run_query(client, sql):
+    """Execute sql uncached; returns latency and cost stats of the job"""
+    from google.cloud import bigquery
+
+    config = bigquery.QueryJobConfig(use_query_cache=False)
+    started = time.perf_counter()
+    job = client.query(sql, job_config=config)
+    job.result()
+    wall_ms = (time.perf_counter() - started) * 1000
+    return {
+        'wall_ms': wall_ms,
+        'job_ms': (job.ended - job.started).total_seconds() * 1000 if job.ended and job.started else None,
+        'bytes_processed': job.total_bytes_processed or 0,
+        'bytes_billed': job.total_bytes_billed or 0,
+        'slot_ms': job.slot_millis or 0,
+    }
+
+
+def benchmark(runs=5):
+    """Median stats per dashboard query over `runs` executions"""
+    from google.cloud import bigquery
+
+    client = bigquery.Client(project=PROJECT)
+    results = {}
+    for name, sql in DASHBOARD_QUERIES.items():
+        samples = [run_query(client, sql) for _ in range(runs)]
+        results[name] = {
+            key: statistics.median(s[key] for s in samples if s[key] is not None)
+            for key in samples[0]
+        }
+        print(f"   {name:<20} {results[name]['wall_ms']:8.0f} ms  "
+              f"{results[name]['bytes_processed'] / 1e6:10.2f} MB processed")
+    return results
+
+
+def compare(report, before='before', after='after'):
+    if before not in report or after not in report:
+        raise SystemExit(f"❌ Need both '{before}' and '{after}' runs in the report")
+    print(f"{'query':<20} {'metric':<16} {before:>12} {after:>12} {'change':>8}")
+    for name in DASHBOARD_QUERIES:
+        for metric in ('wall_ms', 'job_ms', 'bytes_processed', 'bytes_billed', 'slot_ms'):
+            old = report[before]['queries'][name][metric]
+            new = report[after]['queries'][name][metric]
+            change = f"{(new - old) / old * 100:+.0f}%" if old else 'n/a'
+            print(f"{name:<20} {metric:<16} {old:>12.0f} {new:>12.0f} {change:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark dashboard queries')
+    parser.add_argument('--label', help='Name of this run (e.g. before / after)')
+    parser.add_argument('--runs', type=int, default=5, help='Executions per query (median is kept)')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='JSON report (runs are merged by label)')
+    parser.add_argument('--compare', action='store_true', help='Print before / after from the report')
+    args = parser.parse_args()
+
+    report = {}
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            report = json.load(f)
+
+    if args.compare:
+        compare(report)
+    elif args.label:
+        print(f"⏱️  Benchmarking dashboard queries ({args.label}, {args.runs} runs each)")
+        report[args.label] = {
+            'run_at': datetime.now().isoformat(),
+            'queries': benchmark(args.runs),
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Saved to {args.output}")
+    else:
+        parser.error('--label or --compare is required')
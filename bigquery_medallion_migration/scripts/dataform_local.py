@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Local runner for the incremental Dataform models
+
+Compiles dataform/definitions/*.sqlx with the subset of Dataform used there
+(config, pre_operations DECLAREs, ${ref()}, ${self()}, ${when(incremental(), ...)})
+and runs them in DuckDB against CSV fixtures (one table per file in
+dataform/fixtures). Incremental runs apply Dataform's MERGE semantics: rows whose
+uniqueKey matches a target row inside updatePartitionFilter are replaced, the
+rest are inserted. HLL_COUNT sketches are emulated as sorted lists of distinct
+values, so merged counts are exact.
+
+Models are built after the models they ${ref()}. --diff builds each model twice
+and compares the outputs (ignoring last_updated):
+    incremental  full run on fixture rows before --cutoff, then an incremental
+                 run on all fixture rows
+    full         one full run on all fixture rows
+
+Usage:
+    pip install duckdb
+    python scripts/dataform_local.py --diff
+    python scripts/dataform_local.py --model user_cohorts_v1 --database /tmp/dataform.duckdb
+"""
+import argparse
+import datetime
+import glob
+import os
+import re
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFINITIONS_DIR = os.path.join(BASE_DIR, 'dataform', 'definitions')
+FIXTURES_DIR = os.path.join(BASE_DIR, 'dataform', 'fixtures')
+DEFAULT_CUTOFF = '2026-02-20'
+
+# BigQuery -> DuckDB spellings used by the models
+DIALECT_REWRITES = [
+    (re.compile(r'\bSAFE_CAST\('), 'TRY_CAST('),
+    (re.compile(r'\bFLOAT64\b'), 'DOUBLE'),
+    (re.compile(r'\bINT64\b'), 'BIGINT'),
+    (re.compile(r'\bDATE_SUB\((.+?),\s*INTERVAL (\d+) (DAY|MONTH|YEAR)\)'), r'CAST(\1 - INTERVAL \2 \3 AS DATE)'),
+    (re.compile(r'\bCURRENT_DATE\(\)'), 'CURRENT_DATE'),
+    (re.compile(r'\bCURRENT_TIMESTAMP\(\)'), 'CURRENT_TIMESTAMP'),
+    (re.compile(r'\bUNION DISTINCT\b'), 'UNION'),
+    # BigQuery DAYOFWEEK is 1 = Sunday, DuckDB DOW is 0 = Sunday
+    (re.compile(r'\bEXTRACT\(DAYOFWEEK FROM (\w+)\)'), r'(EXTRACT(DOW FROM \1) + 1)'),
+    # Different hash values, but stable between the incremental and full builds
+    (re.compile(r'\bFARM_FINGERPRINT\('), 'hash('),
+    (re.compile(r'\bDATE_TRUNC\((\w+),\s*WEEK\(MONDAY\)\)'), r"CAST(date_trunc('week', \1) AS DATE)"),
+    (re.compile(r'\bDATE_TRUNC\((\w+),\s*(MONTH|YEAR)\)'), r"CAST(date_trunc('\2', \1) AS DATE)"),
+    # HLL_COUNT sketches as sorted lists of distinct values: mergeable like the real
+    # sketches, and exact (BigQuery's HLL++ is exact for small counts too)
+    (re.compile(r'\bHLL_COUNT\.INIT\(([^()]*)\)'), r'list_sort(list_distinct(list(\1)))'),
+    (re.compile(r'\bHLL_COUNT\.MERGE_PARTIAL\(([^()]*)\)'), r'list_sort(list_distinct(flatten(list(\1))))'),
+    (re.compile(r'\bHLL_COUNT\.MERGE\(([^()]*)\)'), r'len(list_distinct(flatten(list(\1))))'),
+    (re.compile(r'\bHLL_COUNT\.EXTRACT\(([^()]*)\)'), r'len(\1)'),
+]
+
+
+def _block(text, keyword):
+    """(body, start, end) of a top-level `keyword { ... }` block, or (None, -1, -1)"""
+    match = re.search(rf'^{keyword}\s*\{{', text, re.MULTILINE)
+    if not match:
+        return None, -1, -1
+    depth, i = 1, match.end()
+    while depth:
+        depth += {'{': 1, '}': -1}.get(text[i], 0)
+        i += 1
+    return text[match.end():i - 1], match.start(), i
+
+
+def _expression_end(text, start):
+    """Index just past the `}` closing the ${ at start (the models' SQL has no other braces)"""
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] == '{':
+            depth += 1
+        elif text[i] == '}':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    raise ValueError(f"Unclosed ${{ at offset {start}")
+
+
+def render(text, incremental, target):
+    """Expand the Dataform template expressions in text"""
+    out, i = [], 0
+    while True:
+        start = text.find('${', i)
+        if start < 0:
+            out.append(text[i:])
+            return ''.join(out)
+        end = _expression_end(text, start)
+        out.append(text[i:start])
+        out.append(_evaluate(text[start + 2:end - 1].strip(), incremental, target))
+        i = end
+
+
+def _evaluate(expression, incremental, target):
+    if expression == 'self()':
+        return target
+    if expression == 'incremental()':
+        return 'true' if incremental else 'false'
+    ref = re.fullmatch(r'ref\(["\'](\w+)["\']\)', expression)
+    if ref:
+        return ref.group(1)
+    when = re.fullmatch(r'when\(\s*incremental\(\)\s*,(.*)\)', expression, re.DOTALL)
+    if when:
+        branches = _backtick_strings(when.group(1))
+        chosen = branches[0] if incremental else (branches[1] if len(branches) > 1 else '')
+        return render(chosen, incremental, target)
+    raise ValueError(f"Unsupported Dataform expression: ${{{expression}}}")
+
+
+def _backtick_strings(text):
+    return re.findall(r'`([^`]*)`', text)
+
+
+def to_duckdb(sql):
+    for pattern, replacement in DIALECT_REWRITES:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+def load_model(name):
+    with open(os.path.join(DEFINITIONS_DIR, f'{name}.sqlx')) as f:
+        text = f.read()
+    config, start, end = _block(text, 'config')
+    text = text[:start] + text[end:]
+    pre_operations, start, end = _block(text, 'pre_operations')
+    if pre_operations is not None:
+        text = text[:start] + text[end:]
+
+    unique_key = re.search(r'uniqueKey:\s*\[([^\]]*)\]', config)
+    partition_filter = re.search(r'updatePartitionFilter:\s*"([^"]*)"', config)
+    return {
+        'name': name,
+        'type': re.search(r'type:\s*"(\w+)"', config).group(1),
+        'unique_key': re.findall(r'"(\w+)"', unique_key.group(1)) if unique_key else [],
+        'partition_filter': partition_filter.group(1) if partition_filter else None,
+        'pre_operations': pre_operations or '',
+        'query': text,
+        # Refs to other models (not declarations), built first by build()
+        'upstream': [ref for ref in re.findall(r'\$\{ref\(["\'](\w+)["\']\)\}', text)
+                     if os.path.exists(os.path.join(DEFINITIONS_DIR, f'{ref}.sqlx'))],
+    }
+
+
+def _declare(con, pre_operations, variables):
+    """Evaluate `DECLARE name TYPE DEFAULT (expr);` statements into SQL literals"""
+    for statement in pre_operations.split(';'):
+        match = re.search(r'DECLARE\s+(\w+)\s+\w+\s+DEFAULT\s*\((.*)\)\s*$', statement, re.DOTALL)
+        if not match:
+            continue
+        value = con.execute(f"SELECT ({_substitute(match.group(2), variables)})").fetchone()[0]
+        if value is None:
+            variables[match.group(1)] = 'NULL'
+        elif isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+            variables[match.group(1)] = f"DATE '{value.isoformat()}'"
+        else:
+            variables[match.group(1)] = repr(value)
+    return variables
+
+
+def _substitute(sql, variables):
+    for name, literal in variables.items():
+        sql = re.sub(rf'\b{name}\b', literal, sql)
+    return to_duckdb(sql)
+
+
+def run_model(con, model, full_refresh=False):
+    """Build or incrementally update one model's table in DuckDB; returns 'full' or 'incremental'"""
+    target = model['name']
+    exists = con.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ?",
+                         [target]).fetchone()[0] > 0
+    incremental = model['type'] == 'incremental' and exists and not full_refresh
+
+    variables = _declare(con, render(model['pre_operations'], incremental, target), {})
+    query = _substitute(render(model['query'], incremental, target), variables)
+
+    if not incremental:
+        con.execute(f"CREATE OR REPLACE TABLE {target} AS {query}")
+        return 'full'
+
+    con.execute(f"CREATE OR REPLACE TEMP TABLE {target}__increment AS {query}")
+    keys = ', '.join(model['unique_key'])
+    condition = f"({keys}) IN (SELECT ({keys}) FROM {target}__increment)" if len(model['unique_key']) > 1 \
+        else f"{keys} IN (SELECT {keys} FROM {target}__increment)"
+    if model['partition_filter']:
+        condition += f" AND {_substitute(model['partition_filter'], variables)}"
+    con.execute(f"DELETE FROM {target} WHERE {condition}")
+    con.execute(f"INSERT INTO {target} BY NAME SELECT * FROM {target}__increment")
+    con.execute(f"DROP TABLE {target}__increment")
+    return 'incremental'
+
+
+def build(con, name, full_refresh=False):
+    """Run a model after the models it refs; returns the model's run mode"""
+    model = load_model(name)
+    for upstream in dict.fromkeys(model['upstream']):
+        build(con, upstream, full_refresh)
+    return run_model(con, model, full_refresh)
+
+
+def load_fixtures(con, fixtures_dir=FIXTURES_DIR, before=None):
+    """One table per CSV; with `before`, only rows with session_date < before"""
+    for path in sorted(glob.glob(os.path.join(fixtures_dir, '*.csv'))):
+        table = os.path.splitext(os.path.basename(path))[0]
+        where = f"WHERE session_date < DATE '{before}'" if before else ''
+        con.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM read_csv_auto('{path}') {where}")
+
+
+def _hashable(row):
+    """Row with list values (local HLL sketches) as tuples, so rows can be compared as sets"""
+    return tuple(tuple(v) if isinstance(v, list) else v for v in row)
+
+
+def diff_model(name, cutoff=DEFAULT_CUTOFF, fixtures_dir=FIXTURES_DIR):
+    """Rows that differ between the incremental and the full build of a model"""
+    import duckdb
+
+    incremental_db = duckdb.connect()
+    load_fixtures(incremental_db, fixtures_dir, before=cutoff)
+    build(incremental_db, name)
+    load_fixtures(incremental_db, fixtures_dir)
+    mode = build(incremental_db, name)
+
+    full_db = duckdb.connect()
+    load_fixtures(full_db, fixtures_dir)
+    build(full_db, name, full_refresh=True)
+
+    incremental = set(map(_hashable, incremental_db.execute(f"SELECT * EXCLUDE (last_updated) FROM {name}").fetchall()))
+    full = set(map(_hashable, full_db.execute(f"SELECT * EXCLUDE (last_updated) FROM {name}").fetchall()))
+    return mode, len(full), incremental - full, full - incremental
+
+
+if __name__ == "__main__":
+    models = sorted(os.path.splitext(os.path.basename(p))[0] for p in glob.glob(os.path.join(DEFINITIONS_DIR, '*.sqlx')))
+    parser = argparse.ArgumentParser(description='Run the Dataform models locally in DuckDB')
+    parser.add_argument('--model', action='append', choices=models, help='Model(s) to run (default: all)')
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--database', default=':memory:', help='DuckDB file (keeps tables between runs)')
+    parser.add_argument('--full-refresh', action='store_true')
+    parser.add_argument('--diff', action='store_true', help='Compare incremental and full builds')
+    parser.add_argument('--cutoff', default=DEFAULT_CUTOFF, help='First session_date of the incremental run (--diff)')
+    args = parser.parse_args()
+
+    import duckdb
+
+    failed = False
+    for name in args.model or models:
+        if args.diff:
+            mode, rows, extra, missing = diff_model(name, args.cutoff, args.fixtures)
+            if mode != 'incremental' and load_model(name)['type'] == 'incremental':
+                print(f"⚠️  {name}: second run was not incremental")
+            if extra or missing:
+                failed = True
+                print(f"❌ {name}: {len(extra)} row(s) only in incremental, {len(missing)} only in full")
+                for row in sorted(extra, key=str)[:5]:
+                    print(f"   + {row}")
+                for row in sorted(missing, key=str)[:5]:
+                    print(f"   - {row}")
+            else:
+                print(f"✅ {name}: incremental build matches full build ({rows} rows)")
+        else:
+            con = duckdb.connect(args.database)
+            load_fixtures(con, args.fixtures)
+            mode = build(con, name, full_refresh=args.full_refresh)
+            count = con.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+            print(f"✅ {name}: {mode} run, {count} rows")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,69 @@
+-- Bronze Layer: compacted latest-state tables and changelog retention
+-- Purpose: One row per Firestore document (its newest CREATE/UPDATE) so silver
+--          no longer deduplicates the full change history on every refresh,
+--          and bounded storage for the append-only *_raw_changelog tables
+-- Created: 2026-10-19
+--
+-- refresh_silver keeps the *_raw_latest tables current: each run folds in the
+-- changelog rows from COMPACTION_LOOKBACK_HOURS (default 24) before the newest
+-- compacted timestamp, then sets partition_expiration_days to
+-- CHANGELOG_RETENTION_DAYS (default 90) on the changelog. It also creates a
+-- missing *_raw_latest table from the full changelog, so this script is only
+-- needed to bootstrap by hand. Run it before the expiration below takes effect.
+--
+-- History-based tables in silver_enhanced_tables.sql (per-day snapshots) only
+-- see changelog rows inside the retention window.
+-- period_tracking_data_raw_latest is maintained by the Firebase extension.
+
+-- ============================================================================
+-- STEP 1: Initial compaction (one row per document_id)
+-- ============================================================================
+
+CREATE TABLE IF NOT EXISTS `junoplus-dev.junoplus_analytics.therapy_sessions_data_raw_latest`
+CLUSTER BY document_id
+AS
+SELECT * EXCEPT(rn)
+FROM (
+  SELECT *, ROW_NUMBER() OVER (PARTITION BY document_id ORDER BY timestamp DESC) as rn
+  FROM `junoplus-dev.junoplus_analytics.therapy_sessions_data_raw_changelog`
+  WHERE operation IN ('CREATE', 'UPDATE')
+    AND data IS NOT NULL
+)
+WHERE rn = 1;
+
+CREATE TABLE IF NOT EXISTS `junoplus-dev.junoplus_analytics.user_health_data_raw_latest`
+CLUSTER BY document_id
+AS
+SELECT * EXCEPT(rn)
+FROM (
+  SELECT *, ROW_NUMBER() OVER (PARTITION BY document_id ORDER BY timestamp DESC) as rn
+  FROM `junoplus-dev.junoplus_analytics.user_health_data_raw_changelog`
+  WHERE operation IN ('CREATE', 'UPDATE')
+    AND data IS NOT NULL
+)
+WHERE rn = 1;
+
+CREATE TABLE IF NOT EXISTS `junoplus-dev.junoplus_analytics.medications_data_raw_latest`
+CLUSTER BY document_id
+AS
+SELECT * EXCEPT(rn)
+FROM (
+  SELECT *, ROW_NUMBER() OVER (PARTITION BY document_id ORDER BY timestamp DESC) as rn
+  FROM `junoplus-dev.junoplus_analytics.medications_data_raw_changelog`
+  WHERE operation IN ('CREATE', 'UPDATE')
+    AND data IS NOT NULL
+)
+WHERE rn = 1;
+
+-- ============================================================================
+-- STEP 2: Changelog retention (requires the changelogs to be partitioned)
+-- ============================================================================
+
+ALTER TABLE `junoplus-dev.junoplus_analytics.therapy_sessions_data_raw_changelog`
+SET OPTIONS (partition_expiration_days = 90);
+
+ALTER TABLE `junoplus-dev.junoplus_analytics.user_health_data_raw_changelog`
+SET OPTIONS (partition_expiration_days = 90);
+
+ALTER TABLE `junoplus-dev.junoplus_analytics.medications_data_raw_changelog`
+SET OPTIONS (partition_expiration_days = 90);
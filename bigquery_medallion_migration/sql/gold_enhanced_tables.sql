@@ -112,9 +112,8 @@ WITH user_profile AS (
     JSON_VALUE(data, '$.subscription_tier') as subscription_tier,
     DATE(TIMESTAMP(JSON_VALUE(data, '$.created_at'))) as account_created_date,
     ROW_NUMBER() OVER (PARTITION BY JSON_VALUE(data, '$.userId') ORDER BY timestamp DESC) as rn
-  FROM `junoplus-dev.junoplus_analytics.user_health_data_raw_changelog`
-  WHERE operation IN ('CREATE', 'UPDATE')
-    AND data IS NOT NULL
+  FROM `junoplus-dev.junoplus_analytics.user_health_data_raw_latest`
+  WHERE data IS NOT NULL
 )
 SELECT
   user_id,
@@ -165,9 +164,8 @@ WITH therapist_data AS (
     CAST(JSON_VALUE(data, '$.years_experience') AS INT64) as years_experience,
     JSON_VALUE(data, '$.certification') as certification,
     ROW_NUMBER() OVER (PARTITION BY JSON_VALUE(data, '$.therapistId') ORDER BY timestamp DESC) as rn
-  FROM `junoplus-dev.junoplus_analytics.user_health_data_raw_changelog`
-  WHERE operation IN ('CREATE', 'UPDATE')
-    AND data IS NOT NULL
+  FROM `junoplus-dev.junoplus_analytics.user_health_data_raw_latest`
+  WHERE data IS NOT NULL
     AND JSON_VALUE(data, '$.therapistId') IS NOT NULL
 )
 SELECT
@@ -313,7 +311,14 @@ SELECT
   END as time_of_day,
   CURRENT_TIMESTAMP() as processed_at
 FROM `junoplus-dev.junoplus_analytics_silver.silver_therapy_sessions` s
-LEFT JOIN `junoplus-dev.junoplus_analytics_silver.silver_period_tracking` p
+-- silver_period_tracking carries the logged date and cycle_day, so sessions on logged days
+-- match here; the newest entry per user and day keeps the join from duplicating sessions
+LEFT JOIN (
+  SELECT *
+  FROM `junoplus-dev.junoplus_analytics_silver.silver_period_tracking`
+  WHERE date IS NOT NULL
+  QUALIFY ROW_NUMBER() OVER (PARTITION BY user_id, date ORDER BY last_update DESC) = 1
+) p
   ON s.user_id = p.user_id AND s.session_date = p.date
 LEFT JOIN `junoplus-dev.junoplus_analytics_silver.silver_user_health_data` h
   ON s.user_id = h.user_id AND s.session_date = h.date
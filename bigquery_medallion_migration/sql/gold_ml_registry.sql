@@ -80,3 +80,22 @@ SELECT
     'balanced' as data_split_strategy
   ) as experiment_metadata,
   CURRENT_TIMESTAMP() as created_at;
+
+-- Per-trial results written by ml_training/hparam_search.py
+ALTER TABLE `junoplus-dev.junoplus_analytics_gold.experiment_registry`
+ADD COLUMN IF NOT EXISTS search_results JSON;
+
+-- Serving metadata read by the prediction API's model manager (tens_prediction_api/model_manager.py):
+-- the newest row with deployment_status = 'active' for the API's backend is hot-loaded
+ALTER TABLE `junoplus-dev.junoplus_analytics_gold.model_registry`
+ADD COLUMN IF NOT EXISTS serving_backend STRING,   -- bigquery | lightgbm | onnx
+ADD COLUMN IF NOT EXISTS serving_config JSON;      -- backend options, e.g. BigQuery ML model ids
+
+-- Example rollout (previous active row for the backend should be set to 'retired'):
+-- INSERT INTO `junoplus-dev.junoplus_analytics_gold.model_registry`
+--   (model_id, model_name, model_type, description, model_uri, deployment_status,
+--    serving_backend, serving_config, created_at, last_updated)
+-- VALUES
+--   ('tens_lgbm_20261019', 'TENS Hierarchical LightGBM', 'LightGBM', 'Heat / mode / level classifiers',
+--    'gs://junoplus-models/tens/lgbm_20261019/', 'active', 'lightgbm', JSON '{}',
+--    CURRENT_TIMESTAMP(), CURRENT_TIMESTAMP());
@@ -66,7 +66,14 @@ SELECT
   END as is_during_ovulation,
   CURRENT_TIMESTAMP() as processed_at
 FROM `junoplus-dev.junoplus_analytics_silver.silver_therapy_sessions` s
-LEFT JOIN `junoplus-dev.junoplus_analytics_silver.silver_period_tracking` p
+-- silver_period_tracking carries the logged date and cycle_day, so sessions on logged days
+-- match here; the newest entry per user and day keeps the join from duplicating sessions
+LEFT JOIN (
+  SELECT *
+  FROM `junoplus-dev.junoplus_analytics_silver.silver_period_tracking`
+  WHERE date IS NOT NULL
+  QUALIFY ROW_NUMBER() OVER (PARTITION BY user_id, date ORDER BY last_update DESC) = 1
+) p
   ON s.user_id = p.user_id AND s.session_date = p.date
 LEFT JOIN `junoplus-dev.junoplus_analytics_silver.silver_user_profiles` u
   ON s.user_id = u.user_id
@@ -1,5 +1,6 @@
 -- Gold Layer: Period Cycle Analytics
 -- Analyze period patterns, regularity, and predictions
+-- One row per user and logged month; entries without a date fall into a NULL month
 
 CREATE OR REPLACE TABLE `junoplus-dev.junoplus_analytics_gold.gold_period_cycle_analytics`
 PARTITION BY month
@@ -0,0 +1,103 @@
+-- Prediction API Log
+-- Purpose: One row per predict-tens-level response (written by
+--          tens_prediction_api/prediction_log.py through the Storage Write API)
+-- Created: 2026-10-19
+
+CREATE TABLE IF NOT EXISTS `junoplus-dev.junoplus_analytics.predictions_log` (
+  request_id STRING NOT NULL,
+  logged_at TIMESTAMP NOT NULL,
+  user_id STRING,
+  backend STRING,
+  role STRING,
+  model_version STRING,
+  latency_ms FLOAT64,
+  status_code INT64,
+  inputs JSON,
+  outputs JSON
+)
+PARTITION BY DATE(logged_at)
+CLUSTER BY user_id, model_version
+OPTIONS(
+  partition_expiration_days=400,
+  description="Prediction API requests and responses"
+);
+
+-- Shadow scoring rows (role = 'shadow') share the primary's request_id
+ALTER TABLE `junoplus-dev.junoplus_analytics.predictions_log`
+ADD COLUMN IF NOT EXISTS role STRING;
+
+-- Recommendations joined to the first session the user started within 2 hours
+CREATE OR REPLACE VIEW `junoplus-dev.junoplus_analytics_gold.prediction_outcomes_v1` AS
+WITH predictions AS (
+  SELECT
+    request_id,
+    logged_at,
+    user_id,
+    backend,
+    model_version,
+    latency_ms,
+    CAST(JSON_VALUE(outputs, '$.recommended_heat_level') AS INT64) as recommended_heat,
+    CAST(JSON_VALUE(outputs, '$.recommended_tens_mode') AS INT64) as recommended_mode,
+    CAST(JSON_VALUE(outputs, '$.recommended_tens_level') AS INT64) as recommended_tens
+  FROM `junoplus-dev.junoplus_analytics.predictions_log`
+  WHERE status_code = 200
+    AND COALESCE(role, 'primary') = 'primary'
+    AND user_id IS NOT NULL
+)
+SELECT
+  p.*,
+  s.session_id,
+  s.start_time as session_start_time,
+  s.initial_heat,
+  s.initial_mode,
+  s.initial_tens,
+  s.final_heat,
+  s.final_mode,
+  s.final_tens,
+  s.pain_reduction,
+  s.was_effective,
+  s.initial_heat = p.recommended_heat
+    AND s.initial_mode = p.recommended_mode
+    AND s.initial_tens = p.recommended_tens as recommendation_followed
+FROM predictions p
+JOIN `junoplus-dev.junoplus_analytics_silver.silver_therapy_sessions` s
+  ON s.user_id = p.user_id
+  AND s.start_time BETWEEN p.logged_at AND TIMESTAMP_ADD(p.logged_at, INTERVAL 2 HOUR)
+QUALIFY ROW_NUMBER() OVER (PARTITION BY p.request_id ORDER BY s.start_time) = 1;
+
+-- Daily agreement and latency of shadow backends against the serving (primary) backend
+CREATE OR REPLACE VIEW `junoplus-dev.junoplus_analytics_gold.shadow_agreement_v1` AS
+WITH settings AS (
+  SELECT
+    request_id,
+    DATE(logged_at) as prediction_date,
+    backend,
+    COALESCE(role, 'primary') as role,
+    model_version,
+    latency_ms,
+    CAST(JSON_VALUE(outputs, '$.recommended_heat_level') AS INT64) as heat,
+    CAST(JSON_VALUE(outputs, '$.recommended_tens_mode') AS INT64) as mode,
+    CAST(JSON_VALUE(outputs, '$.recommended_tens_level') AS INT64) as tens
+  FROM `junoplus-dev.junoplus_analytics.predictions_log`
+  WHERE status_code = 200
+)
+SELECT
+  s.prediction_date,
+  p.backend as primary_backend,
+  s.backend as shadow_backend,
+  s.model_version as shadow_model_version,
+  COUNT(*) as compared,
+  AVG(IF(s.heat = p.heat, 1, 0)) as heat_agreement,
+  AVG(IF(s.mode = p.mode, 1, 0)) as mode_agreement,
+  AVG(IF(s.tens = p.tens, 1, 0)) as tens_agreement,
+  AVG(IF(s.heat = p.heat AND s.mode = p.mode AND s.tens = p.tens, 1, 0)) as full_agreement,
+  APPROX_QUANTILES(p.latency_ms, 100)[OFFSET(50)] as primary_request_p50_ms,
+  APPROX_QUANTILES(s.latency_ms, 100)[OFFSET(50)] as shadow_p50_ms,
+  APPROX_QUANTILES(s.latency_ms, 100)[OFFSET(95)] as shadow_p95_ms,
+  APPROX_QUANTILES(s.latency_ms, 100)[OFFSET(99)] as shadow_p99_ms
+FROM settings s
+JOIN settings p
+  ON p.request_id = s.request_id
+  AND p.role = 'primary'
+WHERE s.role = 'shadow'
+GROUP BY prediction_date, primary_backend, shadow_backend, shadow_model_version;
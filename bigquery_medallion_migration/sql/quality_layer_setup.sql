@@ -340,6 +340,205 @@ SELECT
 FROM `junoplus-dev.junoplus_analytics_quality.row_count_tracking`
 WHERE DATE(checked_at) = CURRENT_DATE();
 
+-- ============================================================================
+-- STEP 6: Prediction API Drift Sketches
+-- ============================================================================
+
+-- Written by the prediction API drift monitor (tens_prediction_api/drift.py):
+-- one row per instance per flush window with mergeable histogram state and
+-- the PSI / KS alerts raised for that window
+CREATE TABLE IF NOT EXISTS `junoplus-dev.junoplus_analytics_quality.prediction_drift` (
+  flushed_at TIMESTAMP NOT NULL,
+  window_start TIMESTAMP,
+  instance_id STRING,
+  model_version STRING,
+  reference_source STRING,
+  request_count INT64,
+  dropped_count INT64,
+  sketch JSON,
+  alerts JSON
+)
+PARTITION BY DATE(flushed_at)
+CLUSTER BY model_version
+OPTIONS(
+  partition_expiration_days=90,
+  description="Prediction API feature/prediction drift sketches and alerts"
+);
+
+-- ============================================================================
+-- STEP 7: Pipeline Job Statistics & Regressions
+-- ============================================================================
+
+-- Written by refresh_silver / refresh_gold: one row per pipeline query job
+-- (stages: per-stage timings, slot-ms, records and shuffle bytes from the query plan)
+CREATE TABLE IF NOT EXISTS `junoplus-dev.junoplus_analytics_quality.pipeline_job_stats` (
+  run_id STRING NOT NULL,
+  function_name STRING NOT NULL,
+  step STRING NOT NULL,
+  job_id STRING,
+  status STRING,
+  error STRING,
+  statement_type STRING,
+  created_at TIMESTAMP NOT NULL,
+  started_at TIMESTAMP,
+  ended_at TIMESTAMP,
+  duration_ms INT64,
+  slot_ms INT64,
+  bytes_processed INT64,
+  bytes_billed INT64,
+  bytes_shuffled INT64,
+  bytes_spilled INT64,
+  cache_hit BOOL,
+  partitions_total INT64,
+  partitions_processed INT64,
+  partitions_pruned INT64,
+  stages JSON,
+  recorded_at TIMESTAMP
+)
+PARTITION BY DATE(created_at)
+CLUSTER BY function_name, step
+OPTIONS(
+  partition_expiration_days=400,
+  description="BigQuery job statistics of every pipeline query, keyed by function, step and run"
+);
+
+-- Partition pruning columns (tables created before they were added)
+ALTER TABLE `junoplus-dev.junoplus_analytics_quality.pipeline_job_stats`
+  ADD COLUMN IF NOT EXISTS partitions_total INT64,
+  ADD COLUMN IF NOT EXISTS partitions_pruned INT64;
+
+-- Latest successful run of each step vs the median of its previous 10 runs (45 days).
+-- A metric regresses when it grows by more than threshold_pct and by at least min_delta
+-- (WARN; FAIL above twice the threshold). Needs 3+ baseline runs.
+CREATE OR REPLACE VIEW `junoplus-dev.junoplus_analytics_quality.pipeline_job_regressions` AS
+WITH runs AS (
+  SELECT
+    function_name,
+    step,
+    run_id,
+    created_at,
+    duration_ms,
+    slot_ms,
+    bytes_processed,
+    bytes_spilled,
+    partitions_processed,
+    ROW_NUMBER() OVER (PARTITION BY function_name, step ORDER BY created_at DESC) as run_rank
+  FROM `junoplus-dev.junoplus_analytics_quality.pipeline_job_stats`
+  WHERE status = 'success'
+    AND NOT IFNULL(cache_hit, FALSE)
+    AND created_at >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 45 DAY)
+),
+baseline AS (
+  SELECT
+    function_name,
+    step,
+    COUNT(*) as baseline_runs,
+    APPROX_QUANTILES(duration_ms, 2)[OFFSET(1)] as duration_ms,
+    APPROX_QUANTILES(slot_ms, 2)[OFFSET(1)] as slot_ms,
+    APPROX_QUANTILES(bytes_processed, 2)[OFFSET(1)] as bytes_processed,
+    APPROX_QUANTILES(IFNULL(bytes_spilled, 0), 2)[OFFSET(1)] as bytes_spilled,
+    APPROX_QUANTILES(partitions_processed, 2)[OFFSET(1)] as partitions_processed
+  FROM runs
+  WHERE run_rank BETWEEN 2 AND 11
+  GROUP BY function_name, step
+),
+metrics AS (
+  SELECT
+    l.function_name,
+    l.step,
+    l.run_id,
+    l.created_at,
+    b.baseline_runs,
+    m.metric,
+    m.latest_value,
+    m.baseline_value,
+    m.threshold_pct,
+    m.min_delta
+  FROM runs l
+  INNER JOIN baseline b
+    ON l.function_name = b.function_name AND l.step = b.step
+  CROSS JOIN UNNEST([
+    STRUCT('duration_ms' as metric, l.duration_ms as latest_value, b.duration_ms as baseline_value,
+           50.0 as threshold_pct, 30000 as min_delta),
+    STRUCT('slot_ms', l.slot_ms, b.slot_ms, 50.0, 60000),
+    STRUCT('bytes_processed', l.bytes_processed, b.bytes_processed, 25.0, 104857600),
+    STRUCT('bytes_spilled', IFNULL(l.bytes_spilled, 0), b.bytes_spilled, 25.0, 10485760),
+    STRUCT('partitions_processed', l.partitions_processed, b.partitions_processed, 25.0, 10)
+  ]) m
+  WHERE l.run_rank = 1
+    AND b.baseline_runs >= 3
+    AND m.latest_value IS NOT NULL
+    AND m.baseline_value IS NOT NULL
+)
+SELECT
+  * EXCEPT(min_delta),
+  ROUND(SAFE_DIVIDE(latest_value - baseline_value, baseline_value) * 100, 1) as change_pct,
+  CASE
+    WHEN latest_value - baseline_value < min_delta THEN 'PASS'
+    WHEN baseline_value > 0 AND SAFE_DIVIDE(latest_value - baseline_value, baseline_value) * 100 <= threshold_pct THEN 'PASS'
+    WHEN SAFE_DIVIDE(latest_value - baseline_value, baseline_value) * 100 > 2 * threshold_pct THEN 'FAIL'
+    ELSE 'WARN'
+  END as status
+FROM metrics;
+
+-- ============================================================================
+-- STEP 8: Pipeline Lineage
+-- ============================================================================
+
+-- Written by the orchestrator (functions/orchestrator): one row per step and
+-- source table per run. A step's consumed watermark for a source is the
+-- MAX(source_last_modified) of its 'success' rows.
+CREATE TABLE IF NOT EXISTS `junoplus-dev.junoplus_analytics_quality.pipeline_lineage` (
+  run_id STRING NOT NULL,
+  step STRING NOT NULL,
+  status STRING,
+  reason STRING,
+  source_table STRING,
+  source_last_modified TIMESTAMP,
+  consumed_last_modified TIMESTAMP,
+  changed_partitions INT64,
+  changed_partition_ids ARRAY<STRING>,
+  target_tables ARRAY<STRING>,
+  started_at TIMESTAMP NOT NULL,
+  finished_at TIMESTAMP,
+  response JSON
+)
+PARTITION BY DATE(started_at)
+CLUSTER BY step, source_table
+OPTIONS(
+  description="Orchestrator decisions and source versions consumed by each pipeline step"
+);
+
+-- ============================================================================
+-- STEP 9: Backfill Checkpoints
+-- ============================================================================
+
+-- Append-only shard events of sharded backfills (functions/backfill): 'pending'
+-- rows are the plan written by the coordinator; workers add 'done' (in the same
+-- transaction as the shard's data) or 'failed' rows
+CREATE TABLE IF NOT EXISTS `junoplus-dev.junoplus_analytics_quality.backfill_checkpoints` (
+  backfill_id STRING NOT NULL,
+  shard_id STRING NOT NULL,
+  layer STRING,
+  table_name STRING,
+  mode STRING,
+  kind STRING,
+  range_start DATE,
+  range_end DATE,
+  bucket INT64,
+  buckets INT64,
+  staging_table STRING,
+  status STRING NOT NULL,
+  error STRING,
+  recorded_at TIMESTAMP NOT NULL
+)
+PARTITION BY DATE(recorded_at)
+CLUSTER BY backfill_id, shard_id
+OPTIONS(
+  partition_expiration_days=180,
+  description="Per-shard checkpoints of sharded refreshes and backfills"
+);
+
 -- ============================================================================
 -- VERIFICATION QUERY
 -- ============================================================================
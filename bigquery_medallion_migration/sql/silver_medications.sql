@@ -1,6 +1,6 @@
 -- Silver Layer: Medications
--- Source: medications_data_raw_changelog
--- Logic: Flattens the medications array found in user documents
+-- Source: medications_data_raw_latest (compacted changelog, sql/bronze_compaction.sql)
+-- Logic: Flattens the medications array of each user's latest document
 CREATE OR REPLACE TABLE `junoplus-dev.junoplus_analytics_silver.silver_medications`
 CLUSTER BY user_id
 AS
@@ -9,9 +9,8 @@ WITH med_array AS (
     document_id as user_id,
     JSON_EXTRACT_ARRAY(data, '$.medications') as meds,
     timestamp
-  FROM `junoplus-dev.junoplus_analytics.medications_data_raw_changelog`
-  WHERE operation IN ('CREATE', 'UPDATE')
-    AND data IS NOT NULL
+  FROM `junoplus-dev.junoplus_analytics.medications_data_raw_latest`
+  WHERE data IS NOT NULL
 ),
 flat_meds AS (
   SELECT
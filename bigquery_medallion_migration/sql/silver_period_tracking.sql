@@ -7,9 +7,14 @@ AS
 SELECT
   JSON_VALUE(path_params, '$.userId') as user_id,
   document_id as cycle_id,
+  -- Logged day and its cycle day (ISO string or Firestore timestamp); NULL when not logged
+  COALESCE(
+    DATE(SAFE.TIMESTAMP(JSON_VALUE(data, '$.date'))),
+    DATE(TIMESTAMP_SECONDS(SAFE_CAST(JSON_VALUE(data, '$.date._seconds') AS INT64)))
+  ) as date,
+  COALESCE(SAFE_CAST(JSON_VALUE(data, '$.cycle_day') AS INT64),
+           SAFE_CAST(JSON_VALUE(data, '$.cycleDay') AS INT64)) as cycle_day,
   -- These will be NULL for now as the current raw schema is complex to flatten
-  CAST(NULL AS DATE) as date,
-  CAST(NULL AS INT64) as cycle_day,
   CAST(NULL AS STRING) as flow_intensity,
   CAST(NULL AS STRING) as symptoms,
   CAST(NULL AS INT64) as pain_level,
@@ -1,5 +1,5 @@
 -- Silver Layer: Therapy Sessions
--- Source: therapy_sessions_data_raw_changelog (Sub-collection)
+-- Source: therapy_sessions_data_raw_latest (compacted changelog, sql/bronze_compaction.sql)
 CREATE OR REPLACE TABLE `junoplus-dev.junoplus_analytics_silver.silver_therapy_sessions`
 PARTITION BY session_date
 CLUSTER BY user_id
@@ -22,14 +22,12 @@ WITH session_data AS (
     CAST(JSON_VALUE(data, '$.finalSettings.tensLevel') AS INT64) as final_tens,
     CAST(JSON_VALUE(data, '$.feedback.painLevelBefore') AS INT64) as pain_before,
     CAST(JSON_VALUE(data, '$.feedback.painLevelAfter') AS INT64) as pain_after,
-    CAST(JSON_VALUE(data, '$.feedback.feedbackCompleted') AS BOOL) as has_feedback,
-    ROW_NUMBER() OVER (PARTITION BY document_id ORDER BY timestamp DESC) as rn
-  FROM `junoplus-dev.junoplus_analytics.therapy_sessions_data_raw_changelog`
-  WHERE operation IN ('CREATE', 'UPDATE')
-    AND data IS NOT NULL
+    CAST(JSON_VALUE(data, '$.feedback.feedbackCompleted') AS BOOL) as has_feedback
+  FROM `junoplus-dev.junoplus_analytics.therapy_sessions_data_raw_latest`
+  WHERE data IS NOT NULL
 )
 SELECT
-  * EXCEPT(rn),
+  *,
   CASE 
     WHEN pain_before IS NOT NULL AND pain_after IS NOT NULL 
     THEN pain_before - pain_after 
@@ -54,5 +52,4 @@ SELECT
     ELSE FALSE 
   END as user_adjusted,
   CURRENT_TIMESTAMP() as processed_at
-FROM session_data
-WHERE rn = 1;
+FROM session_data;
@@ -1,5 +1,5 @@
 -- Silver Layer: User Profiles
--- Source: user_health_data_raw_changelog
+-- Source: user_health_data_raw_latest (compacted changelog, sql/bronze_compaction.sql)
 CREATE OR REPLACE TABLE `junoplus-dev.junoplus_analytics_silver.silver_user_profiles`
 CLUSTER BY user_id
 AS
@@ -15,9 +15,8 @@ WITH user_data AS (
     CAST(JSON_VALUE(data, '$.healthData.periodLength') AS INT64) as period_length,
     TIMESTAMP_SECONDS(CAST(JSON_VALUE(data, '$.healthData.lastPeriodDate._seconds') AS INT64)) as last_period_date,
     ROW_NUMBER() OVER (PARTITION BY JSON_VALUE(data, '$.uid') ORDER BY timestamp DESC) as rn
-  FROM `junoplus-dev.junoplus_analytics.user_health_data_raw_changelog`
-  WHERE operation IN ('CREATE', 'UPDATE')
-    AND data IS NOT NULL
+  FROM `junoplus-dev.junoplus_analytics.user_health_data_raw_latest`
+  WHERE data IS NOT NULL
     AND JSON_VALUE(data, '$.uid') IS NOT NULL
 )
 SELECT
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Offline backtest of the serving models over an ml_snapshot table
+
+Streams a snapshot (`ml_snapshot_snapshot_YYYYMMDD`) in fixed-size chunks,
+maps each session to the request context the prediction API would have
+received, scores it with the API's hierarchical LightGBM backend
+(tens_prediction_api/backends.py, so the inference rules are exactly the
+served ones) and compares the recommended settings with the recorded
+final_heat / final_mode / final_tens.
+
+Sources:
+    cache    local Arrow cache (data_cache.py; exported once, memory-mapped)
+    storage  BigQuery Storage Read API, one read stream per task
+
+Chunks are scored across a process pool; each worker writes its chunk's
+predictions straight to Parquet and returns only per-segment counters, so
+memory stays at one chunk per worker whatever the snapshot size.
+
+Output (--output, default backtests/<snapshot>__<model version>/):
+    predictions/part-*.parquet  one row per session
+    metrics.parquet             accuracy / MAE / latency per segment
+
+Usage:
+    python ml_training/backtest.py snapshot_20260215 --workers 8
+    python ml_training/backtest.py snapshot_20260215 --source storage --model-dir models/hierarchical_approach
+"""
+import argparse
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_DIR = os.path.join(REPO_ROOT, 'tens_prediction_api')
+DEFAULT_MODEL_DIR = os.path.join(REPO_ROOT, 'models', 'hierarchical_approach')
+
+PROJECT_ID = 'junoplus-dev'
+DATASET_GOLD = 'junoplus_analytics_gold'
+CHUNK_ROWS = 50_000
+
+# Columns every ml_training_base_v2 snapshot has (refresh_gold's query)
+REQUIRED_COLUMNS = [
+    'session_id', 'user_id', 'session_date', 'age', 'pain_before', 'initial_tens', 'hour_of_day',
+    'final_heat', 'final_mode', 'final_tens',
+]
+# Context columns of the sql/gold_ml_training_base_v2.sql variant; read when the snapshot has them,
+# else the request gets the API defaults (time_of_day then comes from hour_of_day)
+OPTIONAL_COLUMNS = [
+    'age_group', 'cycle_length', 'period_length', 'is_during_period', 'is_during_ovulation', 'cycle_phase',
+    'period_pain_level', 'flow_intensity', 'on_medication', 'time_of_day',
+]
+SNAPSHOT_COLUMNS = REQUIRED_COLUMNS + OPTIONAL_COLUMNS
+
+# Columns metrics are broken down by (plus 'all')
+SEGMENTS = ['time_of_day', 'age_group', 'cycle_phase', 'is_during_period', 'on_medication', 'pain_band']
+
+FLOW_LEVELS = {'none': 0, 'spotting': 1, 'light': 2, 'medium': 3, 'heavy': 4, 'very_heavy': 5}
+
+_backend = None
+
+
+def _flow_level(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)) or str(value).isdigit():
+        return min(5, int(value))
+    return FLOW_LEVELS.get(str(value).lower())
+
+
+def snapshot_columns(available):
+    """SNAPSHOT_COLUMNS present in a snapshot's column names; raises if a required one is missing"""
+    missing = [column for column in REQUIRED_COLUMNS if column not in available]
+    if missing:
+        raise ValueError(f"Snapshot is missing required columns: {', '.join(missing)}")
+    return [column for column in SNAPSHOT_COLUMNS if column in available]
+
+
+def _time_of_day(row):
+    """Snapshot time_of_day, else the same bucketing of hour_of_day as the training base query"""
+    if row.get('time_of_day'):
+        return row['time_of_day']
+    hour = row.get('hour_of_day')
+    if hour is None:
+        return None
+    if 6 <= hour <= 11:
+        return 'morning'
+    if 12 <= hour <= 17:
+        return 'afternoon'
+    return 'evening' if 18 <= hour <= 21 else 'night'
+
+
+def _segment_value(row, segment):
+    return str(_time_of_day(row) if segment == 'time_of_day' else row.get(segment))
+
+
+def _pain_band(pain):
+    if pain is None:
+        return 'unknown'
+    return 'low' if pain <= 3 else ('medium' if pain <= 6 else 'high')
+
+
+def snapshot_context(row):
+    """Prediction API request context for one snapshot session (API defaults where the snapshot has no value)"""
+    pain = row['pain_before'] if row['pain_before'] is not None else row.get('period_pain_level')
+    on_medication = bool(row.get('on_medication'))
+    return {
+        'user_id': row['user_id'],
+        'user_age': int(row['age']) if row['age'] is not None else 28,
+        'user_cycle_length': int(row['cycle_length']) if row.get('cycle_length') is not None else 30,
+        'user_period_length': int(row['period_length']) if row.get('period_length') is not None else 5,
+        'is_period_day': bool(row.get('is_during_period')),
+        'is_ovulation_day': bool(row.get('is_during_ovulation')),
+        'current_pain_level': int(pain) if pain is not None else None,
+        'current_flow_level': _flow_level(row.get('flow_intensity')),
+        'has_medications': on_medication,
+        'medication_count': int(on_medication),
+        'user_experience': 'experienced_user',
+        'time_of_day': _time_of_day(row) or 'afternoon',
+        # Setting the session started with (the app's previous level)
+        'previous_tens_level': int(row['initial_tens']) if row['initial_tens'] is not None else 5,
+        'tens_mode': 'continuous',
+        'explain': False,
+        'explain_top_k': 3,
+    }
+
+
+def _init_worker(model_dir):
+    global _backend
+    # The API modules are imported by path so the backtest runs the served inference code;
+    # API_DIR goes first because ml_training has its own features.py
+    sys.path.insert(0, API_DIR)
+    os.environ.setdefault('LIGHTGBM_NUM_THREADS', '1')
+    from backends import LightGBMBackend
+    _backend = LightGBMBackend(model_dir=model_dir)
+
+
+def _empty_counts():
+    return {'rows': 0, 'heat': 0, 'mode': 0, 'tens': 0, 'all': 0, 'tens_abs_error': 0.0, 'latency_ms': 0.0}
+
+
+def score_chunk(batch, output_dir, part):
+    """Score one Arrow batch, write its predictions, return {(segment, value): counters}"""
+    from backends import recommended_settings
+
+    rows = batch.to_pylist()
+    contexts = [snapshot_context(row) for row in rows]
+    start = time.perf_counter()
+    predictions = _backend.predict(contexts)
+    latency_ms = (time.perf_counter() - start) * 1000
+    per_row_ms = latency_ms / max(len(rows), 1)
+
+    records = defaultdict(list)
+    counts = defaultdict(_empty_counts)
+    for row, prediction in zip(rows, predictions):
+        heat, mode, tens = recommended_settings(prediction)
+        row['pain_band'] = _pain_band(row['pain_before'])
+        hits = {'heat': heat == row['final_heat'], 'mode': mode == row['final_mode'],
+                'tens': tens == row['final_tens']}
+        hits['all'] = all(hits.values())
+
+        for column in ('session_id', 'user_id', 'session_date', 'final_heat', 'final_mode', 'final_tens'):
+            records[column].append(row[column])
+        records['predicted_heat'].append(heat)
+        records['predicted_mode'].append(mode)
+        records['predicted_tens'].append(tens)
+        for head, hit in hits.items():
+            records[f'{head}_correct'].append(hit)
+
+        for key in [('all', 'all')] + [(segment, _segment_value(row, segment)) for segment in SEGMENTS]:
+            c = counts[key]
+            c['rows'] += 1
+            for head, hit in hits.items():
+                c[head] += hit
+            if row['final_tens'] is not None:
+                c['tens_abs_error'] += abs(tens - row['final_tens'])
+            c['latency_ms'] += per_row_ms
+
+    pq.write_table(pa.table(records), os.path.join(output_dir, 'predictions', f'part-{part}.parquet'))
+    return dict(counts), len(rows), latency_ms
+
+
+def _score_cache_slice(path, batch_index, offset, length, output_dir, task_index):
+    # Memory-mapped: only this slice's pages are read
+    batch = ipc.open_file(pa.memory_map(path, 'r')).get_batch(batch_index).slice(offset, length)
+    return score_chunk(batch.select(snapshot_columns(batch.schema.names)), output_dir, f'{task_index:05d}')
+
+
+def _score_stream(stream_name, chunk_rows, output_dir, task_index):
+    """Read one Storage Read API stream, scoring every chunk_rows rows; returns the merged results"""
+    from google.cloud import bigquery_storage
+
+    reader = bigquery_storage.BigQueryReadClient().read_rows(stream_name)
+    results = []
+    pending, pending_rows = [], 0
+    for page in reader.rows().pages:
+        batch = page.to_arrow()
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        while pending_rows >= chunk_rows:
+            table = pa.Table.from_batches(pending)
+            chunk = table.slice(0, chunk_rows).combine_chunks().to_batches()[0]
+            results.append(score_chunk(chunk, output_dir, f'{task_index:04d}-{len(results):05d}'))
+            rest = table.slice(chunk_rows)
+            pending, pending_rows = rest.to_batches(), rest.num_rows
+    if pending_rows:
+        table = pa.Table.from_batches(pending).combine_chunks()
+        results.append(score_chunk(table.to_batches()[0], output_dir, f'{task_index:04d}-{len(results):05d}'))
+    return merge_results(results)
+
+
+def merge_results(results):
+    """Sum (counters, rows, latency_ms) results of several chunks"""
+    counts = defaultdict(_empty_counts)
+    total_rows, total_latency_ms = 0, 0.0
+    for chunk_counts, rows, latency_ms in results:
+        for key, c in chunk_counts.items():
+            for field, value in c.items():
+                counts[key][field] += value
+        total_rows += rows
+        total_latency_ms += latency_ms
+    return dict(counts), total_rows, total_latency_ms
+
+
+def cache_tasks(snapshot_id, chunk_rows, cache_dir=None):
+    """(path, batch index, offset, length) slices of the cached snapshot"""
+    import json
+
+    from google.cloud import bigquery
+
+    from data_cache import DEFAULT_CACHE_DIR, export
+
+    client = bigquery.Client(project=PROJECT_ID)
+    print(f"📦 Loading {snapshot_id} into the local cache (exported once)...")
+    entry_dir = export(client, snapshot_id, cache_dir=cache_dir or DEFAULT_CACHE_DIR)
+    with open(os.path.join(entry_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    tasks = []
+    for file_info in manifest['files']:
+        path = os.path.join(entry_dir, file_info['path'])
+        reader = ipc.open_file(pa.memory_map(path, 'r'))
+        for batch_index in range(reader.num_record_batches):
+            num_rows = reader.get_batch(batch_index).num_rows
+            for offset in range(0, num_rows, chunk_rows):
+                tasks.append((path, batch_index, offset, min(chunk_rows, num_rows - offset)))
+    return tasks
+
+
+def storage_streams(snapshot_id, max_streams):
+    """Read stream names for the snapshot table (BigQuery balances rows across them)"""
+    from google.cloud import bigquery, bigquery_storage
+    from google.cloud.bigquery_storage import types
+
+    table_name = snapshot_id if snapshot_id.startswith('ml_snapshot_') else f'ml_snapshot_{snapshot_id}'
+    table = bigquery.Client(project=PROJECT_ID).get_table(f'{PROJECT_ID}.{DATASET_GOLD}.{table_name}')
+    columns = snapshot_columns([field.name for field in table.schema])
+    session = bigquery_storage.BigQueryReadClient().create_read_session(
+        parent=f'projects/{PROJECT_ID}',
+        read_session=types.ReadSession(
+            table=f'projects/{PROJECT_ID}/datasets/{DATASET_GOLD}/tables/{table_name}',
+            data_format=types.DataFormat.ARROW,
+            read_options=types.ReadSession.TableReadOptions(selected_fields=columns),
+        ),
+        max_stream_count=max_streams,
+    )
+    return [stream.name for stream in session.streams]
+
+
+def metrics_table(counts):
+    rows = []
+    for (segment, value), c in sorted(counts.items()):
+        n = c['rows']
+        rows.append({
+            'segment': segment,
+            'value': value,
+            'rows': n,
+            'heat_accuracy': c['heat'] / n,
+            'mode_accuracy': c['mode'] / n,
+            'tens_accuracy': c['tens'] / n,
+            'all_accuracy': c['all'] / n,
+            'tens_mae': c['tens_abs_error'] / n,
+            'mean_latency_us_per_row': c['latency_ms'] * 1000 / n,
+        })
+    return pa.Table.from_pylist(rows)
+
+
+def run_backtest(snapshot_id, model_dir=DEFAULT_MODEL_DIR, source='cache', workers=None, chunk_rows=CHUNK_ROWS,
+                 output=None, cache_dir=None):
+    workers = workers or os.cpu_count()
+    model_version = f"lightgbm_hierarchical@{int(os.path.getmtime(os.path.join(model_dir, 'tens_mode_model.pkl')))}"
+    output = output or os.path.join('backtests', f'{snapshot_id}__{model_version.replace("@", "_")}')
+    os.makedirs(os.path.join(output, 'predictions'), exist_ok=True)
+
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model_dir,)) as pool:
+        if source == 'cache':
+            tasks = cache_tasks(snapshot_id, chunk_rows, cache_dir)
+            futures = [pool.submit(_score_cache_slice, *task, output, i) for i, task in enumerate(tasks)]
+        else:
+            # Several streams per worker keeps every core busy when streams finish unevenly
+            streams = storage_streams(snapshot_id, workers * 4)
+            futures = [pool.submit(_score_stream, stream, chunk_rows, output, i) for i, stream in enumerate(streams)]
+        print(f"🚀 Scoring {len(futures)} task(s) on {workers} worker(s)...")
+        for done, future in enumerate(as_completed(futures), 1):
+            results.append(future.result())
+            if done % max(1, len(futures) // 10) == 0:
+                print(f"  {done}/{len(futures)} tasks")
+
+    counts, total_rows, inference_ms = merge_results(results)
+    if not total_rows:
+        raise ValueError(f"{snapshot_id} has no rows to score")
+    metrics = metrics_table(counts)
+    pq.write_table(metrics, os.path.join(output, 'metrics.parquet'))
+
+    elapsed = time.perf_counter() - start
+    overall = counts[('all', 'all')]
+    print(f"✅ {total_rows:,} sessions scored in {elapsed:.1f}s ({total_rows / elapsed:,.0f} rows/s)")
+    print(f"  heat {overall['heat'] / total_rows:.3f}  mode {overall['mode'] / total_rows:.3f}  "
+          f"tens {overall['tens'] / total_rows:.3f}  all {overall['all'] / total_rows:.3f}  "
+          f"tens MAE {overall['tens_abs_error'] / total_rows:.2f}")
+    print(f"  Inference: {inference_ms * 1000 / total_rows:.1f} µs/row per worker")
+    print(f"  Results: {output}")
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Backtest the serving models on an ml_snapshot table')
+    parser.add_argument('snapshot_id', help='snapshot_YYYYMMDD or ml_snapshot_snapshot_YYYYMMDD')
+    parser.add_argument('--model-dir', default=DEFAULT_MODEL_DIR)
+    parser.add_argument('--source', choices=['cache', 'storage'], default='cache',
+                        help='Local Arrow cache (default) or BigQuery Storage Read API streams')
+    parser.add_argument('--workers', type=int, default=None, help='Processes (default: all cores)')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    run_backtest(args.snapshot_id, model_dir=args.model_dir, source=args.source, workers=args.workers,
+                 chunk_rows=args.chunk_rows, output=args.output, cache_dir=args.cache_dir)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Local columnar cache for ML training data
+
+Exports a gold training table (an immutable `ml_snapshot_*` table, or a
+version of `ml_training_base_v2` / `ml_training_data_v1`) once through the
+BigQuery Storage Read API, optionally through a feature query, into
+partitioned Arrow IPC files:
+
+    <cache_dir>/<version>__<query hash>/
+        manifest.json
+        data_split=TRAIN/part-00000.arrow
+        data_split=EVAL/part-00000.arrow
+        ...
+
+Columns are stored with compact types (dictionary-encoded strings, int8
+levels, float32 measures) and later loads memory-map the files, so rerunning
+an experiment reads local pages instead of scanning BigQuery again.
+
+Usage:
+    python ml_training/data_cache.py snapshot_20260215
+    python ml_training/data_cache.py ml_training_base_v2 --refresh
+    python ml_training/data_cache.py --list
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+from google.cloud import bigquery, bigquery_storage
+
+PROJECT_ID = 'junoplus-dev'
+DATASET_GOLD = 'junoplus_analytics_gold'
+DEFAULT_CACHE_DIR = os.environ.get('JUNO_DATA_CACHE', os.path.expanduser('~/.cache/junoai/training_data'))
+
+ROWS_PER_FILE = 250_000
+PARTITION_COLUMN = 'data_split'
+
+# Unique per row, so dictionary encoding would only add overhead
+HIGH_CARDINALITY_COLUMNS = {'sessionId', 'session_id', 'document_id'}
+
+# Small integer settings/levels stored as int8
+INT8_PATTERN = re.compile(r'^(y_(heat|mode|tens)|.*_level|.*_heat|.*_mode|.*_tens|day_of_week.*|session_hour|hour_of_day)$')
+
+
+def _query_hash(query):
+    if not query:
+        return 'table'
+    normalized = ' '.join(query.split())
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:12]
+
+
+def resolve_source(client, snapshot_id, project=PROJECT_ID, dataset=DATASET_GOLD):
+    """Map a snapshot id or gold table name to (table_id, version).
+
+    `snapshot_YYYYMMDD` snapshots are immutable, so their id is the version.
+    Mutable tables are versioned by their last-modified time.
+    """
+    if snapshot_id.startswith('ml_snapshot_'):
+        snapshot_id = snapshot_id[len('ml_snapshot_'):]
+    if snapshot_id.startswith('snapshot_'):
+        return f"{project}.{dataset}.ml_snapshot_{snapshot_id}", snapshot_id
+
+    table = client.get_table(f"{project}.{dataset}.{snapshot_id}")
+    return table.full_table_id.replace(':', '.'), f"{snapshot_id}@{table.modified.strftime('%Y%m%dT%H%M%S')}"
+
+
+def compact_schema(schema):
+    """Target schema with compact column types for a source Arrow schema"""
+    fields = []
+    for field in schema:
+        dtype = field.type
+        if pa.types.is_string(dtype) or pa.types.is_large_string(dtype):
+            if field.name not in HIGH_CARDINALITY_COLUMNS:
+                dtype = pa.dictionary(pa.int32(), pa.string())
+        elif pa.types.is_integer(dtype):
+            dtype = pa.int8() if INT8_PATTERN.match(field.name) else pa.int32()
+        elif pa.types.is_floating(dtype):
+            dtype = pa.float32()
+        fields.append(pa.field(field.name, dtype, nullable=field.nullable))
+    return pa.schema(fields)
+
+
+def _compact_table(table, schema):
+    columns = []
+    for field, column in zip(schema, table.columns):
+        if pa.types.is_dictionary(field.type):
+            column = pc.dictionary_encode(column.combine_chunks())
+        else:
+            column = column.cast(field.type, safe=True)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class _PartitionWriter:
+    """Buffers batches per partition value and writes one Arrow IPC file per
+    ROWS_PER_FILE rows (one dictionary per file, as the IPC file format requires)"""
+
+    def __init__(self, root, schema, rows_per_file):
+        self.root = root
+        self.schema = schema
+        self.rows_per_file = rows_per_file
+        self.buffers = {}
+        self.file_counts = {}
+        self.files = []
+
+    def write(self, partition, batch):
+        buffered = self.buffers.setdefault(partition, [])
+        buffered.append(batch)
+        if sum(b.num_rows for b in buffered) >= self.rows_per_file:
+            self._flush(partition)
+
+    def _flush(self, partition):
+        batches = self.buffers.pop(partition, [])
+        if not batches:
+            return
+        index = self.file_counts.get(partition, 0)
+        self.file_counts[partition] = index + 1
+
+        directory = os.path.join(self.root, f"{PARTITION_COLUMN}={partition}") if partition else self.root
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"part-{index:05d}.arrow")
+
+        table = _compact_table(pa.Table.from_batches(batches), self.schema)
+        with pa.OSFile(path, 'wb') as sink, ipc.new_file(sink, self.schema) as writer:
+            writer.write_table(table)
+        self.files.append({'path': os.path.relpath(path, self.root),
+                           'partition': partition, 'rows': table.num_rows})
+
+    def close(self):
+        for partition in list(self.buffers):
+            self._flush(partition)
+
+
+def export(client, snapshot_id, query=None, cache_dir=DEFAULT_CACHE_DIR, rows_per_file=ROWS_PER_FILE,
+           bqstorage_client=None):
+    """Export a table version (optionally through `query`) to the local cache.
+
+    `query` may reference the resolved table as `{source_table}`.
+    Returns the cache entry directory.
+    """
+    table_id, version = resolve_source(client, snapshot_id)
+    entry_dir = os.path.join(cache_dir, f"{version}__{_query_hash(query)}")
+    if os.path.exists(os.path.join(entry_dir, 'manifest.json')):
+        return entry_dir
+
+    bqstorage_client = bqstorage_client or bigquery_storage.BigQueryReadClient()
+    if query:
+        rows = client.query(query.replace('{source_table}', table_id)).result()
+    else:
+        rows = client.list_rows(table_id)
+
+    tmp_dir = f"{entry_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    writer = None
+    schema = None
+    total_rows = 0
+    for batch in rows.to_arrow_iterable(bqstorage_client=bqstorage_client):
+        if batch.num_rows == 0:
+            continue
+        if schema is None:
+            schema = compact_schema(batch.schema)
+            writer = _PartitionWriter(tmp_dir, schema, rows_per_file)
+        total_rows += batch.num_rows
+
+        if PARTITION_COLUMN not in schema.names:
+            writer.write(None, batch)
+            continue
+        split = batch.column(PARTITION_COLUMN).cast(pa.string())
+        for partition in pc.unique(split).to_pylist():
+            mask = pc.equal(split, partition) if partition is not None else pc.is_null(split)
+            writer.write(partition or 'NULL', batch.filter(mask))
+
+    if writer is None:
+        raise ValueError(f"{table_id} returned no rows for the cache query")
+    writer.close()
+
+    manifest = {
+        'snapshot_id': snapshot_id,
+        'version': version,
+        'source_table': table_id,
+        'query_hash': _query_hash(query),
+        'query': query,
+        'rows': total_rows,
+        'files': writer.files,
+        'schema': schema.to_string(),
+        'created_at': datetime.now().isoformat(),
+    }
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    # Publish atomically; a concurrent export of the same entry wins the race harmlessly
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return entry_dir
+
+
+def read_table(entry_dir, splits=None, columns=None):
+    """Memory-map a cache entry as a pyarrow Table (zero-copy for fixed-width columns)"""
+    with open(os.path.join(entry_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    tables = []
+    for file_info in manifest['files']:
+        if splits and file_info['partition'] not in splits:
+            continue
+        source = pa.memory_map(os.path.join(entry_dir, file_info['path']), 'r')
+        table = ipc.open_file(source).read_all()
+        tables.append(table.select(columns) if columns else table)
+    if not tables:
+        raise ValueError(f"No cached files match splits={splits} in {entry_dir}")
+    return pa.concat_tables(tables)
+
+
+def invalidate(client, snapshot_id, query=None, cache_dir=DEFAULT_CACHE_DIR):
+    """Drop the cache entry for a table version + query"""
+    _, version = resolve_source(client, snapshot_id)
+    shutil.rmtree(os.path.join(cache_dir, f"{version}__{_query_hash(query)}"), ignore_errors=True)
+
+
+def load_dataframe(snapshot_id, query=None, client=None, cache_dir=DEFAULT_CACHE_DIR, splits=None,
+                   columns=None, refresh=False, categoricals=True):
+    """Return the cached data as pandas (exporting it first if needed).
+
+    Dictionary columns become pandas categoricals (or plain object columns with
+    categoricals=False, matching client.query(...).to_dataframe()); int8 levels
+    stay int8 unless they contain nulls.
+    """
+    client = client or bigquery.Client(project=PROJECT_ID)
+    if refresh:
+        invalidate(client, snapshot_id, query=query, cache_dir=cache_dir)
+    entry_dir = export(client, snapshot_id, query=query, cache_dir=cache_dir)
+    table = read_table(entry_dir, splits=splits, columns=columns)
+    if not categoricals:
+        table = table.cast(pa.schema([
+            pa.field(f.name, f.type.value_type if pa.types.is_dictionary(f.type) else f.type)
+            for f in table.schema
+        ]))
+    return table.to_pandas(split_blocks=True)
+
+
+def list_entries(cache_dir=DEFAULT_CACHE_DIR):
+    """Manifests of every cache entry"""
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for name in sorted(os.listdir(cache_dir)):
+        manifest_path = os.path.join(cache_dir, name, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                entries.append({'path': os.path.join(cache_dir, name), **json.load(f)})
+    return entries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export a training snapshot to the local Arrow cache')
+    parser.add_argument('snapshot_id', nargs='?',
+                        help='snapshot_YYYYMMDD, ml_snapshot_snapshot_YYYYMMDD or a gold table name')
+    parser.add_argument('--query-file', help='SQL file to run instead of a plain table read ({source_table} placeholder)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--refresh', action='store_true', help='Re-export even if cached')
+    parser.add_argument('--list', action='store_true', help='List cache entries')
+    args = parser.parse_args()
+
+    if args.list or not args.snapshot_id:
+        for entry in list_entries(args.cache_dir):
+            print(f"{entry['version']:<40} {entry['query_hash']:<14} {entry['rows']:>10,} rows  {entry['path']}")
+    else:
+        query = open(args.query_file).read() if args.query_file else None
+        client = bigquery.Client(project=PROJECT_ID)
+        if args.refresh:
+            invalidate(client, args.snapshot_id, query=query, cache_dir=args.cache_dir)
+        print(f"📦 Exporting {args.snapshot_id}...")
+        entry_dir = export(client, args.snapshot_id, query=query, cache_dir=args.cache_dir)
+        with open(os.path.join(entry_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        print(f"✅ {manifest['rows']:,} rows in {len(manifest['files'])} file(s) at {entry_dir}")
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+Distil the hierarchical LightGBM models into one compact multi-output student
+
+The teacher is the served hierarchy (tens_prediction_api/backends.py LightGBM
+backend: 500-tree heat, mode and TENS level classifiers). Each ml_snapshot
+session is mapped to the request the API would have received (backtest.py),
+the teacher's class probabilities for all three heads become soft targets, and
+a single-hidden-layer network with three softmax heads is fitted to them
+(cross-entropy against the teacher; the TENS head is weighted by the teacher's
+P(mode > 0), since stage 2 only matters for active sessions). No recorded
+labels are needed to train, so --synthetic-rows can add random requests to the
+transfer set.
+
+The student is numpy only: missing-value fill and the scaler are folded into
+the first layer, so a prediction is two small matrix products. It is served by
+the API's `distilled` backend, which applies the same hierarchical rules
+(TENS off for mode 0, fallback level below the mode confidence threshold).
+
+Sessions of 20% of users (hash of user_id) are held out. The report compares
+student and teacher on them: accuracy against the recorded final settings,
+agreement with the teacher, model size, and single-request / batch latency of
+both backends (one thread).
+
+Output (--output, default models/distilled_approach/):
+    student_model.npz     weights, fill values, head classes, feature columns
+    distill_report.json   the comparison above
+
+Usage:
+    python ml_training/distill.py snapshot_20260215
+    python ml_training/distill.py snapshot_20260215 --hidden 32 --synthetic-rows 100000
+    python ml_training/distill.py --parquet /data/ml_snapshot.parquet --output /tmp/student
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import zlib
+from datetime import datetime
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from backtest import API_DIR, DEFAULT_MODEL_DIR, REPO_ROOT, snapshot_columns, snapshot_context
+
+# The API modules run the served inference code; API_DIR goes first because
+# ml_training has its own features.py
+sys.path.insert(0, API_DIR)
+os.environ.setdefault('LIGHTGBM_NUM_THREADS', '1')
+
+from backends import DistilledBackend, LightGBMBackend, recommended_settings  # noqa: E402
+from features import build_matrix  # noqa: E402
+
+DEFAULT_OUTPUT = os.path.join(REPO_ROOT, 'models', 'distilled_approach')
+HOLDOUT_BUCKETS = 2  # of 10 user hash buckets
+HEAD_NAMES = ('heat', 'mode', 'tens')
+
+
+def load_rows(snapshot_id=None, parquet=None, max_rows=None, cache_dir=None, seed=42):
+    """Snapshot sessions as dicts (backtest.snapshot_columns the snapshot has), sampled down to max_rows"""
+    if parquet:
+        table = pq.read_table(parquet, columns=snapshot_columns(pq.read_schema(parquet).names))
+    else:
+        from google.cloud import bigquery
+
+        from data_cache import DEFAULT_CACHE_DIR, PROJECT_ID, export, read_table
+        entry_dir = export(bigquery.Client(project=PROJECT_ID), snapshot_id, cache_dir=cache_dir or DEFAULT_CACHE_DIR)
+        table = read_table(entry_dir)  # memory-mapped; only the selected columns are decoded below
+        table = table.select(snapshot_columns(table.schema.names))
+    if max_rows and table.num_rows > max_rows:
+        rng = np.random.default_rng(seed)
+        table = table.take(np.sort(rng.choice(table.num_rows, max_rows, replace=False)))
+    return table.to_pylist()
+
+
+def is_holdout(user_id):
+    return zlib.crc32(str(user_id).encode('utf-8')) % 10 < HOLDOUT_BUCKETS
+
+
+def synthetic_contexts(n, seed):
+    """Random API requests (benchmark_backends.random_context) to widen the transfer set"""
+    import random
+
+    from benchmark_backends import random_context
+    rng = random.Random(seed)
+    return [{**random_context(rng), 'explain': False, 'explain_top_k': 3} for _ in range(n)]
+
+
+def teacher_targets(teacher, X):
+    """Soft targets: the teacher's class probabilities for every head on every row"""
+    return {
+        'heat': teacher.heat_model.predict_proba(X).astype(np.float32),
+        'mode': teacher.mode_model.predict_proba(X).astype(np.float32),
+        'tens': teacher.tens_model.predict_proba(X).astype(np.float32),
+    }
+
+
+def _softmax(logits):
+    z = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return z / z.sum(axis=1, keepdims=True)
+
+
+def _soft_cross_entropy(logits, heads, targets, tens_weight):
+    loss = 0.0
+    for name, s in heads:
+        log_p = np.log(np.clip(_softmax(logits[:, s]), 1e-7, 1.0))
+        per_row = -(targets[name] * log_p).sum(axis=1)
+        loss += (per_row * tens_weight).mean() if name == 'tens' else per_row.mean()
+    return loss
+
+
+def train_student(X, targets, tens_weight, X_val, targets_val, tens_weight_val, hidden=64, epochs=60,
+                  batch_size=512, learning_rate=3e-3, patience=6, seed=42):
+    """
+    Fit the student on teacher soft targets (Adam, early stopping on held-out loss).
+    Returns the serving parameters with the fill values and scaler folded into layer 1.
+    """
+    rng = np.random.default_rng(seed)
+    fill = np.nan_to_num(np.nanmean(np.where(np.isnan(X).all(axis=0), 0.0, X), axis=0)).astype(np.float32)
+    X = np.where(np.isnan(X), fill, X)
+    X_val = np.where(np.isnan(X_val), fill, X_val)
+    mean, std = X.mean(axis=0), X.std(axis=0)
+    std[std == 0] = 1.0
+    X = ((X - mean) / std).astype(np.float32)
+    X_val = ((X_val - mean) / std).astype(np.float32)
+
+    sizes = [targets[name].shape[1] for name in HEAD_NAMES]
+    bounds = np.cumsum([0] + sizes)
+    heads = [(name, slice(bounds[i], bounds[i + 1])) for i, name in enumerate(HEAD_NAMES)]
+    target_matrix = np.hstack([targets[name] for name in HEAD_NAMES])
+    row_weight = np.hstack([np.ones((len(X), bounds[2]), np.float32),
+                            np.repeat(tens_weight[:, None], sizes[2], axis=1)])
+
+    params = {
+        'w1': (rng.standard_normal((X.shape[1], hidden)) * np.sqrt(2.0 / X.shape[1])).astype(np.float32),
+        'b1': np.zeros(hidden, np.float32),
+        'w2': (rng.standard_normal((hidden, bounds[-1])) * np.sqrt(1.0 / hidden)).astype(np.float32),
+        'b2': np.zeros(bounds[-1], np.float32),
+    }
+    moments = {k: (np.zeros_like(v), np.zeros_like(v)) for k, v in params.items()}
+    beta1, beta2, step = 0.9, 0.999, 0
+
+    def forward(inputs, p):
+        h = np.maximum(inputs @ p['w1'] + p['b1'], 0)
+        return h, h @ p['w2'] + p['b2']
+
+    best_loss, best_params, stale = np.inf, None, 0
+    for epoch in range(epochs):
+        order = rng.permutation(len(X))
+        for start in range(0, len(X), batch_size):
+            rows = order[start:start + batch_size]
+            h, logits = forward(X[rows], params)
+            proba = np.hstack([_softmax(logits[:, s]) for _, s in heads])
+            d_logits = (proba - target_matrix[rows]) * row_weight[rows] / len(rows)
+            d_hidden = (d_logits @ params['w2'].T) * (h > 0)
+            grads = {'w1': X[rows].T @ d_hidden, 'b1': d_hidden.sum(axis=0),
+                     'w2': h.T @ d_logits, 'b2': d_logits.sum(axis=0)}
+            step += 1
+            for k, g in grads.items():
+                m, v = moments[k]
+                m[:] = beta1 * m + (1 - beta1) * g
+                v[:] = beta2 * v + (1 - beta2) * g * g
+                m_hat, v_hat = m / (1 - beta1 ** step), v / (1 - beta2 ** step)
+                params[k] -= (learning_rate * m_hat / (np.sqrt(v_hat) + 1e-8)).astype(np.float32)
+
+        val_loss = _soft_cross_entropy(forward(X_val, params)[1], heads, targets_val, tens_weight_val)
+        if val_loss < best_loss - 1e-4:
+            best_loss, best_params, stale = val_loss, {k: v.copy() for k, v in params.items()}, 0
+        else:
+            stale += 1
+            if stale >= patience:
+                break
+    print(f"🎓 Student trained for {epoch + 1} epoch(s), held-out soft cross-entropy {best_loss:.4f}")
+
+    # (x - mean) / std @ w1 + b1  ==  x @ (w1 / std) + (b1 - mean / std @ w1)
+    w1 = best_params['w1'] / std[:, None].astype(np.float32)
+    b1 = best_params['b1'] - (mean / std).astype(np.float32) @ best_params['w1']
+    return {'fill': fill, 'w1': w1.astype(np.float32), 'b1': b1.astype(np.float32),
+            'w2': best_params['w2'], 'b2': best_params['b2']}, float(best_loss)
+
+
+def save_student(path, params, teacher, metadata):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.savez(
+        path,
+        **params,
+        heat_classes=np.asarray(teacher.heat_model.classes_, dtype=np.float32),
+        mode_classes=np.asarray(teacher.mode_model.classes_, dtype=np.float32),
+        tens_classes=np.asarray(teacher.tens_model.classes_, dtype=np.float32),
+        feature_columns=np.asarray(teacher.feature_columns),
+        metadata=np.asarray(json.dumps(metadata)),
+    )
+
+
+def accuracy(rows, predictions):
+    """Accuracy of the recommended settings against the recorded final settings, per head and overall"""
+    hits = {'heat': 0, 'mode': 0, 'tens': 0, 'all': 0}
+    for row, prediction in zip(rows, predictions):
+        heat, mode, tens = recommended_settings(prediction)
+        row_hits = {'heat': heat == row['final_heat'], 'mode': mode == row['final_mode'],
+                    'tens': tens == row['final_tens']}
+        for head, hit in row_hits.items():
+            hits[head] += hit
+        hits['all'] += all(row_hits.values())
+    return {head: count / max(len(rows), 1) for head, count in hits.items()}
+
+
+def agreement(predictions, reference):
+    same = {'heat': 0, 'mode': 0, 'tens': 0, 'all': 0}
+    for a, b in zip(predictions, reference):
+        settings = list(zip(('heat', 'mode', 'tens'), recommended_settings(a), recommended_settings(b)))
+        for head, x, y in settings:
+            same[head] += x == y
+        same['all'] += all(x == y for _, x, y in settings)
+    return {head: count / max(len(predictions), 1) for head, count in same.items()}
+
+
+def latency(backend, contexts, batch_size):
+    """Single-request p50 / p99 (ms) and batched µs per prediction"""
+    backend.predict(contexts[:1])  # warm-up
+    single = []
+    for context in contexts:
+        t0 = time.perf_counter()
+        backend.predict([context])
+        single.append((time.perf_counter() - t0) * 1000)
+    t0 = time.perf_counter()
+    for i in range(0, len(contexts), batch_size):
+        backend.predict(contexts[i:i + batch_size])
+    batch_us = (time.perf_counter() - t0) * 1e6 / len(contexts)
+    single.sort()
+    return {
+        'single_p50_ms': single[len(single) // 2],
+        'single_p99_ms': single[min(len(single) - 1, int(len(single) * 0.99))],
+        'batch_us_per_prediction': batch_us,
+    }
+
+
+def teacher_size(teacher, model_dir):
+    files = ('heat_level_model.pkl', 'tens_mode_model.pkl', 'tens_level_model.pkl')
+    return {
+        'bytes': sum(os.path.getsize(os.path.join(model_dir, f)) for f in files),
+        'trees': sum(m.booster_.num_trees() for m in (teacher.heat_model, teacher.mode_model, teacher.tens_model)),
+    }
+
+
+def run_distillation(snapshot_id=None, parquet=None, model_dir=DEFAULT_MODEL_DIR, output=DEFAULT_OUTPUT,
+                     hidden=64, epochs=60, max_rows=500_000, synthetic_rows=0, latency_requests=1000,
+                     batch_size=256, cache_dir=None, seed=42):
+    teacher = LightGBMBackend(model_dir=model_dir)
+    rows = load_rows(snapshot_id, parquet, max_rows=max_rows, cache_dir=cache_dir, seed=seed)
+    holdout = np.array([is_holdout(row['user_id']) for row in rows], dtype=bool)
+    train_rows = [row for row, h in zip(rows, holdout) if not h]
+    eval_rows = [row for row, h in zip(rows, holdout) if h]
+    if not train_rows or not eval_rows:
+        raise ValueError(f"Need sessions of both training and held-out users, got {len(train_rows)} / {len(eval_rows)}")
+
+    train_contexts = [snapshot_context(row) for row in train_rows] + synthetic_contexts(synthetic_rows, seed)
+    eval_contexts = [snapshot_context(row) for row in eval_rows]
+    print(f"📦 {len(train_contexts):,} training requests ({synthetic_rows:,} synthetic), "
+          f"{len(eval_contexts):,} held out, teacher {teacher.version}")
+
+    X = build_matrix(train_contexts, teacher.feature_columns)
+    X_val = build_matrix(eval_contexts, teacher.feature_columns)
+    targets, targets_val = teacher_targets(teacher, X), teacher_targets(teacher, X_val)
+    active = np.asarray(teacher.mode_model.classes_) > 0
+    tens_weight = targets['mode'][:, active].sum(axis=1)
+    tens_weight_val = targets_val['mode'][:, active].sum(axis=1)
+
+    params, soft_loss = train_student(X, targets, tens_weight, X_val, targets_val, tens_weight_val,
+                                      hidden=hidden, epochs=epochs, batch_size=batch_size, seed=seed)
+    model_version = f"distilled_mlp{hidden}@{datetime.now().strftime('%Y%m%dT%H%M%S')}"
+    model_path = os.path.join(output, DistilledBackend.model_file)
+    save_student(model_path, params, teacher, {
+        'model_version': model_version,
+        'teacher_version': teacher.version,
+        'source': snapshot_id or parquet,
+        'hidden_units': hidden,
+        'created_at': datetime.now().isoformat(),
+    })
+
+    # Evaluate the saved artifact through the serving backend
+    student = DistilledBackend(model_path=model_path)
+    teacher_predictions = teacher.predict(eval_contexts)
+    student_predictions = student.predict(eval_contexts)
+    teacher_accuracy = accuracy(eval_rows, teacher_predictions)
+    student_accuracy = accuracy(eval_rows, student_predictions)
+    timing_contexts = eval_contexts[:latency_requests]
+    report = {
+        'model_version': model_version,
+        'teacher_version': teacher.version,
+        'source': snapshot_id or parquet,
+        'train_requests': len(train_contexts),
+        'holdout_sessions': len(eval_contexts),
+        'heldout_soft_cross_entropy': soft_loss,
+        'teacher_accuracy': teacher_accuracy,
+        'student_accuracy': student_accuracy,
+        'accuracy_loss': {h: teacher_accuracy[h] - student_accuracy[h] for h in teacher_accuracy},
+        'agreement_with_teacher': agreement(student_predictions, teacher_predictions),
+        'teacher_size': teacher_size(teacher, model_dir),
+        'student_size': {'bytes': os.path.getsize(model_path),
+                         'parameters': int(sum(params[k].size for k in ('w1', 'b1', 'w2', 'b2')))},
+        'teacher_latency': latency(teacher, timing_contexts, batch_size),
+        'student_latency': latency(student, timing_contexts, batch_size),
+        'latency_batch_size': batch_size,
+    }
+    with open(os.path.join(output, 'distill_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\n📊 Held-out sessions: {len(eval_contexts):,}")
+    print(f"{'':<10} {'heat':>7} {'mode':>7} {'tens':>7} {'all':>7}")
+    for label, values in (('teacher', teacher_accuracy), ('student', student_accuracy),
+                          ('loss', report['accuracy_loss']), ('agreement', report['agreement_with_teacher'])):
+        print(f"{label:<10} " + ' '.join(f"{values[h]:>7.3f}" for h in ('heat', 'mode', 'tens', 'all')))
+    for label in ('teacher', 'student'):
+        size, timing = report[f'{label}_size'], report[f'{label}_latency']
+        print(f"{label:<10} {size['bytes'] / 1024:>9,.0f} KB  single p50 {timing['single_p50_ms']:.3f} ms  "
+              f"p99 {timing['single_p99_ms']:.3f} ms  batch {timing['batch_us_per_prediction']:.1f} µs/prediction")
+    print(f"✅ Student saved to {model_path}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Distil the hierarchical LightGBM models into a compact student')
+    parser.add_argument('snapshot_id', nargs='?', help='snapshot_YYYYMMDD or ml_snapshot_snapshot_YYYYMMDD')
+    parser.add_argument('--parquet', help='Parquet file or directory with the snapshot columns instead of the cache')
+    parser.add_argument('--model-dir', default=DEFAULT_MODEL_DIR, help='Teacher (hierarchical LightGBM) directory')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--hidden', type=int, default=64, help='Hidden units of the student')
+    parser.add_argument('--epochs', type=int, default=60)
+    parser.add_argument('--max-rows', type=int, default=500_000, help='Sample the snapshot down to this many sessions')
+    parser.add_argument('--synthetic-rows', type=int, default=0, help='Random API requests added to the training set')
+    parser.add_argument('--latency-requests', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    if not args.snapshot_id and not args.parquet:
+        parser.error('snapshot_id or --parquet is required')
+
+    run_distillation(args.snapshot_id, parquet=args.parquet, model_dir=args.model_dir, output=args.output,
+                     hidden=args.hidden, epochs=args.epochs, max_rows=args.max_rows,
+                     synthetic_rows=args.synthetic_rows, latency_requests=args.latency_requests,
+                     batch_size=args.batch_size, cache_dir=args.cache_dir, seed=args.seed)
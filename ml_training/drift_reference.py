@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Build the reference distribution for the prediction API drift monitor
+
+Bins every serving feature of a training snapshot (deciles for continuous
+features, one bin per value for low-cardinality ones) and records the
+proportion of TRAIN rows in each bin, plus the class distribution the
+hierarchical models predict on the same rows. The API's drift monitor
+(tens_prediction_api/drift.py) compares live sketches against this file.
+
+Usage:
+    python ml_training/drift_reference.py
+    python ml_training/drift_reference.py --label-reference --output models/drift_reference.json
+"""
+import argparse
+import json
+import os
+from datetime import datetime
+
+import joblib
+import numpy as np
+from google.cloud import bigquery
+
+from features import HEADS, PROJECT_ID, load_training_frame, prepare_features
+
+N_BINS = 10
+
+# Hierarchical inference (same rule as the API's LightGBM backend)
+MODE_CONFIDENCE_THRESHOLD = 0.5
+FALLBACK_TENS_LEVEL = 4
+
+
+def bin_edges(values, n_bins=N_BINS):
+    """Quantile edges, or midpoints between values for low-cardinality features"""
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return []
+    unique = np.unique(values)
+    if len(unique) <= n_bins:
+        return ((unique[:-1] + unique[1:]) / 2).tolist()
+    quantiles = np.quantile(values, np.linspace(0, 1, n_bins + 1)[1:-1])
+    return np.unique(quantiles).tolist()
+
+
+def feature_reference(values, edges):
+    present = values[~np.isnan(values)]
+    counts = np.bincount(np.searchsorted(edges, present, side='left'), minlength=len(edges) + 1)
+    return {
+        'edges': edges,
+        'expected': (counts / max(len(present), 1)).tolist(),
+        'missing_rate': float(1 - len(present) / max(len(values), 1)),
+    }
+
+
+def predicted_classes(X, model_dir):
+    """Class predictions of the hierarchical LightGBM models on X"""
+    heat_model = joblib.load(os.path.join(model_dir, 'heat_level_model.pkl'))
+    mode_model = joblib.load(os.path.join(model_dir, 'tens_mode_model.pkl'))
+    tens_model = joblib.load(os.path.join(model_dir, 'tens_level_model.pkl'))
+
+    heat = heat_model.predict(X)
+    mode_proba = mode_model.predict_proba(X)
+    mode = mode_model.classes_[mode_proba.argmax(axis=1)]
+    tens = np.where(mode == 0, 0, FALLBACK_TENS_LEVEL)
+    confident = (mode > 0) & (mode_proba.max(axis=1) >= MODE_CONFIDENCE_THRESHOLD)
+    if confident.any():
+        tens[confident] = tens_model.predict(X[confident])
+    return {'heat': heat, 'mode': mode, 'tens': tens}
+
+
+def build_reference(df, feature_columns, model_dir=None, source=None):
+    df_encoded, _ = prepare_features(df)
+    train = df_encoded[df_encoded['data_split'] == 'TRAIN']
+
+    # Columns the snapshot does not produce stay missing, as they are at serving time
+    X = np.full((len(train), len(feature_columns)), np.nan, dtype=np.float32)
+    for i, col in enumerate(feature_columns):
+        if col in train.columns:
+            X[:, i] = train[col].to_numpy(dtype=np.float32)
+
+    features = {col: feature_reference(X[:, i], bin_edges(X[:, i])) for i, col in enumerate(feature_columns)}
+
+    if model_dir:
+        classes = predicted_classes(X, model_dir)
+        prediction_source = 'lightgbm_hierarchical'
+    else:
+        classes = {head: train[config['target']].to_numpy() for head, config in HEADS.items()}
+        prediction_source = 'training_labels'
+    predictions = {
+        head: (np.bincount(classes[head].astype(int), minlength=config['num_class'])[:config['num_class']]
+               / len(classes[head])).tolist()
+        for head, config in HEADS.items()
+    }
+
+    return {
+        'source': source,
+        'created_at': datetime.now().isoformat(),
+        'rows': int(len(train)),
+        'n_bins': N_BINS,
+        'feature_columns': list(feature_columns),
+        'features': features,
+        'prediction_source': prediction_source,
+        'predictions': predictions,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the drift-monitor reference distribution')
+    parser.add_argument('--refresh-data', action='store_true', help='Re-export the cached training data')
+    parser.add_argument('--model-dir', default='models/hierarchical_approach',
+                        help='Hierarchical models for the prediction reference (feature_columns.pkl is always read)')
+    parser.add_argument('--label-reference', action='store_true',
+                        help='Use training label distributions instead of model predictions')
+    parser.add_argument('--output', default='models/drift_reference.json')
+    args = parser.parse_args()
+
+    client = bigquery.Client(project=PROJECT_ID)
+    df = load_training_frame(client, refresh=args.refresh_data)
+    source = f"ml_features_v1@{datetime.now().strftime('%Y%m%d')}"
+
+    feature_columns = list(joblib.load(os.path.join(args.model_dir, 'feature_columns.pkl')))
+    print(f"📊 Building drift reference over {len(feature_columns)} features from {source}...")
+    reference = build_reference(df, feature_columns,
+                                model_dir=None if args.label_reference else args.model_dir,
+                                source=source)
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(reference, f, indent=2)
+    print(f"✅ Reference saved: {args.output} ({reference['rows']:,} TRAIN rows, predictions from {reference['prediction_source']})")
@@ -0,0 +1,104 @@
+"""
+Shared feature engineering for the hierarchical heat / mode / level models
+Reads the leakage-free features of gold.ml_features_v1 (maintained incrementally
+by dataform/definitions/ml_features_v1.sqlx) and applies the preprocessing used in
+hierarchical_classification_xgboost.ipynb, so offline tools train on exactly the
+same feature matrix as the notebook.
+"""
+import numpy as np
+import pandas as pd
+
+PROJECT_ID = 'junoplus-dev'
+REGION = 'us-central1'
+FEATURE_TABLE = f'{PROJECT_ID}.junoplus_analytics_gold.ml_features_v1'
+
+# Feature rows are computed once per session by the ml_features_v1 Dataform model
+# (leakage fixed: no target_* / final_* derived inputs, user history from past sessions only)
+FEATURE_QUERY = f"""
+SELECT session_id AS sessionId, * EXCEPT(session_id, session_date, last_updated)
+FROM `{FEATURE_TABLE}`
+"""
+
+TARGET_COLS = ['y_heat', 'y_mode', 'y_tens']
+ID_COLS = ['sessionId', 'userId', 'therapyStartTime', 'data_split']
+
+ENCODE_COLS = ['device_size', 'time_of_day_category', 'cycle_phase_estimated',
+               'age_group', 'user_experience_level', 'cycle_period', 'pain_severity']
+
+# Users almost never change mode/level mid-session, so these reconstruct the target
+LEAKY_FEATURES = ['initial_tens_mode', 'initial_tens_level']
+
+# Hierarchy heads: Stage 1 (heat, mode) on all sessions, Stage 2 (tens) on Mode > 0
+HEADS = {
+    'heat': {'target': 'y_heat', 'num_class': 4, 'active_only': False},
+    'mode': {'target': 'y_mode', 'num_class': 4, 'active_only': False},
+    'tens': {'target': 'y_tens', 'num_class': 11, 'active_only': True},
+}
+
+
+def load_training_frame(client, use_cache=True, refresh=False):
+    """Return the raw session dataframe for the feature query.
+
+    By default the result is served from the local Arrow cache (data_cache.py),
+    keyed by the source table version and the query text.
+    """
+    if use_cache:
+        from data_cache import load_dataframe
+        df = load_dataframe('ml_features_v1', query=FEATURE_QUERY, client=client, refresh=refresh)
+    else:
+        df = client.query(FEATURE_QUERY).to_dataframe()
+    df.rename(columns={'user_id': 'userId'}, inplace=True)
+    return df
+
+
+def prepare_features(df):
+    """Fill missing values and one-hot encode, as in the notebook.
+
+    Returns (df_encoded, feature_cols).
+    """
+    df = df.copy()
+
+    numerical_cols = [col for col in df.select_dtypes(include=[np.number]).columns
+                      if col not in TARGET_COLS + ID_COLS]
+    for col in numerical_cols:
+        if df[col].isnull().any():
+            df[col] = df[col].fillna(df[col].median())
+
+    categorical_cols = [col for col in df.select_dtypes(include=['object', 'category']).columns
+                        if col not in ID_COLS]
+    for col in categorical_cols:
+        if df[col].isnull().any():
+            if isinstance(df[col].dtype, pd.CategoricalDtype) and 'Unknown' not in df[col].cat.categories:
+                df[col] = df[col].cat.add_categories('Unknown')
+            df[col] = df[col].fillna('Unknown')
+
+    # Cached frames carry categoricals; sort categories so get_dummies(drop_first=True)
+    # drops the same level as it does for object columns
+    for col in ENCODE_COLS:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].cat.remove_unused_categories()
+            df[col] = df[col].cat.reorder_categories(sorted(df[col].cat.categories))
+
+    df_encoded = pd.get_dummies(df, columns=ENCODE_COLS, drop_first=True, dtype=int)
+
+    feature_cols = [col for col in df_encoded.columns
+                    if col not in ID_COLS + TARGET_COLS + LEAKY_FEATURES]
+    return df_encoded, feature_cols
+
+
+def head_mask(df, head, split):
+    """Boolean row mask for a head's rows within a data split"""
+    mask = (df['data_split'] == split).to_numpy()
+    if HEADS[head]['active_only']:
+        mask &= (df['y_mode'] > 0).to_numpy()
+    return mask
+
+
+def balanced_weights(y, num_class):
+    """Per-row weights equivalent to class_weight='balanced'"""
+    y = np.asarray(y, dtype=int)
+    counts = np.bincount(y, minlength=num_class).astype(float)
+    present = counts > 0
+    class_weight = np.zeros(num_class)
+    class_weight[present] = len(y) / (present.sum() * counts[present])
+    return class_weight[y]
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Parallel hyperparameter search for the hierarchical heat / mode / level heads
+
+Replaces the hand-tuned LightGBM settings from the notebook
+(n_estimators=500, learning_rate=0.01, num_leaves=50, ...) with a random
+search that:
+  - runs trials concurrently in a process pool
+  - prunes trials whose intermediate eval multi_logloss is worse than the
+    median of other trials at the same iteration
+  - bins each head's training data once and shares the binary Dataset
+    between all trials
+  - records the outcome in gold.experiment_registry
+
+Usage:
+    python ml_training/hparam_search.py
+    python ml_training/hparam_search.py --trials 60 --workers 8 --heads mode tens
+    python ml_training/hparam_search.py --streaming   # out-of-core binning (streaming_data.py)
+"""
+import argparse
+import json
+import math
+import os
+import random
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from multiprocessing import Manager
+
+import lightgbm as lgb
+from google.cloud import bigquery
+
+from features import (HEADS, PROJECT_ID, REGION, balanced_weights, head_mask,
+                      load_training_frame, prepare_features)
+
+DATASET_GOLD = 'junoplus_analytics_gold'
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.cache/junoai/hparam_search')
+
+MAX_BOOST_ROUNDS = 500
+EARLY_STOPPING_ROUNDS = 50
+
+# Binning is fixed per cached Dataset, so max_bin is not searched. Without pre-filtering
+# features are binned for any min_child_samples a trial samples (not just the default 20)
+DATASET_PARAMS = {'max_bin': 255, 'feature_pre_filter': False, 'verbose': -1}
+
+# Notebook baseline (bagging_freq added: subsample alone never enables bagging)
+BASE_PARAMS = {
+    'objective': 'multiclass',
+    'metric': ['multi_logloss', 'multi_error'],
+    'first_metric_only': True,
+    'learning_rate': 0.01,
+    'max_depth': 10,
+    'num_leaves': 50,
+    'min_child_samples': 20,
+    'bagging_fraction': 0.8,
+    'bagging_freq': 1,
+    'feature_fraction': 0.8,
+    'lambda_l1': 0.1,
+    'lambda_l2': 0.1,
+    'seed': 42,
+    'verbose': -1,
+}
+
+
+SEARCH_KEYS = ('learning_rate', 'num_leaves', 'max_depth', 'min_child_samples',
+               'bagging_fraction', 'feature_fraction', 'lambda_l1', 'lambda_l2')
+
+
+def _log_uniform(rng, low, high):
+    return math.exp(rng.uniform(math.log(low), math.log(high)))
+
+
+def sample_params(rng):
+    """Draw one configuration from the search space"""
+    return {
+        'learning_rate': _log_uniform(rng, 0.005, 0.1),
+        'num_leaves': rng.randint(15, 127),
+        'max_depth': rng.choice([-1, 6, 8, 10, 12]),
+        'min_child_samples': rng.randint(5, 60),
+        'bagging_fraction': rng.uniform(0.5, 1.0),
+        'feature_fraction': rng.uniform(0.5, 1.0),
+        'lambda_l1': _log_uniform(rng, 1e-3, 10.0),
+        'lambda_l2': _log_uniform(rng, 1e-3, 10.0),
+    }
+
+
+def build_dataset_cache(df_encoded, feature_cols, heads, cache_dir):
+    """Bin each head's train/eval data once and save as LightGBM binaries"""
+    os.makedirs(cache_dir, exist_ok=True)
+    paths = {}
+
+    for head in heads:
+        spec = HEADS[head]
+        train_mask = head_mask(df_encoded, head, 'TRAIN')
+        eval_mask = head_mask(df_encoded, head, 'EVAL')
+
+        X_train = df_encoded.loc[train_mask, feature_cols]
+        y_train = df_encoded.loc[train_mask, spec['target']].to_numpy()
+        X_eval = df_encoded.loc[eval_mask, feature_cols]
+        y_eval = df_encoded.loc[eval_mask, spec['target']].to_numpy()
+
+        train_set = lgb.Dataset(X_train, label=y_train,
+                                weight=balanced_weights(y_train, spec['num_class']),
+                                params=DATASET_PARAMS, free_raw_data=True)
+        # Eval set is unweighted, matching eval_set=[(X_eval, y_eval)] in the notebook
+        eval_set = lgb.Dataset(X_eval, label=y_eval, reference=train_set,
+                               params=DATASET_PARAMS, free_raw_data=True)
+
+        train_path = os.path.join(cache_dir, f'{head}_train.bin')
+        eval_path = os.path.join(cache_dir, f'{head}_eval.bin')
+        for path in (train_path, eval_path):
+            if os.path.exists(path):
+                os.remove(path)
+        train_set.save_binary(train_path)
+        eval_set.save_binary(eval_path)
+
+        paths[head] = (train_path, eval_path)
+        print(f"   💾 {head}: {len(y_train):,} train / {len(y_eval):,} eval rows binned")
+
+    return paths
+
+
+# Per-process state populated by the pool initializer
+_WORKER = {}
+
+
+def _init_worker(dataset_paths, shared_history, lock):
+    datasets = {}
+    for head, (train_path, eval_path) in dataset_paths.items():
+        train_set = lgb.Dataset(train_path, params=DATASET_PARAMS)
+        eval_set = lgb.Dataset(eval_path, reference=train_set, params=DATASET_PARAMS)
+        datasets[head] = (train_set, eval_set)
+    _WORKER['datasets'] = datasets
+    _WORKER['history'] = shared_history
+    _WORKER['lock'] = lock
+
+
+class MedianPruningCallback:
+    """Stop a trial whose eval multi_logloss is above the median of other
+    trials at the same iteration (checked every `interval` rounds)."""
+
+    def __init__(self, head, history, lock, warmup=50, interval=25, min_trials=4):
+        # lgb.train only reads the instance attribute (a class attribute gets overridden by its position)
+        self.order = 35  # after record_evaluation (20) and early_stopping (30)
+        self.head = head
+        self.history = history
+        self.lock = lock
+        self.warmup = warmup
+        self.interval = interval
+        self.min_trials = min_trials
+        self.pruned_at = None
+
+    def __call__(self, env):
+        step = env.iteration + 1
+        if step < self.warmup or step % self.interval:
+            return
+
+        loss = env.evaluation_result_list[0][2]
+        key = f'{self.head}:{step}'
+        with self.lock:
+            others = list(self.history.get(key, []))
+            self.history[key] = others + [loss]
+
+        if len(others) < self.min_trials:
+            return
+        others.sort()
+        mid = len(others) // 2
+        median = others[mid] if len(others) % 2 else (others[mid - 1] + others[mid]) / 2
+        if loss > median:
+            self.pruned_at = step
+            raise lgb.callback.EarlyStopException(env.iteration, env.evaluation_result_list)
+
+
+def run_trial(trial):
+    """Train one configuration on the cached Dataset (runs in a worker)"""
+    head = trial['head']
+    spec = HEADS[head]
+    train_set, eval_set = _WORKER['datasets'][head]
+
+    params = {**BASE_PARAMS, **trial['params'],
+              'num_class': spec['num_class'],
+              'num_threads': trial['num_threads']}
+
+    pruner = MedianPruningCallback(head, _WORKER['history'], _WORKER['lock'])
+    evals = {}
+    start = time.perf_counter()
+    booster = lgb.train(
+        params,
+        train_set,
+        num_boost_round=MAX_BOOST_ROUNDS,
+        valid_sets=[eval_set],
+        valid_names=['eval'],
+        callbacks=[
+            lgb.record_evaluation(evals),
+            pruner,
+            lgb.early_stopping(stopping_rounds=EARLY_STOPPING_ROUNDS, first_metric_only=True, verbose=False),
+        ],
+    )
+    duration = time.perf_counter() - start
+
+    history = evals['eval']['multi_logloss']
+    best_iteration = min(booster.best_iteration or len(history), len(history))
+    return {
+        'trial_id': trial['trial_id'],
+        'head': head,
+        'params': trial['params'],
+        'best_iteration': best_iteration,
+        'eval_logloss': history[best_iteration - 1],
+        'eval_accuracy': 1.0 - evals['eval']['multi_error'][best_iteration - 1],
+        'pruned': pruner.pruned_at is not None,
+        'pruned_at': pruner.pruned_at,
+        'duration_seconds': round(duration, 2),
+    }
+
+
+def run_search(df_encoded, feature_cols, heads=tuple(HEADS), n_trials=40, max_workers=None,
+               cache_dir=DEFAULT_CACHE_DIR, seed=42, streaming_data=None):
+    """Search each head's parameters; returns {head: [trial results sorted by eval logloss]}
+
+    With streaming_data (a streaming_data.StreamingTrainingData) the shared Datasets
+    are binned out of core and df_encoded / feature_cols are not used.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    threads_per_trial = max(1, (os.cpu_count() or 1) // max_workers)
+
+    print(f"🔧 Binning shared datasets into {cache_dir}...")
+    if streaming_data is not None:
+        dataset_paths = streaming_data.save_head_datasets(heads, cache_dir, DATASET_PARAMS)
+    else:
+        dataset_paths = build_dataset_cache(df_encoded, feature_cols, heads, cache_dir)
+
+    rng = random.Random(seed)
+    # Trial 0 of every head is the notebook's hand-tuned baseline
+    trials = []
+    for head in heads:
+        baseline = {key: BASE_PARAMS[key] for key in SEARCH_KEYS}
+        if head == 'tens':
+            baseline['min_child_samples'] = 15
+        trials.append({'trial_id': f'{head}_000', 'head': head, 'params': baseline})
+        for i in range(1, n_trials):
+            trials.append({'trial_id': f'{head}_{i:03d}', 'head': head, 'params': sample_params(rng)})
+    # Interleave heads so pruning history builds up evenly
+    trials.sort(key=lambda t: t['trial_id'].split('_')[1])
+    for trial in trials:
+        trial['num_threads'] = threads_per_trial
+
+    print(f"🚀 Running {len(trials)} trials on {max_workers} workers "
+          f"({threads_per_trial} thread(s) each)...")
+
+    results = {head: [] for head in heads}
+    with Manager() as manager:
+        history = manager.dict()
+        lock = manager.Lock()
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(dataset_paths, history, lock)) as pool:
+            futures = [pool.submit(run_trial, trial) for trial in trials]
+            for done, future in enumerate(as_completed(futures), start=1):
+                result = future.result()
+                results[result['head']].append(result)
+                status = f"pruned@{result['pruned_at']}" if result['pruned'] else f"iter {result['best_iteration']}"
+                print(f"   [{done:>3}/{len(trials)}] {result['trial_id']}: "
+                      f"logloss={result['eval_logloss']:.4f} acc={result['eval_accuracy']:.3f} ({status})")
+
+    # Completed trials rank ahead of pruned ones (pruned losses are from earlier iterations)
+    for head in heads:
+        results[head].sort(key=lambda r: (r['pruned'], r['eval_logloss']))
+    return results
+
+
+def persist_results(client, results, duration_seconds, project=PROJECT_ID, dataset=DATASET_GOLD):
+    """Record one experiment_registry row per head"""
+    experiment_date = datetime.now().strftime('%Y%m%d')
+    for head, trials in results.items():
+        if not trials:
+            continue
+        best = trials[0]
+        runner_up = trials[1] if len(trials) > 1 else trials[0]
+        experiment_id = f"hpsearch_{head}_{experiment_date}_{uuid.uuid4().hex[:8]}"
+
+        query = f"""
+        INSERT INTO `{project}.{dataset}.experiment_registry`
+        (experiment_id, experiment_name, objective, experiment_date, models_compared,
+         winner_model_id, human_decision, experiment_metadata, created_at, search_results)
+        VALUES (
+          @experiment_id,
+          @experiment_name,
+          'Minimise eval multi_logloss with median pruning',
+          CURRENT_DATE(),
+          @models_compared,
+          @winner,
+          STRUCT(@rationale AS rationale, 'Review before promoting' AS decision,
+                 'hparam_search' AS decided_by),
+          STRUCT(@winning_accuracy AS winning_accuracy, @runner_up_accuracy AS runner_up_accuracy,
+                 @training_time_minutes AS training_time_minutes,
+                 'user_hash_70_20_10' AS data_split_strategy),
+          CURRENT_TIMESTAMP(),
+          PARSE_JSON(@search_results)
+        )
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('experiment_id', 'STRING', experiment_id),
+            bigquery.ScalarQueryParameter('experiment_name', 'STRING', f'LightGBM {head} head search'),
+            bigquery.ArrayQueryParameter('models_compared', 'STRING', [t['trial_id'] for t in trials]),
+            bigquery.ScalarQueryParameter('winner', 'STRING', best['trial_id']),
+            bigquery.ScalarQueryParameter(
+                'rationale', 'STRING',
+                f"Lowest eval multi_logloss ({best['eval_logloss']:.4f}) of {len(trials)} trials"),
+            bigquery.ScalarQueryParameter('winning_accuracy', 'FLOAT64', best['eval_accuracy']),
+            bigquery.ScalarQueryParameter('runner_up_accuracy', 'FLOAT64', runner_up['eval_accuracy']),
+            bigquery.ScalarQueryParameter('training_time_minutes', 'INT64', round(duration_seconds / 60)),
+            bigquery.ScalarQueryParameter('search_results', 'STRING', json.dumps(trials)),
+        ])
+        client.query(query, job_config=job_config).result()
+        print(f"   ✅ {head}: registered {experiment_id}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Parallel LightGBM search for the hierarchical heads')
+    parser.add_argument('--trials', type=int, default=40, help='Trials per head')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--heads', nargs='+', choices=list(HEADS), default=list(HEADS))
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Where binned Datasets are stored')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--refresh-data', action='store_true', help='Re-export training data instead of using the local cache')
+    parser.add_argument('--no-registry', action='store_true', help='Skip writing to experiment_registry')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Bin from the Arrow cache out of core with native categoricals (streaming_data.py)')
+    args = parser.parse_args()
+
+    client = bigquery.Client(project=PROJECT_ID, location=REGION)
+
+    print("🔄 Loading training data...")
+    streaming_data = None
+    if args.streaming:
+        from features import FEATURE_QUERY
+        from streaming_data import StreamingTrainingData
+        streaming_data = StreamingTrainingData.from_cache('ml_features_v1', query=FEATURE_QUERY, client=client,
+                                                          refresh=args.refresh_data)
+        df_encoded, feature_cols = None, streaming_data.feature_cols
+        print(f"✅ {streaming_data.num_rows:,} sessions, {len(feature_cols)} features "
+              f"({len(streaming_data.categorical_cols)} native categorical)")
+    else:
+        df_encoded, feature_cols = prepare_features(load_training_frame(client, refresh=args.refresh_data))
+        print(f"✅ {len(df_encoded):,} sessions, {len(feature_cols)} features")
+
+    start = time.perf_counter()
+    results = run_search(df_encoded, feature_cols, heads=args.heads, n_trials=args.trials,
+                         max_workers=args.workers, cache_dir=args.cache_dir, seed=args.seed,
+                         streaming_data=streaming_data)
+    duration = time.perf_counter() - start
+
+    print()
+    print("=" * 60)
+    print(f"📊 SEARCH SUMMARY ({duration / 60:.1f} min)")
+    print("=" * 60)
+    for head, trials in results.items():
+        best = trials[0]
+        pruned = sum(1 for t in trials if t['pruned'])
+        print(f"{head}: best {best['trial_id']} logloss={best['eval_logloss']:.4f} "
+              f"acc={best['eval_accuracy']:.3f} ({pruned}/{len(trials)} pruned)")
+        print(f"   params: {json.dumps(best['params'])}")
+
+    with open(os.path.join(args.cache_dir, 'search_results.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if not args.no_registry:
+        print()
+        print("📝 Writing experiment_registry...")
+        persist_results(client, results, duration)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+Out-of-core LightGBM training data for the hierarchical heads
+
+Builds lgb.Dataset objects straight from Arrow record batches (a data_cache.py
+entry or Parquet files) instead of a pandas frame + get_dummies + per-split copies:
+  - every file is an lgb.Sequence that decodes one block of rows at a time into a
+    dense matrix, so LightGBM samples its bin boundaries and pushes rows block by block
+  - string columns become integer codes and are passed as native categorical
+    features (no one-hot columns)
+  - labels, data_split and the active-mode flag are small numpy arrays; each head's
+    TRAIN / EVAL / TEST rows are index subsets of one binned Dataset, not copies
+
+Peak memory is about one binned copy of the data (one byte per feature per row
+with max_bin <= 255) plus one decoded block per file. Cache files are memory-mapped.
+
+Binning differs from the notebook path in two ways: bin boundaries are sampled from
+all rows (labels are not used), and missing values stay missing (LightGBM handles
+them natively) instead of being median / 'Unknown' filled. Models trained on these
+Datasets use native categoricals, so their feature_columns differ from the served
+one-hot models.
+
+Usage:
+    python ml_training/streaming_data.py                             # features.FEATURE_QUERY via the cache
+    python ml_training/streaming_data.py --parquet /data/ml_features/ --heads tens
+    python ml_training/streaming_data.py --save-dir /tmp/bins        # LightGBM binaries per head / split
+"""
+import argparse
+import glob
+import json
+import os
+import resource
+import time
+
+import lightgbm as lgb
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+from features import HEADS, ID_COLS, LEAKY_FEATURES, TARGET_COLS, balanced_weights
+
+BLOCK_ROWS = 65_536
+SPLITS = ('TRAIN', 'EVAL', 'TEST')
+
+# Columns that are never model inputs (the cache keeps the query's user_id name)
+NON_FEATURE_COLS = set(ID_COLS + TARGET_COLS + LEAKY_FEATURES) | {'user_id', 'session_id', 'session_date'}
+
+
+class _IpcSource:
+    """Memory-mapped Arrow IPC file; blocks are record batches cut to BLOCK_ROWS"""
+
+    def __init__(self, path, block_rows):
+        self.path = path
+        self.reader = ipc.open_file(pa.memory_map(path, 'r'))
+        self.schema = self.reader.schema
+        self.blocks = []
+        for i in range(self.reader.num_record_batches):
+            rows = self.reader.get_batch(i).num_rows
+            self.blocks += [(i, start, min(block_rows, rows - start)) for start in range(0, rows, block_rows)]
+
+    def read(self, block, columns):
+        batch_index, start, length = self.blocks[block]
+        batch = self.reader.get_batch(batch_index).slice(start, length)
+        return [batch.column(self.schema.get_field_index(name)) for name in columns]
+
+
+class _ParquetSource:
+    """Parquet file; blocks are row groups (read whole, then sliced to BLOCK_ROWS)"""
+
+    def __init__(self, path, block_rows):
+        self.path = path
+        self.file = pq.ParquetFile(path, memory_map=True)
+        self.schema = self.file.schema_arrow
+        self._group = (None, None, None)
+        self.blocks = []
+        for group in range(self.file.num_row_groups):
+            rows = self.file.metadata.row_group(group).num_rows
+            self.blocks += [(group, start, min(block_rows, rows - start)) for start in range(0, rows, block_rows)]
+
+    def read(self, block, columns):
+        group, start, length = self.blocks[block]
+        if self._group[:2] != (group, columns):
+            self._group = (group, columns, self.file.read_row_group(group, columns=columns))
+        table = self._group[2].slice(start, length)
+        return [table.column(name) for name in columns]
+
+
+def _block_rows(source):
+    return [length for _, _, length in source.blocks]
+
+
+def _chunks(column):
+    return column.chunks if isinstance(column, pa.ChunkedArray) else [column]
+
+
+def _is_categorical(dtype):
+    if pa.types.is_dictionary(dtype):
+        dtype = dtype.value_type
+    return pa.types.is_string(dtype) or pa.types.is_large_string(dtype)
+
+
+def _is_numeric(dtype):
+    return pa.types.is_integer(dtype) or pa.types.is_floating(dtype) or pa.types.is_boolean(dtype)
+
+
+def _encode_categorical(column, levels):
+    """Global category codes (float32, NaN for nulls / unseen values) of a string or dictionary column"""
+    parts = []
+    for chunk in _chunks(column):
+        if not pa.types.is_dictionary(chunk.type):
+            chunk = pc.dictionary_encode(chunk)
+        lookup = np.array([levels.get(v, np.nan) for v in chunk.dictionary.to_pylist()] or [np.nan],
+                          dtype=np.float32)
+        indices = chunk.indices.fill_null(0).to_numpy(zero_copy_only=False)
+        codes = lookup[indices]
+        if chunk.null_count:
+            codes[chunk.is_null().to_numpy(zero_copy_only=False)] = np.nan
+        parts.append(codes)
+    return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+
+def _to_float32(column):
+    return np.asarray(pc.cast(column, pa.float32()).to_numpy(zero_copy_only=False), dtype=np.float32)
+
+
+class ArrowSequence(lgb.Sequence):
+    """One source file as LightGBM rows; keeps only the last decoded block"""
+
+    def __init__(self, source, data, batch_size=BLOCK_ROWS):
+        self.source = source
+        self.data = data
+        self.batch_size = batch_size
+        self.offsets = np.concatenate([[0], np.cumsum(_block_rows(source))]).astype(np.int64)
+        self._cached = (None, None)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def _block(self, block):
+        if self._cached[0] != block:
+            self._cached = (block, self.data.decode(self.source, block))
+        return self._cached[1]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            block = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+            return self._block(block)[idx - self.offsets[block]]
+        start, stop, _ = idx.indices(len(self))
+        parts = []
+        while start < stop:
+            block = int(np.searchsorted(self.offsets, start, side='right')) - 1
+            end = min(stop, int(self.offsets[block + 1]))
+            parts.append(self._block(block)[start - self.offsets[block]:end - self.offsets[block]])
+            start = end
+        if not parts:
+            return np.empty((0, len(self.data.feature_cols)), dtype=np.float64)
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+
+class StreamingTrainingData:
+    """
+    Training rows spread over Arrow / Parquet files, exposed as one binned
+    LightGBM Dataset plus per-head index subsets.
+    """
+
+    def __init__(self, paths, feature_cols=None, block_rows=BLOCK_ROWS):
+        self.block_rows = block_rows
+        self.sources = [(_ParquetSource if path.endswith('.parquet') else _IpcSource)(path, block_rows)
+                        for path in paths]
+        if not self.sources:
+            raise ValueError("No data files given")
+        schema = self.sources[0].schema
+        self.feature_cols = feature_cols or [
+            f.name for f in schema
+            if f.name not in NON_FEATURE_COLS and (_is_numeric(f.type) or _is_categorical(f.type))
+        ]
+        self.categorical_cols = [c for c in self.feature_cols if _is_categorical(schema.field(c).type)]
+        self._scan()
+        self._binned = None
+
+    @classmethod
+    def from_cache(cls, snapshot_id, query=None, client=None, refresh=False, **kwargs):
+        """Files of a data_cache.py entry (exported first if needed)"""
+        from data_cache import export, invalidate
+        from google.cloud import bigquery
+
+        client = client or bigquery.Client()
+        if refresh:
+            invalidate(client, snapshot_id, query=query)
+        entry_dir = export(client, snapshot_id, query=query)
+        with open(os.path.join(entry_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        return cls([os.path.join(entry_dir, file_info['path']) for file_info in manifest['files']], **kwargs)
+
+    @classmethod
+    def from_parquet(cls, path, **kwargs):
+        """A Parquet file or every *.parquet below a directory"""
+        paths = [path] if os.path.isfile(path) else sorted(glob.glob(os.path.join(path, '**', '*.parquet'),
+                                                                     recursive=True))
+        return cls(paths, **kwargs)
+
+    def _scan(self):
+        """One pass over the label / split / categorical columns (never the full rows)"""
+        columns = TARGET_COLS + ['data_split']
+        values = {col: [] for col in columns}
+        levels = {col: set() for col in self.categorical_cols}
+        for source in self.sources:
+            for block in range(len(source.blocks)):
+                read = dict(zip(columns + self.categorical_cols,
+                                source.read(block, columns + self.categorical_cols)))
+                for col in TARGET_COLS:
+                    values[col].append(_to_float32(read[col]))
+                values['data_split'].append(_encode_categorical(read['data_split'], {s: i for i, s in enumerate(SPLITS)}))
+                for col in self.categorical_cols:
+                    for chunk in _chunks(read[col]):
+                        dictionary = chunk.dictionary if pa.types.is_dictionary(chunk.type) else pc.unique(chunk)
+                        levels[col].update(v for v in dictionary.to_pylist() if v is not None)
+
+        # Sorted levels, so codes are stable across runs and sources
+        self.levels = {col: {v: i for i, v in enumerate(sorted(levels[col]))} for col in self.categorical_cols}
+        self.labels = {col: np.concatenate(values[col]) for col in TARGET_COLS}
+        self.split = np.concatenate(values['data_split'])
+        self.num_rows = len(self.split)
+
+    def decode(self, source, block):
+        """float64 matrix (rows x feature_cols) of one block (LightGBM samples bins from doubles)"""
+        matrix = np.empty((source.blocks[block][2], len(self.feature_cols)), dtype=np.float64)
+        for j, (name, column) in enumerate(zip(self.feature_cols, source.read(block, self.feature_cols))):
+            if name in self.levels:
+                matrix[:, j] = _encode_categorical(column, self.levels[name])
+            else:
+                matrix[:, j] = _to_float32(column)
+        return matrix
+
+    def indices(self, head, split):
+        """Row indices of a head's rows within a data split (mirrors features.head_mask)"""
+        mask = self.split == SPLITS.index(split)
+        if HEADS[head]['active_only']:
+            mask &= self.labels['y_mode'] > 0
+        return np.flatnonzero(mask)
+
+    def binned_dataset(self, params=None):
+        """The one binned Dataset every head / split subset shares (built on first use)"""
+        if self._binned is None:
+            # Without pre-filtering, trainers can use any min_child_samples on the shared bins
+            params = {'verbose': -1, **(params or {}), 'feature_pre_filter': False}
+            self._binned = lgb.Dataset(
+                [ArrowSequence(source, self, self.block_rows) for source in self.sources],
+                label=self.labels['y_heat'],
+                feature_name=self.feature_cols,
+                categorical_feature=self.categorical_cols,
+                params=params,
+                free_raw_data=True,
+            ).construct()
+        return self._binned
+
+    def head_dataset(self, head, split, params=None, weighted=None):
+        """Constructed subset Dataset of a head's split; TRAIN is class-balanced like the notebook"""
+        spec = HEADS[head]
+        rows = self.indices(head, split)
+        if len(rows) == 0:
+            raise ValueError(f"No {split} rows for head {head}")
+        y = self.labels[spec['target']][rows].astype(np.int32)
+        subset = self.binned_dataset(params).subset(rows).construct()
+        subset.set_label(y)
+        if weighted if weighted is not None else split == 'TRAIN':
+            subset.set_weight(balanced_weights(y, spec['num_class']))
+        return subset
+
+    def head_datasets(self, head, params=None):
+        """(train_set, eval_set) for lgb.train(..., valid_sets=[eval_set])"""
+        return self.head_dataset(head, 'TRAIN', params), self.head_dataset(head, 'EVAL', params)
+
+    def save_head_datasets(self, heads, cache_dir, params=None):
+        """Save each head's train / eval subsets as LightGBM binaries (hparam_search's dataset cache)"""
+        os.makedirs(cache_dir, exist_ok=True)
+        paths = {}
+        for head in heads:
+            train_set, eval_set = self.head_datasets(head, params)
+            train_path = os.path.join(cache_dir, f'{head}_train.bin')
+            eval_path = os.path.join(cache_dir, f'{head}_eval.bin')
+            for path in (train_path, eval_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            train_set.save_binary(train_path)
+            eval_set.save_binary(eval_path)
+            paths[head] = (train_path, eval_path)
+            print(f"   💾 {head}: {train_set.num_data():,} train / {eval_set.num_data():,} eval rows binned")
+        return paths
+
+    def predict(self, booster, rows):
+        """booster.predict for the given row indices, decoding one block at a time"""
+        rows = np.sort(np.asarray(rows))
+        predictions = []
+        offset = 0
+        for source in self.sources:
+            for block, (_, _, length) in enumerate(source.blocks):
+                lo, hi = np.searchsorted(rows, [offset, offset + length])
+                if hi > lo:
+                    predictions.append(booster.predict(self.decode(source, block)[rows[lo:hi] - offset]))
+                offset += length
+        return np.concatenate(predictions) if predictions else np.empty((0,))
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Bin training data out of core for the hierarchical heads')
+    parser.add_argument('--parquet', help='Parquet file or directory (default: features.FEATURE_QUERY via the cache)')
+    parser.add_argument('--heads', nargs='+', choices=list(HEADS), default=list(HEADS))
+    parser.add_argument('--block-rows', type=int, default=BLOCK_ROWS)
+    parser.add_argument('--max-bin', type=int, default=255)
+    parser.add_argument('--save-dir', help='Write <head>_train.bin / <head>_eval.bin here')
+    parser.add_argument('--refresh-data', action='store_true', help='Re-export training data instead of using the local cache')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.parquet:
+        data = StreamingTrainingData.from_parquet(args.parquet, block_rows=args.block_rows)
+    else:
+        from features import FEATURE_QUERY, PROJECT_ID
+        from google.cloud import bigquery
+        data = StreamingTrainingData.from_cache('ml_features_v1', query=FEATURE_QUERY,
+                                                client=bigquery.Client(project=PROJECT_ID),
+                                                refresh=args.refresh_data, block_rows=args.block_rows)
+    print(f"📦 {data.num_rows:,} rows in {len(data.sources)} file(s), {len(data.feature_cols)} features "
+          f"({len(data.categorical_cols)} categorical)")
+
+    params = {'max_bin': args.max_bin, 'verbose': -1}
+    binned = data.binned_dataset(params)
+    print(f"🔧 Binned in {time.perf_counter() - start:.1f}s, peak RSS {peak_rss_mb():,.0f} MB")
+
+    if args.save_dir:
+        data.save_head_datasets(args.heads, args.save_dir, params)
+    else:
+        for head in args.heads:
+            print(f"   {head}: " + ', '.join(f"{split} {len(data.indices(head, split)):,}" for split in SPLITS))
+    print(f"✅ Done in {time.perf_counter() - start:.1f}s, peak RSS {peak_rss_mb():,.0f} MB")
@@ -0,0 +1,43 @@
+import os
+import sys
+import threading
+
+import lightgbm as lgb
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import hparam_search  # noqa: E402
+
+
+def _cache_mode_datasets(directory):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(2000, 6))
+    X[:, 5] = np.arange(2000) % 150 == 0  # too rare to split on with the default min_child_samples (20)
+    y = (X[:, 0] > 0).astype(int) + (X[:, 1] > 0.5).astype(int) + rng.integers(0, 2, size=2000)
+    train_set = lgb.Dataset(X[:1500], label=y[:1500], params=hparam_search.DATASET_PARAMS)
+    eval_set = lgb.Dataset(X[1500:], label=y[1500:], reference=train_set, params=hparam_search.DATASET_PARAMS)
+    paths = (os.path.join(directory, 'mode_train.bin'), os.path.join(directory, 'mode_eval.bin'))
+    train_set.save_binary(paths[0])
+    eval_set.save_binary(paths[1])
+    return {'mode': paths}
+
+
+def test_trial_is_pruned_against_better_trials(tmp_path):
+    # Four earlier trials that were far better at the first pruning check (iteration 50)
+    history = {'mode:50': [0.01, 0.02, 0.03, 0.04]}
+    hparam_search._init_worker(_cache_mode_datasets(str(tmp_path)), history, threading.Lock())
+
+    # The worker's Datasets are constructed by the first trial (baseline min_child_samples 20);
+    # a later trial with a smaller min_child_samples must still train on them
+    hparam_search.run_trial({'trial_id': 'mode_000', 'head': 'mode', 'num_threads': 1, 'params': {}})
+    result = hparam_search.run_trial({
+        'trial_id': 'mode_001', 'head': 'mode', 'num_threads': 1,
+        'params': {'min_child_samples': 5, 'num_leaves': 15},
+    })
+
+    assert result['pruned']
+    assert result['pruned_at'] == 50
+    assert 1 <= result['best_iteration'] <= 50
+    assert result['eval_logloss'] > 0.04
+    assert len(history['mode:50']) == 6
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Export the multi-output network to a single ONNX graph for CPU serving
+
+Fuses the notebook's StandardScaler into the converted Keras model:
+
+    features (float32, N x F, NaN = missing)
+      -> IsNaN / Where   (missing values imputed with the training mean)
+      -> Sub(mean) / Div(scale)
+      -> shared layers -> heat_output (4) / mode_output (4) / tens_output (11)
+
+The feature column order is stored in the model metadata so the prediction
+API can build input vectors without the pickles. The export is checked with
+onnx.checker and against Keras predictions before it is written.
+
+Usage:
+    python multioutput_deeplearning_approach/export_onnx.py
+    python multioutput_deeplearning_approach/export_onnx.py --model-dir models/multioutput_approach --opset 17
+"""
+import argparse
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import joblib
+import numpy as np
+import onnx
+import onnxruntime as ort
+import tensorflow as tf
+import tf2onnx
+from onnx import TensorProto, helper, numpy_helper
+
+OUTPUT_NAMES = ['heat_output', 'mode_output', 'tens_output']
+INPUT_NAME = 'features'
+
+
+def convert_keras(model, n_features, opset):
+    """Keras -> ONNX with the outputs named after the Keras heads"""
+    spec = (tf.TensorSpec((None, n_features), tf.float32, name='input'),)
+    onnx_model, _ = tf2onnx.convert.from_keras(model, input_signature=spec, opset=opset)
+
+    graph = onnx_model.graph
+    for output, name in zip(list(graph.output), model.output_names):
+        if output.name != name:
+            graph.node.append(helper.make_node('Identity', [output.name], [name], name=f'{name}_identity'))
+            output.name = name
+    return onnx_model
+
+
+def fuse_scaler(onnx_model, scaler):
+    """Prepend NaN imputation and standard scaling to the graph input"""
+    graph = onnx_model.graph
+    original_input = graph.input[0]
+    n_features = len(scaler.mean_)
+
+    mean = scaler.mean_.astype(np.float32)
+    scale = scaler.scale_.astype(np.float32)
+    graph.initializer.extend([
+        numpy_helper.from_array(mean, name='scaler_mean'),
+        numpy_helper.from_array(scale, name='scaler_scale'),
+    ])
+
+    preprocessing = [
+        helper.make_node('IsNaN', [INPUT_NAME], ['features_is_nan'], name='impute_is_nan'),
+        helper.make_node('Where', ['features_is_nan', 'scaler_mean', INPUT_NAME], ['features_imputed'],
+                         name='impute_mean'),
+        helper.make_node('Sub', ['features_imputed', 'scaler_mean'], ['features_centered'], name='scaler_sub'),
+        helper.make_node('Div', ['features_centered', 'scaler_scale'], ['features_scaled'], name='scaler_div'),
+    ]
+
+    # Rewire consumers of the Keras input to the scaled tensor
+    for node in graph.node:
+        for i, name in enumerate(node.input):
+            if name == original_input.name:
+                node.input[i] = 'features_scaled'
+
+    nodes = preprocessing + list(graph.node)
+    del graph.node[:]
+    graph.node.extend(nodes)
+
+    graph.input.remove(original_input)
+    graph.input.insert(0, helper.make_tensor_value_info(INPUT_NAME, TensorProto.FLOAT, ['batch', n_features]))
+    return onnx_model
+
+
+def check_parity(onnx_path, keras_model, scaler, samples=512, seed=42, atol=1e-4):
+    """Compare onnxruntime and Keras on synthetic inputs around the training distribution"""
+    rng = np.random.default_rng(seed)
+    X = (scaler.mean_ + scaler.scale_ * rng.standard_normal((samples, len(scaler.mean_)))).astype(np.float32)
+
+    session = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+    onnx_outputs = session.run(OUTPUT_NAMES, {INPUT_NAME: X})
+    keras_outputs = keras_model.predict(scaler.transform(X).astype(np.float32), verbose=0)
+
+    report = {}
+    for name, onnx_out, keras_out in zip(OUTPUT_NAMES, onnx_outputs, keras_outputs):
+        max_diff = float(np.abs(onnx_out - keras_out).max())
+        agreement = float((onnx_out.argmax(axis=1) == keras_out.argmax(axis=1)).mean())
+        report[name] = {'max_abs_diff': max_diff, 'argmax_agreement': agreement}
+        if max_diff > atol:
+            raise AssertionError(f"{name}: ONNX differs from Keras by {max_diff:.2e} (> {atol:.0e})")
+
+    # Missing values must behave like the training mean
+    X_missing = X[:1].copy()
+    X_missing[0, :] = np.nan
+    X_mean = scaler.mean_.astype(np.float32)[None, :]
+    for name, missing_out, mean_out in zip(OUTPUT_NAMES, session.run(OUTPUT_NAMES, {INPUT_NAME: X_missing}),
+                                           session.run(OUTPUT_NAMES, {INPUT_NAME: X_mean})):
+        if not np.allclose(missing_out, mean_out, atol=atol):
+            raise AssertionError(f"{name}: NaN imputation does not match the training mean")
+    return report
+
+
+def export(model_dir, output_path=None, opset=17, model_version=None):
+    output_path = output_path or os.path.join(model_dir, 'multioutput_model.onnx')
+    keras_path = os.path.join(model_dir, 'final_model.h5')
+
+    keras_model = tf.keras.models.load_model(keras_path, compile=False)
+    scaler = joblib.load(os.path.join(model_dir, 'feature_scaler.pkl'))
+    feature_cols = list(joblib.load(os.path.join(model_dir, 'feature_columns.pkl')))
+    if len(feature_cols) != len(scaler.mean_):
+        raise ValueError(f"{len(feature_cols)} feature columns but the scaler has {len(scaler.mean_)} features")
+
+    print(f"🔄 Converting {keras_path} ({len(feature_cols)} features, opset {opset})...")
+    onnx_model = fuse_scaler(convert_keras(keras_model, len(feature_cols), opset), scaler)
+
+    with open(keras_path, 'rb') as f:
+        source_hash = hashlib.sha256(f.read()).hexdigest()[:12]
+    metadata = {
+        'feature_columns': json.dumps(feature_cols),
+        'outputs': json.dumps(OUTPUT_NAMES),
+        'model_version': model_version or f"multioutput_onnx_{source_hash}",
+        'source_model_sha256': source_hash,
+        'exported_at': datetime.now().isoformat(),
+    }
+    del onnx_model.metadata_props[:]
+    for key, value in metadata.items():
+        onnx_model.metadata_props.append(onnx.StringStringEntryProto(key=key, value=value))
+
+    onnx.checker.check_model(onnx_model, full_check=True)
+    tmp_path = f"{output_path}.tmp"
+    onnx.save(onnx_model, tmp_path)
+
+    report = check_parity(tmp_path, keras_model, scaler)
+    os.replace(tmp_path, output_path)
+
+    print(f"✅ Exported {output_path} ({os.path.getsize(output_path) / 1024:.0f} KB)")
+    for name, stats in report.items():
+        print(f"   {name}: max |diff| {stats['max_abs_diff']:.2e}, argmax agreement {stats['argmax_agreement']:.1%}")
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the multi-output Keras model + scaler to ONNX')
+    parser.add_argument('--model-dir', default='models/multioutput_approach',
+                        help='Directory with final_model.h5, feature_scaler.pkl and feature_columns.pkl')
+    parser.add_argument('--output', help='Output path (default: <model-dir>/multioutput_model.onnx)')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--model-version', help='Version string stored in the model metadata')
+    args = parser.parse_args()
+
+    export(args.model_dir, output_path=args.output, opset=args.opset, model_version=args.model_version)
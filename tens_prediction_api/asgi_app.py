@@ -0,0 +1,221 @@
+"""
+ASGI serving variant of the prediction API (Starlette)
+
+Same request validation, recommendation rules, fallbacks and logging as the
+Cloud Function in main.py, but one process holds many concurrent requests:
+BigQuery predictions are awaited without holding a thread, and CPU-bound
+local inference (lightgbm / onnx, explanations, fallbacks) runs in a worker
+pool.
+
+Routes:
+    POST /predict        same body and response as predict_tens_level
+    POST /predict/batch  {"requests": [<predict body>, ...]} -> {"results": [...]}
+    GET  /health         serving backend, model version and service counters
+    GET  /diagnostics/memory  RSS / PSS / USS of every worker (shared_assets.py)
+
+Run locally:
+    pip install -r requirements-asgi.txt
+    gunicorn asgi_app:app -c gunicorn.conf.py   # models loaded once before fork, shared by the workers
+or: uvicorn asgi_app:app --host 0.0.0.0 --port 8080 --workers 4   # one model copy per worker
+or: python asgi_app.py (uvicorn, workers from WEB_CONCURRENCY)
+"""
+import asyncio
+import contextlib
+import os
+import time
+import uuid
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import main as api
+import shared_assets
+from singleflight import request_key
+
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '100'))
+
+ALL_METHODS = ['GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS']
+PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Max-Age': '3600'
+}
+CORS_HEADERS = {'Access-Control-Allow-Origin': '*'}
+
+
+async def _backend():
+    # First call loads the model; keep it off the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, api.get_backend)
+
+
+async def _json_body(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def _recommendations(request_id, contexts, started_at):
+    """Predict and explain a list of validated contexts; returns (backend, results, degraded reasons)"""
+    loop = asyncio.get_running_loop()
+    backend = await _backend()
+    start = time.perf_counter()
+    keys = [request_key(context, backend.version) for context in contexts]
+    predictions = await api._resilience.predict_async(backend, contexts, keys, started_at)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    api.observe_predictions(request_id, contexts, predictions, elapsed_ms)
+
+    explanations, explanation_status = await loop.run_in_executor(
+        None, api.explain_predictions, backend, contexts, predictions, elapsed_ms)
+    results = [
+        api.build_recommendation(context, prediction, backend.version, explanation, explanation_status)
+        for context, prediction, explanation in zip(contexts, predictions, explanations)
+    ]
+    reasons = sorted({p['degraded_reason'] for p in predictions if p['degraded']})
+    return backend, results, reasons
+
+
+async def predict(request):
+    """Single prediction: the predict_tens_level contract"""
+    if request.method == 'OPTIONS':
+        return Response(status_code=204, headers=PREFLIGHT_HEADERS)
+    headers = dict(CORS_HEADERS)
+    if request.method != 'POST':
+        return JSONResponse({'error': 'Method not allowed. Use POST.'}, status_code=405, headers=headers)
+
+    request_id = request.headers.get('X-Request-Id') or uuid.uuid4().hex
+    request_start = time.perf_counter()
+    context = None
+    backend = None
+
+    try:
+        request_json = await _json_body(request)
+        if not request_json:
+            return JSONResponse({'error': 'Invalid JSON in request body'}, status_code=400, headers=headers)
+
+        context, error = api.parse_context(request_json)
+        if error:
+            return JSONResponse({'error': error}, status_code=400, headers=headers)
+
+        backend, results, reasons = await _recommendations(request_id, [context], request_start)
+        result_dict = results[0]
+        result_dict['request_id'] = request_id
+        api.log_prediction(request_id, context, result_dict, backend,
+                           (time.perf_counter() - request_start) * 1000, 200)
+        api._maybe_log_metrics()
+
+        if reasons:
+            headers['X-Degraded'] = reasons[0]
+        return JSONResponse(result_dict, headers=headers)
+
+    except Exception as e:
+        print(f"Error processing request: {str(e)}")
+        error_dict = {'error': 'Internal server error', 'request_id': request_id}
+        api.log_prediction(request_id, context, error_dict, backend,
+                           (time.perf_counter() - request_start) * 1000, 500)
+        return JSONResponse(error_dict, status_code=500, headers=headers)
+
+
+async def predict_batch(request):
+    """Several predictions in one backend call; invalid items get an 'error' entry instead of failing the batch"""
+    if request.method == 'OPTIONS':
+        return Response(status_code=204, headers=PREFLIGHT_HEADERS)
+    headers = dict(CORS_HEADERS)
+    if request.method != 'POST':
+        return JSONResponse({'error': 'Method not allowed. Use POST.'}, status_code=405, headers=headers)
+
+    request_id = request.headers.get('X-Request-Id') or uuid.uuid4().hex
+    request_start = time.perf_counter()
+    backend = None
+    contexts = []
+    valid = []
+
+    try:
+        request_json = await _json_body(request)
+        items = request_json.get('requests') if isinstance(request_json, dict) else None
+        if not isinstance(items, list) or not items:
+            return JSONResponse({'error': 'Body must be {"requests": [...]} with at least one request'},
+                                status_code=400, headers=headers)
+        if len(items) > MAX_BATCH_SIZE:
+            return JSONResponse({'error': f'At most {MAX_BATCH_SIZE} requests per batch'},
+                                status_code=400, headers=headers)
+
+        results = [None] * len(items)
+        for i, item in enumerate(items):
+            context, error = api.parse_context(item) if isinstance(item, dict) and item else (
+                None, 'Invalid request object')
+            if error:
+                results[i] = {'error': error}
+            else:
+                valid.append(i)
+                contexts.append(context)
+
+        reasons = []
+        if contexts:
+            backend, recommendations, reasons = await _recommendations(request_id, contexts, request_start)
+            latency_ms = (time.perf_counter() - request_start) * 1000
+            for i, context, result_dict in zip(valid, contexts, recommendations):
+                result_dict['request_id'] = f'{request_id}-{i}'
+                api.log_prediction(result_dict['request_id'], context, result_dict, backend, latency_ms, 200)
+                results[i] = result_dict
+        api._maybe_log_metrics()
+
+        if reasons:
+            headers['X-Degraded'] = ','.join(reasons)
+        return JSONResponse({'request_id': request_id, 'results': results}, headers=headers)
+
+    except Exception as e:
+        print(f"Error processing batch request: {str(e)}")
+        error_dict = {'error': 'Internal server error', 'request_id': request_id}
+        for i, context in zip(valid, contexts):
+            api.log_prediction(f'{request_id}-{i}', context, error_dict, backend,
+                               (time.perf_counter() - request_start) * 1000, 500)
+        return JSONResponse(error_dict, status_code=500, headers=headers)
+
+
+async def health(request):
+    try:
+        backend = await _backend()
+    except Exception as e:
+        return JSONResponse({'status': 'unavailable', 'error': str(e)}, status_code=503, headers=CORS_HEADERS)
+    return JSONResponse({
+        'status': 'ok',
+        'backend': backend.name,
+        'model_version': backend.version,
+        'pid': os.getpid(),
+        'stats': api.service_stats(),
+    }, headers=CORS_HEADERS)
+
+
+async def memory_diagnostics(request):
+    """Per-worker memory; with the pre-fork preload, USS stays well below RSS (model pages are shared)"""
+    backend = await _backend()
+    report = await asyncio.get_running_loop().run_in_executor(None, shared_assets.memory_report)
+    report['backend'] = {'name': backend.name, 'version': backend.version, 'shared': shared_assets.is_shared(backend)}
+    return JSONResponse(report, headers=CORS_HEADERS)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Load the serving model before the worker accepts traffic
+    await _backend()
+    yield
+
+
+app = Starlette(
+    routes=[
+        Route('/predict', predict, methods=ALL_METHODS),
+        Route('/predict/batch', predict_batch, methods=ALL_METHODS),
+        Route('/health', health, methods=['GET']),
+        Route('/diagnostics/memory', memory_diagnostics, methods=['GET']),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run('asgi_app:app', host='0.0.0.0', port=int(os.environ.get('PORT', '8080')),
+                workers=int(os.environ.get('WEB_CONCURRENCY', '4')))
@@ -0,0 +1,393 @@
+"""
+Prediction backends for the TENS recommendation API
+
+Every backend takes a list of validated request contexts (see main.parse_context)
+and returns one prediction dict per context:
+
+    {'mode': int, 'tens': float, 'heat': float, 'probabilities': {...} or None}
+
+Select the backend with the PREDICTION_BACKEND environment variable:
+    bigquery  - BigQuery ML models via ML.PREDICT (default)
+    lightgbm  - hierarchical LightGBM models loaded from MODEL_DIR
+    onnx      - multi-output network exported by export_onnx.py, run with onnxruntime
+    distilled - numpy student distilled from the LightGBM models by ml_training/distill.py
+"""
+import asyncio
+import json
+import os
+
+import numpy as np
+
+from features import build_matrix
+from shared_assets import preloaded
+
+PROJECT_ID = os.environ.get('PROJECT_ID', 'junoplus-dev')
+MODEL_DIR = os.environ.get('MODEL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models'))
+
+MODE_MODEL = f'{PROJECT_ID}.junoplus_analytics.tens_mode_model'
+LEVEL_MODEL = f'{PROJECT_ID}.junoplus_analytics.tens_predictor_production_vertex'
+
+# Hierarchical inference (hierarchical_classification_xgboost.ipynb)
+MODE_CONFIDENCE_THRESHOLD = 0.5
+FALLBACK_TENS_LEVEL = 4
+
+# Upper bound for one ML.PREDICT query; the job is cancelled server-side after it
+BIGQUERY_TIMEOUT_SECONDS = float(os.environ.get('BIGQUERY_TIMEOUT_SECONDS', '10'))
+
+
+def heuristic_heat(context):
+    """Heat level rule used while there is no production heat model"""
+    pain = context['current_pain_level']
+    if pain and pain >= 8:
+        return 3
+    if pain and pain >= 6:
+        return 2
+    if context['is_period_day']:
+        return 2
+    return 1
+
+
+def heuristic_prediction(context):
+    """Rule-based prediction for degraded responses: the user's last TENS level, heat from heuristic_heat"""
+    previous = context['previous_tens_level']
+    return {
+        'mode': 0 if previous == 0 else 1,
+        'tens': float(previous or FALLBACK_TENS_LEVEL),
+        'heat': float(heuristic_heat(context)),
+        'probabilities': None,
+    }
+
+
+def recommended_settings(prediction):
+    """Final (heat, mode, tens) settings from a backend prediction (TENS off when mode=0)"""
+    mode = prediction['mode']
+    tens = 0 if mode == 0 else round(max(1, min(10, prediction['tens'])))
+    heat = round(max(0, min(3, prediction['heat'])))
+    return heat, mode, tens
+
+
+def _sql_bool(value):
+    return str(bool(value)).lower()
+
+
+class BigQueryMLBackend:
+    """ML.PREDICT on the BigQuery ML mode and level models, one query per model per batch"""
+
+    name = 'bigquery'
+
+    def __init__(self, client=None, mode_model=MODE_MODEL, level_model=LEVEL_MODEL, version=None,
+                 timeout_seconds=BIGQUERY_TIMEOUT_SECONDS):
+        from google.cloud import bigquery
+        self.client = client or bigquery.Client()
+        self.mode_model = mode_model
+        self.level_model = level_model
+        self.timeout_seconds = timeout_seconds
+        self.version = version or self._model_version()
+
+    def _model_version(self):
+        """<model>@<last modified> for both models, so retrained models get a new version"""
+        parts = []
+        for model_id in (self.mode_model, self.level_model):
+            model = self.client.get_model(model_id)
+            parts.append(f"{model.model_id}@{model.modified.strftime('%Y%m%dT%H%M%S')}")
+        return '+'.join(parts)
+
+    def _mode_row(self, index, c):
+        return f"""SELECT
+            {index} as request_index,
+            {c['user_age']} as age,
+            {c['user_cycle_length']} as cycle_length,
+            {c['user_period_length']} as period_length,
+            {_sql_bool(c['is_period_day'])} as is_period_day,
+            {_sql_bool(c['is_ovulation_day'])} as is_ovulation_day,
+            {c['current_pain_level'] if c['current_pain_level'] is not None else 'NULL'} as pain_level,
+            {c['current_flow_level'] if c['current_flow_level'] is not None else 'NULL'} as flow_level,
+            {_sql_bool(c['has_medications'])} as has_medications,
+            {c['medication_count']} as medication_count,
+            CASE
+              WHEN '{c['user_experience']}' = 'new_user' THEN 0
+              WHEN '{c['user_experience']}' = 'experienced_user' THEN 1
+              WHEN '{c['user_experience']}' = 'expert_user' THEN 2
+              ELSE 1
+            END as user_experience_encoded,
+            CASE
+              WHEN '{c['time_of_day']}' = 'morning' THEN 0
+              WHEN '{c['time_of_day']}' = 'afternoon' THEN 1
+              WHEN '{c['time_of_day']}' = 'evening' THEN 2
+              WHEN '{c['time_of_day']}' = 'night' THEN 3
+              ELSE 1
+            END as time_of_day_encoded,
+            {c['previous_tens_level']} as previous_tens_level,
+            2 as previous_heat_level"""
+
+    def _level_row(self, index, c):
+        pain = c['current_pain_level'] if c['current_pain_level'] is not None else 5
+        return f"""SELECT
+            {index} as request_index,
+            {c['user_age']} as age,
+            {c['user_cycle_length']} as cycle_length,
+            {c['user_period_length']} as period_length,
+            {_sql_bool(c['is_period_day'])} as is_period_day,
+            {_sql_bool(c['is_ovulation_day'])} as is_ovulation_day,
+            {pain} as period_pain_level,
+            {c['current_flow_level'] if c['current_flow_level'] is not None else 0} as flow_level,
+            {_sql_bool(c['has_medications'])} as has_pain_medication,
+            {c['medication_count']} as medication_count,
+            1.5 as recent_medication_usage,
+            CASE
+              WHEN '{c['time_of_day']}' = 'morning' THEN 9
+              WHEN '{c['time_of_day']}' = 'afternoon' THEN 14
+              WHEN '{c['time_of_day']}' = 'evening' THEN 19
+              ELSE 22
+            END as session_hour,
+            EXTRACT(DAYOFWEEK FROM CURRENT_DATE()) as day_of_week,
+            CASE
+              WHEN '{c['user_experience']}' = 'new_user' THEN 30
+              WHEN '{c['user_experience']}' = 'learning_user' THEN 60
+              ELSE 180
+            END as days_since_signup,
+            {c['previous_tens_level']} as initial_tens_level,
+            {pain} as input_pain_level"""
+
+    def _submit(self, model, column, rows):
+        from google.cloud import bigquery
+        query = f"""
+        SELECT request_index, {column} as prediction
+        FROM ML.PREDICT(
+          MODEL `{model}`,
+          ({' UNION ALL '.join(rows)})
+        )
+        """
+        job_config = bigquery.QueryJobConfig(job_timeout_ms=int(self.timeout_seconds * 1000))
+        return self.client.query(query, job_config=job_config, timeout=self.timeout_seconds)
+
+    def _collect(self, job, model, count):
+        values = [None] * count
+        for row in job.result(timeout=self.timeout_seconds):
+            values[row['request_index']] = row['prediction']
+        if any(value is None for value in values):
+            raise RuntimeError(f'Prediction failed for {model}')
+        return values
+
+    def _submit_all(self, contexts):
+        # Both queries are started before waiting on either
+        return (
+            self._submit(self.mode_model, 'predicted_tens_mode',
+                         [self._mode_row(i, c) for i, c in enumerate(contexts)]),
+            self._submit(self.level_model, 'predicted_target_tens_level',
+                         [self._level_row(i, c) for i, c in enumerate(contexts)]),
+        )
+
+    def _predictions(self, contexts, mode_job, level_job):
+        modes = self._collect(mode_job, self.mode_model, len(contexts))
+        levels = self._collect(level_job, self.level_model, len(contexts))
+        return [
+            {'mode': int(mode), 'tens': float(level), 'heat': float(heuristic_heat(context)),
+             'probabilities': None}
+            for context, mode, level in zip(contexts, modes, levels)
+        ]
+
+    def predict(self, contexts):
+        return self._predictions(contexts, *self._submit_all(contexts))
+
+    async def predict_async(self, contexts):
+        """predict for an event loop: no thread is held while the query jobs run"""
+        jobs = await asyncio.to_thread(self._submit_all, contexts)
+        delay = 0.05
+        while not all(await asyncio.gather(*(asyncio.to_thread(job.done) for job in jobs))):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        return await asyncio.to_thread(self._predictions, contexts, *jobs)
+
+
+class LightGBMBackend:
+    """Hierarchical heat / mode / level LightGBM classifiers (models/hierarchical_approach)"""
+
+    name = 'lightgbm'
+
+    def __init__(self, model_dir=None, version=None):
+        import joblib
+        model_dir = model_dir or os.path.join(MODEL_DIR, 'hierarchical_approach')
+        threads = int(os.environ.get('LIGHTGBM_NUM_THREADS', '1'))
+
+        self.heat_model = joblib.load(os.path.join(model_dir, 'heat_level_model.pkl'))
+        self.mode_model = joblib.load(os.path.join(model_dir, 'tens_mode_model.pkl'))
+        self.tens_model = joblib.load(os.path.join(model_dir, 'tens_level_model.pkl'))
+        for model in (self.heat_model, self.mode_model, self.tens_model):
+            model.set_params(n_jobs=threads)
+        self.feature_columns = tuple(joblib.load(os.path.join(model_dir, 'feature_columns.pkl')))
+        self.version = version or \
+            f"lightgbm_hierarchical@{int(os.path.getmtime(os.path.join(model_dir, 'tens_mode_model.pkl')))}"
+
+    def predict(self, contexts):
+        X = build_matrix(contexts, self.feature_columns)
+        heat_proba = self.heat_model.predict_proba(X)
+        mode_proba = self.mode_model.predict_proba(X)
+        heat = self.heat_model.classes_[heat_proba.argmax(axis=1)]
+        mode = self.mode_model.classes_[mode_proba.argmax(axis=1)]
+        mode_confidence = mode_proba.max(axis=1)
+
+        # Stage 2 only for confident active-mode rows
+        tens = np.where(mode == 0, 0, FALLBACK_TENS_LEVEL).astype(float)
+        tens_proba = None
+        confident = (mode > 0) & (mode_confidence >= MODE_CONFIDENCE_THRESHOLD)
+        if confident.any():
+            tens_proba = self.tens_model.predict_proba(X[confident])
+            tens[confident] = self.tens_model.classes_[tens_proba.argmax(axis=1)]
+
+        predictions = []
+        tens_rows = iter(tens_proba if tens_proba is not None else [])
+        for i in range(len(contexts)):
+            predictions.append({
+                'mode': int(mode[i]),
+                'tens': float(tens[i]),
+                'heat': float(heat[i]),
+                'probabilities': {
+                    'heat': heat_proba[i].tolist(),
+                    'mode': mode_proba[i].tolist(),
+                    'tens': next(tens_rows).tolist() if confident[i] else None,
+                },
+            })
+        return predictions
+
+    def explain(self, contexts, predictions, top_k):
+        """Top-k pred_contrib features per head for the predicted classes (one native call per head)"""
+        from explanations import class_contributions, top_contributions
+
+        X = build_matrix(contexts, self.feature_columns)
+        explanations = [{} for _ in contexts]
+        for head, model in (('heat', self.heat_model), ('mode', self.mode_model)):
+            predicted = np.array([np.argmax(p['probabilities'][head]) for p in predictions])
+            contrib = class_contributions(model, X, predicted)
+            for i in range(len(contexts)):
+                explanations[i][head] = top_contributions(contrib[i], X[i], self.feature_columns, top_k)
+
+        # Stage 2 rows only
+        rows = [i for i, p in enumerate(predictions) if p['probabilities']['tens'] is not None]
+        for i in range(len(contexts)):
+            explanations[i]['tens'] = None
+        if rows:
+            predicted = np.array([np.argmax(predictions[i]['probabilities']['tens']) for i in rows])
+            contrib = class_contributions(self.tens_model, X[rows], predicted)
+            for j, i in enumerate(rows):
+                explanations[i]['tens'] = top_contributions(contrib[j], X[i], self.feature_columns, top_k)
+        return explanations
+
+
+class OnnxBackend:
+    """Multi-output network (scaler fused into the graph) on onnxruntime's CPU provider"""
+
+    name = 'onnx'
+    model_file = 'multioutput_model.onnx'
+
+    def __init__(self, model_path=None, version=None):
+        import onnxruntime as ort
+        model_path = model_path or os.path.join(MODEL_DIR, 'multioutput_approach', self.model_file)
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = int(os.environ.get('ONNX_INTRA_OP_THREADS', '1'))
+        options.inter_op_num_threads = int(os.environ.get('ONNX_INTER_OP_THREADS', '1'))
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, sess_options=options,
+                                            providers=['CPUExecutionProvider'])
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.feature_columns = tuple(json.loads(metadata['feature_columns']))
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = ['heat_output', 'mode_output', 'tens_output']
+        self.version = version or metadata.get('model_version', 'multioutput_onnx')
+
+    def predict(self, contexts):
+        X = build_matrix(contexts, self.feature_columns)
+        heat_proba, mode_proba, tens_proba = self.session.run(self.output_names, {self.input_name: X})
+        heat = heat_proba.argmax(axis=1)
+        mode = mode_proba.argmax(axis=1)
+        tens = tens_proba.argmax(axis=1)
+        return [
+            {
+                'mode': int(mode[i]),
+                'tens': float(tens[i]),
+                'heat': float(heat[i]),
+                'probabilities': {
+                    'heat': heat_proba[i].tolist(),
+                    'mode': mode_proba[i].tolist(),
+                    'tens': tens_proba[i].tolist(),
+                },
+            }
+            for i in range(len(contexts))
+        ]
+
+
+def _softmax(logits):
+    z = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return z / z.sum(axis=1, keepdims=True)
+
+
+class DistilledBackend:
+    """
+    One-hidden-layer student of the hierarchical LightGBM models (ml_training/distill.py).
+    All three heads come from one forward pass (missing-value fill and scaler folded into
+    the first layer); the hierarchical TENS rules are the LightGBM backend's.
+    """
+
+    name = 'distilled'
+    model_file = 'student_model.npz'
+
+    def __init__(self, model_path=None, version=None):
+        model_path = model_path or os.path.join(MODEL_DIR, 'distilled_approach', self.model_file)
+        with np.load(model_path) as artifact:
+            self.fill = artifact['fill']
+            self.w1, self.b1 = artifact['w1'], artifact['b1']
+            self.w2, self.b2 = artifact['w2'], artifact['b2']
+            self.classes = {head: artifact[f'{head}_classes'] for head in ('heat', 'mode', 'tens')}
+            self.feature_columns = tuple(str(c) for c in artifact['feature_columns'])
+            metadata = json.loads(str(artifact['metadata']))
+        bounds = np.cumsum([0] + [len(self.classes[head]) for head in ('heat', 'mode', 'tens')])
+        self.slices = {head: slice(bounds[i], bounds[i + 1]) for i, head in enumerate(('heat', 'mode', 'tens'))}
+        self.version = version or metadata.get('model_version', 'distilled')
+
+    def head_probabilities(self, X):
+        """{head: class probabilities} for a build_matrix feature matrix"""
+        X = np.where(np.isnan(X), self.fill, X)
+        logits = np.maximum(X @ self.w1 + self.b1, 0) @ self.w2 + self.b2
+        return {head: _softmax(logits[:, s]) for head, s in self.slices.items()}
+
+    def predict(self, contexts):
+        proba = self.head_probabilities(build_matrix(contexts, self.feature_columns))
+        heat = self.classes['heat'][proba['heat'].argmax(axis=1)]
+        mode = self.classes['mode'][proba['mode'].argmax(axis=1)]
+        confident = (mode > 0) & (proba['mode'].max(axis=1) >= MODE_CONFIDENCE_THRESHOLD)
+        tens = np.where(mode == 0, 0, FALLBACK_TENS_LEVEL).astype(float)
+        tens[confident] = self.classes['tens'][proba['tens'][confident].argmax(axis=1)]
+        return [
+            {
+                'mode': int(mode[i]),
+                'tens': float(tens[i]),
+                'heat': float(heat[i]),
+                'probabilities': {
+                    'heat': proba['heat'][i].tolist(),
+                    'mode': proba['mode'][i].tolist(),
+                    'tens': proba['tens'][i].tolist() if confident[i] else None,
+                },
+            }
+            for i in range(len(contexts))
+        ]
+
+
+BACKENDS = {
+    'bigquery': BigQueryMLBackend,
+    'lightgbm': LightGBMBackend,
+    'onnx': OnnxBackend,
+    'distilled': DistilledBackend,
+}
+
+
+def create_backend(name=None, **kwargs):
+    """Instantiate a backend by name (defaults to PREDICTION_BACKEND, then bigquery)"""
+    name = name or os.environ.get('PREDICTION_BACKEND', 'bigquery')
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown prediction backend '{name}'. Choose from: {', '.join(BACKENDS)}")
+    # Deployed defaults loaded before the workers forked (shared_assets.preload)
+    shared = None if kwargs else preloaded(name)
+    return shared or BACKENDS[name](**kwargs)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Benchmark the prediction backends on synthetic requests
+
+Each backend runs in a fresh spawned process so load time and memory are not
+shared between backends. Reports:
+    - load time (imports + model load)
+    - single-request latency p50 / p95 / p99
+    - batch throughput (predictions / second)
+    - peak RSS of the process, and the increase over the pre-load baseline
+
+Usage:
+    MODEL_DIR=../models python benchmark_backends.py
+    python benchmark_backends.py --backends lightgbm onnx --requests 2000 --batch-size 256
+    python benchmark_backends.py --backends lightgbm distilled
+    python benchmark_backends.py --backends bigquery --requests 20   # runs real queries
+"""
+import argparse
+import multiprocessing as mp
+import random
+import resource
+import time
+
+
+def random_context(rng):
+    pain = rng.choice([None] + list(range(11)))
+    return {
+        'user_id': None,
+        'user_age': rng.randint(18, 50),
+        'user_cycle_length': rng.randint(24, 35),
+        'user_period_length': rng.randint(3, 7),
+        'is_period_day': rng.random() < 0.3,
+        'is_ovulation_day': rng.random() < 0.1,
+        'current_pain_level': pain,
+        'current_flow_level': rng.choice([None, 0, 1, 2, 3, 4, 5]),
+        'has_medications': rng.random() < 0.4,
+        'medication_count': rng.randint(0, 3),
+        'user_experience': rng.choice(['new_user', 'learning_user', 'experienced_user']),
+        'time_of_day': rng.choice(['morning', 'afternoon', 'evening', 'night']),
+        'previous_tens_level': rng.randint(0, 10),
+        'tens_mode': 'continuous',
+    }
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def _run_backend(name, n_requests, batch_size, seed, queue):
+    try:
+        import numpy  # noqa: F401  (baseline includes the shared feature-building imports)
+        import features  # noqa: F401
+        baseline_rss = _peak_rss_mb()
+
+        start = time.perf_counter()
+        from backends import create_backend
+        backend = create_backend(name)
+        load_seconds = time.perf_counter() - start
+
+        rng = random.Random(seed)
+        contexts = [random_context(rng) for _ in range(n_requests)]
+
+        backend.predict(contexts[:1])  # warm-up
+        latencies = []
+        for context in contexts:
+            t0 = time.perf_counter()
+            backend.predict([context])
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+        t0 = time.perf_counter()
+        for i in range(0, n_requests, batch_size):
+            backend.predict(contexts[i:i + batch_size])
+        batch_seconds = time.perf_counter() - t0
+
+        peak_rss = _peak_rss_mb()
+        queue.put({
+            'backend': name,
+            'load_s': load_seconds,
+            'p50_ms': _percentile(latencies, 50),
+            'p95_ms': _percentile(latencies, 95),
+            'p99_ms': _percentile(latencies, 99),
+            'throughput': n_requests / batch_seconds,
+            'peak_rss_mb': peak_rss,
+            'model_rss_mb': peak_rss - baseline_rss,
+        })
+    except Exception as e:
+        queue.put({'backend': name, 'error': str(e)})
+
+
+def benchmark(backends, n_requests, batch_size, seed=42):
+    ctx = mp.get_context('spawn')
+    results = []
+    for name in backends:
+        print(f"⏱️  Benchmarking {name}...")
+        queue = ctx.Queue()
+        process = ctx.Process(target=_run_backend, args=(name, n_requests, batch_size, seed, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare latency and memory of the prediction backends')
+    parser.add_argument('--backends', nargs='+', default=['lightgbm', 'onnx'],
+                        choices=['bigquery', 'lightgbm', 'onnx', 'distilled'],
+                        help='bigquery is opt-in: it issues real ML.PREDICT queries')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    results = benchmark(args.backends, args.requests, args.batch_size, seed=args.seed)
+
+    print(f"\n📊 {args.requests} requests, batch size {args.batch_size}")
+    print(f"{'backend':<10} {'load s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'pred/s':>10} {'peak MB':>9} {'model MB':>9}")
+    for r in results:
+        if 'error' in r:
+            print(f"{r['backend']:<10} ❌ {r['error']}")
+            continue
+        print(f"{r['backend']:<10} {r['load_s']:>8.2f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} "
+              f"{r['throughput']:>10,.0f} {r['peak_rss_mb']:>9.1f} {r['model_rss_mb']:>9.1f}")
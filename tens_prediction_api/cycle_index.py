@@ -0,0 +1,198 @@
+"""
+Per-user cycle index: cycle day and phase flags without a warehouse lookup
+
+gold.user_cycle_index_v1 (refresh_gold) holds each user's last period start
+(the newer of silver_period_tracking and the profile's lastPeriodDate), cycle
+length and period length. export_index()
+writes it as a few compact arrays (shared_assets.save_arrays):
+
+    slot_keys    uint64  open-addressing hash table of user_id hashes (0 = empty)
+    slot_rows    int32   row of each slot
+    period_start int32   last period start, days since 1970-01-01
+    cycle_length int16   0 = unknown
+    period_length int16  0 = unknown
+
+The API opens them memory-mapped (every worker shares the same pages) and
+resolves a user with one hash and a short linear probe, O(1) per request.
+From the last period start the cycle is projected forward:
+
+    cycle_day = (date - last_period_start) mod cycle_length + 1
+    is_period_day     cycle_day <= period_length
+    is_ovulation_day  cycle_day == max(1, cycle_length - 14)   (14-day luteal phase)
+
+Starts more than MAX_PROJECTED_CYCLES cycles back are treated as unknown.
+
+Export (run after refresh_gold, ship the directory with deploy.sh):
+    python cycle_index.py --output ../models/cycle_index
+"""
+import argparse
+import hashlib
+import logging
+import os
+from datetime import date, datetime, timezone
+
+import numpy as np
+
+from shared_assets import open_arrays, save_arrays
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ID = os.environ.get('PROJECT_ID', 'junoplus-dev')
+CYCLE_INDEX_TABLE = os.environ.get('CYCLE_INDEX_TABLE', f'{PROJECT_ID}.junoplus_analytics_gold.user_cycle_index_v1')
+CYCLE_INDEX_DIR = os.environ.get(
+    'CYCLE_INDEX_DIR',
+    os.path.join(os.environ.get('MODEL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')),
+                 'cycle_index'))
+
+# Request defaults (main.parse_context) when neither the client nor the index has a value
+DEFAULT_CYCLE_LENGTH = 30
+DEFAULT_PERIOD_LENGTH = 5
+LUTEAL_PHASE_DAYS = 14
+MAX_PROJECTED_CYCLES = int(os.environ.get('CYCLE_INDEX_MAX_CYCLES', '3'))
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def user_key(user_id):
+    """Non-zero 64-bit hash of a user_id (0 marks an empty slot)"""
+    key = int.from_bytes(hashlib.blake2b(str(user_id).encode('utf-8'), digest_size=8).digest(), 'little')
+    return key or 1
+
+
+def build_arrays(user_ids, period_starts, cycle_lengths, period_lengths):
+    """Index arrays for parallel lists (period_starts as dates, lengths None when unknown)"""
+    n = len(user_ids)
+    size = 1 << max(4, (2 * n - 1).bit_length())  # load factor <= 0.5
+    mask = size - 1
+    slot_keys = np.zeros(size, dtype=np.uint64)
+    slot_rows = np.full(size, -1, dtype=np.int32)
+    for row, user_id in enumerate(user_ids):
+        key = user_key(user_id)
+        slot = key & mask
+        while slot_keys[slot] and int(slot_keys[slot]) != key:
+            slot = (slot + 1) & mask
+        slot_keys[slot] = key
+        slot_rows[slot] = row
+    return {
+        'slot_keys': slot_keys,
+        'slot_rows': slot_rows,
+        'period_start': np.array([d.toordinal() - _EPOCH_ORDINAL for d in period_starts], dtype=np.int32),
+        'cycle_length': np.array([c or 0 for c in cycle_lengths], dtype=np.int16),
+        'period_length': np.array([p or 0 for p in period_lengths], dtype=np.int16),
+    }
+
+
+def export_index(client=None, table=CYCLE_INDEX_TABLE, directory=CYCLE_INDEX_DIR):
+    """Write gold.user_cycle_index_v1 as index arrays to directory; returns the user count"""
+    from google.cloud import bigquery
+    client = client or bigquery.Client(project=PROJECT_ID)
+    rows = list(client.query(f"""
+        SELECT user_id, last_period_start, cycle_length, period_length
+        FROM `{table}`
+        WHERE user_id IS NOT NULL AND last_period_start IS NOT NULL
+    """).result())
+    arrays = build_arrays([r['user_id'] for r in rows], [r['last_period_start'] for r in rows],
+                          [r['cycle_length'] for r in rows], [r['period_length'] for r in rows])
+    save_arrays(directory, arrays, metadata={
+        'source_table': table,
+        'users': len(rows),
+        'exported_at': datetime.now(timezone.utc).isoformat(),
+    })
+    return len(rows)
+
+
+def cycle_state(days_since_start, cycle_length, period_length):
+    """Cycle day, phase and flags days_since_start days after a period start, or None if too far back"""
+    if days_since_start < 0 or days_since_start >= MAX_PROJECTED_CYCLES * cycle_length:
+        return None
+    cycle_day = days_since_start % cycle_length + 1
+    ovulation_day = max(1, cycle_length - LUTEAL_PHASE_DAYS)
+    is_period_day = cycle_day <= period_length
+    is_ovulation_day = not is_period_day and cycle_day == ovulation_day
+    if is_period_day:
+        phase = 'menstrual'
+    elif is_ovulation_day:
+        phase = 'ovulation'
+    elif cycle_day < ovulation_day:
+        phase = 'follicular'
+    else:
+        phase = 'luteal'
+    return {
+        'cycle_day': cycle_day,
+        'cycle_phase': phase,
+        'is_period_day': is_period_day,
+        'is_ovulation_day': is_ovulation_day,
+    }
+
+
+class CycleIndex:
+    """Memory-mapped user -> cycle lookup (see module docstring)"""
+
+    def __init__(self, directory=CYCLE_INDEX_DIR):
+        arrays, self.metadata = open_arrays(directory)
+        self.slot_keys = arrays['slot_keys']
+        self.slot_rows = arrays['slot_rows']
+        self.period_start = arrays['period_start']
+        self.cycle_length = arrays['cycle_length']
+        self.period_length = arrays['period_length']
+        self.mask = len(self.slot_keys) - 1
+
+    def __len__(self):
+        return len(self.period_start)
+
+    def row(self, user_id):
+        key = user_key(user_id)
+        slot = key & self.mask
+        while True:
+            stored = int(self.slot_keys[slot])
+            if stored == key:
+                return int(self.slot_rows[slot])
+            if stored == 0:
+                return None
+            slot = (slot + 1) & self.mask
+
+    def lookup(self, user_id):
+        """(last period start date, cycle length or None, period length or None) of a user, or None"""
+        row = self.row(user_id)
+        if row is None:
+            return None
+        return (date.fromordinal(int(self.period_start[row]) + _EPOCH_ORDINAL),
+                int(self.cycle_length[row]) or None, int(self.period_length[row]) or None)
+
+    def derive(self, user_id, on_date, cycle_length=None, period_length=None):
+        """
+        Cycle lengths and state of a user on on_date, or None if unknown.
+        Lengths passed in (client values) take precedence over the indexed ones.
+        """
+        entry = self.lookup(user_id)
+        if entry is None:
+            return None
+        period_start, indexed_cycle, indexed_period = entry
+        cycle_length = cycle_length or indexed_cycle or DEFAULT_CYCLE_LENGTH
+        period_length = period_length or indexed_period or DEFAULT_PERIOD_LENGTH
+        state = cycle_state((on_date - period_start).days, cycle_length, period_length)
+        if state is None:
+            return None
+        return {'user_cycle_length': cycle_length, 'user_period_length': period_length, **state}
+
+
+def load_cycle_index(directory=CYCLE_INDEX_DIR):
+    """CycleIndex for directory, or None when it has not been exported (clients then send the flags)"""
+    if os.environ.get('CYCLE_INDEX', 'on') != 'on' or not os.path.isdir(directory):
+        return None
+    try:
+        index = CycleIndex(directory)
+        logger.info(f"📅 Cycle index: {len(index):,} users (exported {index.metadata.get('exported_at')})")
+        return index
+    except Exception as e:
+        logger.error(f"❌ Could not load the cycle index from {directory}: {str(e)}")
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export gold.user_cycle_index_v1 for the prediction API')
+    parser.add_argument('--table', default=CYCLE_INDEX_TABLE)
+    parser.add_argument('--output', default=CYCLE_INDEX_DIR)
+    args = parser.parse_args()
+    users = export_index(table=args.table, directory=args.output)
+    print(f"✅ Exported {users:,} users to {args.output}")
@@ -6,24 +6,61 @@
 PROJECT_ID="junoplus-dev"
 REGION="us-central1"
 FUNCTION_NAME="predict-tens-level"
+PREDICTION_BACKEND="${PREDICTION_BACKEND:-bigquery}"  # bigquery | lightgbm | onnx | distilled
+FALLBACK_BACKEND="${FALLBACK_BACKEND:-}"  # optional local fallback tier (resilience.py)
+PREDICTION_LOG_SINK="${PREDICTION_LOG_SINK:-bigquery}"  # bigquery | off
 
 echo "🚀 Deploying TENS Prediction API to Cloud Functions..."
 echo "Project: $PROJECT_ID"
 echo "Region: $REGION"
 echo "Function: $FUNCTION_NAME"
+echo "Backend: $PREDICTION_BACKEND"
+
+# The function is deployed from a staging directory holding only what the selected
+# backends need: their model artifacts and their extra requirements
+BUILD_DIR=$(mktemp -d)
+trap 'rm -rf "$BUILD_DIR"' EXIT
+cp *.py "$BUILD_DIR"/
+cp requirements.txt "$BUILD_DIR"/requirements.txt
+if [ "$PREDICTION_LOG_SINK" = "bigquery" ]; then
+  grep -v '^#' requirements-prediction-log.txt >> "$BUILD_DIR"/requirements.txt
+fi
+
+# Local backends load model artifacts from ./models inside the function source
+stage_backend() {
+  if [ "$1" = "lightgbm" ]; then
+    mkdir -p "$BUILD_DIR"/models && cp -r ../models/hierarchical_approach "$BUILD_DIR"/models/
+    grep -v '^#' requirements-lightgbm.txt >> "$BUILD_DIR"/requirements.txt
+  elif [ "$1" = "onnx" ]; then
+    mkdir -p "$BUILD_DIR"/models/multioutput_approach && cp ../models/multioutput_approach/multioutput_model.onnx "$BUILD_DIR"/models/multioutput_approach/
+    grep -v '^#' requirements-onnx.txt >> "$BUILD_DIR"/requirements.txt
+  elif [ "$1" = "distilled" ]; then
+    mkdir -p "$BUILD_DIR"/models/distilled_approach && cp ../models/distilled_approach/student_model.npz "$BUILD_DIR"/models/distilled_approach/
+  fi
+}
+stage_backend "$PREDICTION_BACKEND"
+if [ -n "$FALLBACK_BACKEND" ] && [ "$FALLBACK_BACKEND" != "$PREDICTION_BACKEND" ]; then
+  stage_backend "$FALLBACK_BACKEND"
+fi
+if [ -f ../models/drift_reference.json ]; then
+  mkdir -p "$BUILD_DIR"/models && cp ../models/drift_reference.json "$BUILD_DIR"/models/  # drift monitor reference (drift.py)
+fi
+if [ -d ../models/cycle_index ]; then
+  mkdir -p "$BUILD_DIR"/models && cp -r ../models/cycle_index "$BUILD_DIR"/models/  # per-user cycle flags (cycle_index.py)
+fi
 
 # Deploy the function
 gcloud functions deploy $FUNCTION_NAME \
   --gen2 \
   --runtime python311 \
   --region $REGION \
-  --source . \
+  --source "$BUILD_DIR" \
   --entry-point predict_tens_level \
   --trigger-http \
   --allow-unauthenticated \
   --memory 512MB \
   --timeout 60s \
-  --set-env-vars PROJECT_ID=$PROJECT_ID
+  --set-env-vars PROJECT_ID=$PROJECT_ID,PREDICTION_BACKEND=$PREDICTION_BACKEND,FALLBACK_BACKEND=$FALLBACK_BACKEND,PREDICTION_LOG_SINK=$PREDICTION_LOG_SINK
 
 if [ $? -eq 0 ]; then
     echo "✅ Function deployed successfully!"
@@ -0,0 +1,267 @@
+"""
+Streaming feature / prediction drift monitor for the prediction API
+
+The request path only enqueues (context, prediction) pairs. A background
+worker turns them into feature vectors and updates fixed-size sketches:
+
+    - one histogram per feature, with bin edges from the training reference
+      (constant memory, mergeable by adding counts)
+    - per-class prediction counts for each head
+
+Every DRIFT_FLUSH_SECONDS (once DRIFT_MIN_SAMPLES requests were seen) the
+window is compared to the reference with PSI and a binned KS statistic,
+alerts are raised in the quality_check result format, and the sketch state
+is written to the prediction_drift table. No raw requests are kept.
+
+The reference comes from ml_training/drift_reference.py (drift_reference.json).
+"""
+import json
+import logging
+import os
+import queue
+import re
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from features import build_matrix
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ID = os.environ.get('PROJECT_ID', 'junoplus-dev')
+DRIFT_TABLE = os.environ.get('DRIFT_TABLE', f'{PROJECT_ID}.junoplus_analytics_quality.prediction_drift')
+FLUSH_SECONDS = float(os.environ.get('DRIFT_FLUSH_SECONDS', '900'))
+MIN_SAMPLES = int(os.environ.get('DRIFT_MIN_SAMPLES', '200'))
+QUEUE_SIZE = 10_000
+
+PSI_WARN, PSI_FAIL = 0.1, 0.25
+KS_WARN, KS_FAIL = 0.1, 0.2
+EPSILON = 1e-4
+
+# Features the API fills with fixed defaults (features.raw_features); they are
+# sketched but not alerted on, since their skew is by construction
+SERVING_DEFAULT_FEATURES = re.compile(r'^(delta_.*|device_size_.*|user_(avg|recent_avg|mode)_(heat|mode)|recent_medication_usage)$')
+
+
+def psi(expected, actual):
+    """Population stability index between two proportion vectors"""
+    expected = np.clip(np.asarray(expected, dtype=float), EPSILON, None)
+    actual = np.clip(np.asarray(actual, dtype=float), EPSILON, None)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def ks_binned(expected, actual):
+    """Kolmogorov-Smirnov statistic on binned distributions (max CDF gap)"""
+    return float(np.max(np.abs(np.cumsum(expected) - np.cumsum(actual))))
+
+
+def _proportions(counts):
+    counts = np.asarray(counts, dtype=float)
+    total = counts.sum()
+    return counts / total if total else counts
+
+
+def _severity(value, warn, fail):
+    if value >= fail:
+        return 'FAIL'
+    if value >= warn:
+        return 'WARN'
+    return None
+
+
+class DriftSketch:
+    """Fixed-size, mergeable histogram state for all features and prediction heads"""
+
+    def __init__(self, reference):
+        self.feature_columns = tuple(reference['feature_columns'])
+        features = [reference['features'][name] for name in self.feature_columns]
+        self.n_bins = np.array([len(f['edges']) + 1 for f in features])
+
+        # Pad edges to a rectangle with +inf so binning is a single vectorized compare
+        max_edges = max(len(f['edges']) for f in features)
+        self.edges = np.full((len(features), max_edges), np.inf)
+        for i, f in enumerate(features):
+            self.edges[i, :len(f['edges'])] = f['edges']
+
+        self.heads = {head: len(p) for head, p in reference['predictions'].items()}
+        self.reset()
+
+    def reset(self):
+        self.counts = np.zeros((len(self.feature_columns), self.edges.shape[1] + 1), dtype=np.int64)
+        self.missing = np.zeros(len(self.feature_columns), dtype=np.int64)
+        self.prediction_counts = {head: np.zeros(n, dtype=np.int64) for head, n in self.heads.items()}
+        self.request_count = 0
+
+    def update(self, X, predictions):
+        present = ~np.isnan(X)
+        self.missing += (~present).sum(axis=0)
+        bins = (X[:, :, None] > self.edges[None, :, :]).sum(axis=2)
+        columns = np.broadcast_to(np.arange(X.shape[1]), X.shape)
+        np.add.at(self.counts, (columns[present], bins[present]), 1)
+        for prediction in predictions:
+            for head, n in self.heads.items():
+                value = int(round(prediction[head]))
+                if 0 <= value < n:
+                    self.prediction_counts[head][value] += 1
+        self.request_count += len(X)
+
+    def state(self):
+        """JSON-serializable state; states from several instances merge with merge_states"""
+        return {
+            'request_count': self.request_count,
+            'features': {
+                name: {'counts': self.counts[i, :self.n_bins[i]].tolist(), 'missing': int(self.missing[i])}
+                for i, name in enumerate(self.feature_columns)
+            },
+            'predictions': {head: counts.tolist() for head, counts in self.prediction_counts.items()},
+        }
+
+
+def merge_states(states):
+    """Add up sketch states (e.g. windows from several API instances)"""
+    merged = None
+    for state in states:
+        if merged is None:
+            merged = json.loads(json.dumps(state))
+            continue
+        merged['request_count'] += state['request_count']
+        for name, feature in state['features'].items():
+            target = merged['features'][name]
+            target['counts'] = [a + b for a, b in zip(target['counts'], feature['counts'])]
+            target['missing'] += feature['missing']
+        for head, counts in state['predictions'].items():
+            merged['predictions'][head] = [a + b for a, b in zip(merged['predictions'][head], counts)]
+    return merged
+
+
+def evaluate(state, reference, source='predict-tens-level'):
+    """Compare a sketch state with the reference; returns quality_check-style alerts"""
+    alerts = []
+    checks = [('feature_drift', name, reference['features'][name]['expected'], feature['counts'])
+              for name, feature in state['features'].items() if not SERVING_DEFAULT_FEATURES.match(name)]
+    checks += [('prediction_drift', f'{head}_prediction', reference['predictions'][head], counts)
+               for head, counts in state['predictions'].items()]
+
+    for alert_type, metric, expected, counts in checks:
+        if sum(counts) == 0:
+            continue
+        actual = _proportions(counts)
+        psi_value = psi(expected, actual)
+        ks_value = ks_binned(expected, actual)
+        statuses = {_severity(psi_value, PSI_WARN, PSI_FAIL), _severity(ks_value, KS_WARN, KS_FAIL)}
+        status = 'FAIL' if 'FAIL' in statuses else ('WARN' if 'WARN' in statuses else None)
+        if status is None:
+            continue
+        alert_msg = (f"{'❌' if status == 'FAIL' else '⚠️ '} DRIFT {status}: {metric} PSI = {psi_value:.3f} "
+                     f"(threshold: {PSI_WARN}), KS = {ks_value:.3f} over {state['request_count']:,} requests")
+        alerts.append({
+            'type': alert_type,
+            'table': source,
+            'metric': metric,
+            'status': status,
+            'value': round(psi_value, 4),
+            'ks': round(ks_value, 4),
+            'threshold': PSI_WARN,
+            'message': alert_msg,
+        })
+    return alerts
+
+
+def bigquery_sink(row):
+    from google.cloud import bigquery
+    errors = bigquery.Client(project=PROJECT_ID).insert_rows_json(DRIFT_TABLE, [row])
+    if errors:
+        raise RuntimeError(f"Drift sketch insert failed: {errors}")
+
+
+class DriftMonitor:
+    """Non-blocking drift monitor; observe() only enqueues"""
+
+    def __init__(self, reference, model_version=None, sink=bigquery_sink,
+                 flush_seconds=FLUSH_SECONDS, min_samples=MIN_SAMPLES):
+        self.reference = reference
+        self.sketch = DriftSketch(reference)
+        self.model_version = model_version
+        self.sink = sink
+        self.flush_seconds = flush_seconds
+        self.min_samples = min_samples
+        self.instance_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._window_start = datetime.now(timezone.utc)
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name='drift-monitor', daemon=True)
+        self._worker.start()
+
+    def observe(self, contexts, predictions):
+        try:
+            self._queue.put_nowait((contexts, predictions))
+        except queue.Full:
+            self.dropped += len(contexts)
+
+    def _run(self):
+        while True:
+            try:
+                contexts, predictions = self._queue.get(timeout=5)
+                # Drain what is queued so feature building is batched
+                while len(contexts) < 256:
+                    try:
+                        more_contexts, more_predictions = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    contexts = contexts + more_contexts
+                    predictions = predictions + more_predictions
+                with self._lock:
+                    self.sketch.update(build_matrix(contexts, self.sketch.feature_columns), predictions)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                logger.error(f"❌ Drift monitor update failed: {str(e)}")
+
+            if time.monotonic() - self._last_flush >= self.flush_seconds:
+                self.flush()
+
+    def flush(self, force=False):
+        """Evaluate and persist the current window; returns the alerts raised"""
+        with self._lock:
+            if self.sketch.request_count == 0 or (self.sketch.request_count < self.min_samples and not force):
+                return []
+            state = self.sketch.state()
+            self.sketch.reset()
+            window_start, self._window_start = self._window_start, datetime.now(timezone.utc)
+            self._last_flush = time.monotonic()
+
+        alerts = evaluate(state, self.reference)
+        for alert in alerts:
+            logger.warning(alert['message'])
+        if self.sink:
+            try:
+                self.sink({
+                    'flushed_at': datetime.now(timezone.utc).isoformat(),
+                    'window_start': window_start.isoformat(),
+                    'instance_id': self.instance_id,
+                    'model_version': self.model_version,
+                    'reference_source': self.reference.get('source'),
+                    'request_count': state['request_count'],
+                    'dropped_count': self.dropped,
+                    'sketch': json.dumps(state),
+                    'alerts': json.dumps(alerts),
+                })
+            except Exception as e:
+                logger.error(f"❌ Drift sketch flush failed: {str(e)}")
+        return alerts
+
+
+def load_reference(path=None):
+    """Reference distribution saved by ml_training/drift_reference.py, or None if absent"""
+    path = path or os.environ.get('DRIFT_REFERENCE') or os.path.join(
+        os.environ.get('MODEL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')),
+        'drift_reference.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
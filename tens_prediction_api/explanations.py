@@ -0,0 +1,161 @@
+"""
+Per-request explanations from LightGBM feature contributions
+
+LightGBM's pred_contrib=True returns exact TreeSHAP values for every row in
+one native call, so explanations can be served per request instead of only in
+the notebook's offline SHAP sample. Contributions are taken for the predicted
+class of each head, ranked by absolute value, and turned into readable reasons
+with the lookup tables below. Features the API does not receive (NaN values and
+drift.SERVING_DEFAULT_FEATURES constants) are never given as reasons.
+"""
+import math
+import os
+import threading
+
+import numpy as np
+
+from drift import SERVING_DEFAULT_FEATURES
+from features import CATEGORICAL_COLUMNS
+
+DEFAULT_TOP_K = int(os.environ.get('EXPLANATION_TOP_K', '3'))
+EXPLANATION_BUDGET_MS = float(os.environ.get('EXPLANATION_BUDGET_MS', '25'))
+
+# Numeric features -> reason template ({value} is the request's feature value)
+REASONS = {
+    'period_pain_level': 'period pain level {value:g}',
+    'input_pain_level': 'current pain level {value:g}',
+    'pain_level_before': 'pain level {value:g} before the session',
+    'flow_level': 'flow level {value:g}',
+    'is_near_period': 'period day',
+    'days_since_period_start': 'day {value:g} of the cycle',
+    'has_pain_medication': 'taking pain medication',
+    'medication_count': '{value:g} medication(s)',
+    'active_medication_count': '{value:g} active medication(s)',
+    'recent_medication_usage': 'recent medication usage',
+    'high_pain_no_med': 'high pain without medication',
+    'high_pain_with_med': 'high pain despite medication',
+    'age': 'age {value:g}',
+    'cycle_length': '{value:g}-day cycle',
+    'period_length': '{value:g}-day period',
+    'days_since_signup': '{value:g} days since signup',
+    'user_avg_heat': 'usual heat level {value:.1f}',
+    'user_avg_mode': 'usual TENS mode {value:.1f}',
+    'user_avg_tens': 'usual TENS level {value:.1f}',
+    'user_recent_avg_heat': 'recent heat level {value:.1f}',
+    'user_recent_avg_tens': 'recent TENS level {value:.1f}',
+    'user_mode_heat': 'most used heat level {value:g}',
+    'user_mode_mode': 'most used TENS mode {value:g}',
+    'user_mode_tens': 'most used TENS level {value:g}',
+    'user_session_count': '{value:g} previous sessions',
+    'session_hour': 'session at {value:g}:00',
+    'day_of_week': 'day of week',
+    'day_of_week_num': 'day of week',
+    'is_weekend': 'weekend session',
+    'initial_heat_level': 'starting heat level {value:g}',
+}
+
+# One-hot features -> reason template ({value} is the category)
+CATEGORY_REASONS = {
+    'device_size': '{value} device',
+    'time_of_day_category': '{value} session',
+    'cycle_phase_estimated': '{value} phase of the cycle',
+    'age_group': 'age group {value}',
+    'user_experience_level': '{value}',
+    'cycle_period': '{value}',
+    'pain_severity': '{value}',
+}
+
+
+def describe(feature, value):
+    """Human-readable reason for a feature at the request's value"""
+    for category in CATEGORICAL_COLUMNS:
+        prefix = f'{category}_'
+        if feature.startswith(prefix):
+            label = CATEGORY_REASONS[category].format(value=feature[len(prefix):]).replace('_', ' ')
+            return label if value == 1 else f'not {label}'
+    template = REASONS.get(feature)
+    if template is None:
+        return feature.replace('_', ' ')
+    if value is None:
+        return f"{feature.replace('_', ' ')} unknown"
+    return template.format(value=value)
+
+
+def explainable(feature, value):
+    """Whether a feature value came from the request (not missing, not a serving default)"""
+    return value is not None and not SERVING_DEFAULT_FEATURES.match(feature)
+
+
+def top_contributions(contrib_row, values_row, feature_columns, top_k):
+    """Top-k (by |contribution|) explainable features of one row; contrib_row excludes the bias term"""
+    result = []
+    for index in np.argsort(-np.abs(contrib_row)):
+        if len(result) >= top_k:
+            break
+        value = float(values_row[index])
+        value = None if math.isnan(value) else value
+        feature = feature_columns[index]
+        if not explainable(feature, value):
+            continue
+        result.append({
+            'feature': feature,
+            'value': value,
+            'contribution': round(float(contrib_row[index]), 4),
+            'reason': describe(feature, value),
+        })
+    return result
+
+
+def class_contributions(model, X, class_index):
+    """pred_contrib for each row's predicted class, without the bias column"""
+    n_features = X.shape[1]
+    contrib = model.predict(X, pred_contrib=True)
+    if isinstance(contrib, list):  # sparse input returns one matrix per class
+        contrib = np.hstack([c.toarray() for c in contrib])
+    contrib = np.asarray(contrib)
+    if contrib.shape[1] == n_features + 1:  # binary / regression
+        return contrib[:, :n_features]
+    per_class = contrib.reshape(len(X), -1, n_features + 1)
+    return per_class[np.arange(len(X)), class_index, :n_features]
+
+
+def summarize(explanations):
+    """One sentence from the strongest positive reasons across heads"""
+    reasons = []
+    for head in ('mode', 'tens', 'heat'):
+        for item in explanations.get(head) or []:
+            if (item['contribution'] > 0 and explainable(item['feature'], item['value'])
+                    and item['reason'] not in reasons):
+                reasons.append(item['reason'])
+    if not reasons:
+        return None
+    return f"Recommended mainly because of: {', '.join(reasons[:3])}"
+
+
+class LatencyBudget:
+    """Skips explanations when the request has used its budget or recent explanations ran long.
+
+    Tracks an exponentially weighted average of explanation cost; an explanation
+    is attempted only if elapsed + expected cost fits in the budget.
+    """
+
+    def __init__(self, budget_ms=EXPLANATION_BUDGET_MS, alpha=0.2):
+        self.budget_ms = budget_ms
+        self.alpha = alpha
+        self.expected_ms = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self, elapsed_ms):
+        if elapsed_ms + self.expected_ms <= self.budget_ms:
+            return True
+        # Decay so a slow spell does not disable explanations for good
+        with self._lock:
+            self.expected_ms *= 1 - self.alpha
+        return False
+
+    def record(self, cost_ms):
+        with self._lock:
+            if self.expected_ms == 0.0:
+                self.expected_ms = cost_ms
+            else:
+                self.expected_ms = self.alpha * cost_ms + (1 - self.alpha) * self.expected_ms
@@ -0,0 +1,150 @@
+"""
+Request context -> model feature vectors for the local (LightGBM / ONNX) backends
+
+The training features come from gold.ml_features_v1 (see ml_training/features.py).
+Values the API does not receive are filled with the same defaults the feature
+query uses (COALESCE values for user history) or left as NaN, which LightGBM
+treats as missing and the ONNX graph imputes with the training mean.
+"""
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+
+SESSION_HOUR = {'morning': 9, 'afternoon': 14, 'evening': 19, 'night': 22}
+DAYS_SINCE_SIGNUP = {'new_user': 30, 'learning_user': 60, 'experienced_user': 180}
+SESSION_COUNT = {'new_user': 2, 'learning_user': 10, 'experienced_user': 30}
+
+# One-hot encoded in training with pd.get_dummies(prefix=<column>)
+CATEGORICAL_COLUMNS = ['device_size', 'time_of_day_category', 'cycle_phase_estimated',
+                       'age_group', 'user_experience_level', 'cycle_period', 'pain_severity']
+
+
+def _age_group(age):
+    if age < 20:
+        return 'under_20'
+    if age < 25:
+        return '20_24'
+    if age < 30:
+        return '25_29'
+    if age < 35:
+        return '30_34'
+    if age < 40:
+        return '35_39'
+    return '40_plus'
+
+
+def _cycle_period(cycle_day):
+    if cycle_day <= 7:
+        return 'early_cycle'
+    if cycle_day <= 14:
+        return 'mid_cycle'
+    if cycle_day <= 21:
+        return 'late_cycle'
+    return 'very_late_cycle'
+
+
+def raw_features(context, now=None):
+    """Named feature values (before one-hot encoding) for one request context"""
+    now = now or datetime.utcnow()
+    pain = context['current_pain_level'] if context['current_pain_level'] is not None else 5
+    flow = context['current_flow_level'] if context['current_flow_level'] is not None else 0
+    experience = context['user_experience']
+    has_meds = context['has_medications']
+
+    # Real cycle day when the server knows it (main.parse_context, cycle index), else estimated from the flags
+    cycle = context.get('cycle') or {}
+    if cycle.get('cycle_day') is not None:
+        cycle_day = cycle['cycle_day']
+    elif context['is_period_day']:
+        cycle_day = 1
+    elif context['is_ovulation_day']:
+        cycle_day = max(1, context['user_cycle_length'] - 14)
+    else:
+        cycle_day = 15
+
+    if context['is_period_day']:
+        cycle_phase = 'menstrual'
+    elif context['is_ovulation_day']:
+        cycle_phase = 'ovulation'
+    else:
+        cycle_phase = 'other'
+
+    day_of_week = now.isoweekday() % 7 + 1  # BigQuery DAYOFWEEK: Sunday = 1
+
+    return {
+        # Cycle context
+        'days_since_period_start': cycle_day,
+        'is_near_period': int(context['is_period_day']),
+        'cycle_phase_estimated': cycle_phase,
+        'cycle_period': _cycle_period(cycle_day),
+        'period_pain_level': pain,
+        'flow_level': flow,
+        # Medication context
+        'has_pain_medication': int(has_meds),
+        'medication_count': context['medication_count'],
+        'active_medication_count': context['medication_count'],
+        'recent_medication_usage': 1.5,
+        'high_pain_no_med': int(pain >= 7 and not has_meds),
+        'high_pain_with_med': int(pain >= 7 and context['medication_count'] > 0),
+        # User context
+        'age': context['user_age'],
+        'age_group': _age_group(context['user_age']),
+        'cycle_length': context['user_cycle_length'],
+        'period_length': context['user_period_length'],
+        'days_since_signup': DAYS_SINCE_SIGNUP.get(experience, 180),
+        'user_experience_level': experience,
+        # User history: feature query COALESCE defaults, previous_tens_level for TENS
+        'user_avg_heat': 1.0,
+        'user_avg_mode': 2.0,
+        'user_avg_tens': float(context['previous_tens_level']),
+        'user_recent_avg_heat': 1.0,
+        'user_recent_avg_tens': float(context['previous_tens_level']),
+        'user_mode_heat': 1.0,
+        'user_mode_mode': 2.0,
+        'user_mode_tens': float(context['previous_tens_level']),
+        'user_session_count': SESSION_COUNT.get(experience, 30),
+        # Session context
+        'session_hour': SESSION_HOUR.get(context['time_of_day'], 22),
+        'time_of_day_category': context['time_of_day'],
+        'day_of_week': day_of_week,
+        'day_of_week_num': day_of_week,
+        'is_weekend': int(day_of_week in (1, 7)),
+        'input_pain_level': pain,
+        'pain_level_before': pain,
+        'pain_severity': 'low_pain' if pain <= 3 else ('medium_pain' if pain <= 6 else 'high_pain'),
+        # Not known before the session
+        'delta_heat': 0,
+        'delta_tens': 0,
+        'delta_mode': 0,
+        'device_size': 'Unknown',
+    }
+
+
+@lru_cache(maxsize=16)
+def _column_plan(feature_columns):
+    """(name, category, category value) per feature column; category is None for numeric columns"""
+    plan = []
+    for name in feature_columns:
+        for category in CATEGORICAL_COLUMNS:
+            prefix = f'{category}_'
+            if name.startswith(prefix):
+                plan.append((name, category, name[len(prefix):]))
+                break
+        else:
+            plan.append((name, None, None))
+    return plan
+
+
+def build_matrix(contexts, feature_columns, now=None):
+    """float32 matrix (n_contexts x n_features) in training column order"""
+    plan = _column_plan(tuple(feature_columns))
+    matrix = np.full((len(contexts), len(plan)), np.nan, dtype=np.float32)
+    for row, context in enumerate(contexts):
+        raw = raw_features(context, now=now)
+        for col, (name, category, category_value) in enumerate(plan):
+            if category is not None:
+                matrix[row, col] = 1.0 if raw[category] == category_value else 0.0
+            elif name in raw:
+                matrix[row, col] = raw[name]
+    return matrix
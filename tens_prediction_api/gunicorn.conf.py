@@ -0,0 +1,26 @@
+"""
+gunicorn settings for the ASGI app (asgi_app.py) with models shared across workers
+
+The master loads the serving / fallback / shadow models once (shared_assets.preload)
+and then forks the uvicorn workers, which reuse those objects through copy-on-write
+pages instead of each unpickling a copy. The app itself (prediction log writer,
+registry poller, drift monitor threads) is still imported per worker, after the fork.
+
+Usage:
+    MODEL_DIR=../models PREDICTION_BACKEND=lightgbm gunicorn asgi_app:app -c gunicorn.conf.py
+    curl localhost:8080/diagnostics/memory
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '4'))
+worker_class = 'uvicorn.workers.UvicornWorker'
+# Threads started at import would not survive the fork, so only the models are preloaded
+preload_app = False
+timeout = int(os.environ.get('WORKER_TIMEOUT_SECONDS', '60'))
+graceful_timeout = 30
+
+
+def on_starting(server):
+    import shared_assets
+    shared_assets.preload()
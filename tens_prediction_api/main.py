@@ -1,16 +1,355 @@
-import functions_framework
-from google.cloud import bigquery
 import json
+import os
+import time
+import uuid
+from datetime import date, datetime, timezone
+
+import functions_framework
 from flask import jsonify
 
-# Initialize BigQuery client
-client = bigquery.Client()
+from backends import recommended_settings
+from cycle_index import load_cycle_index
+from drift import DriftMonitor, load_reference
+from explanations import DEFAULT_TOP_K, LatencyBudget, summarize
+from model_manager import ModelManager
+from prediction_log import create_prediction_logger
+from resilience import ResilientPredictor
+from shadow import create_shadow_scorer
+from singleflight import SingleFlight, request_key
+
+# Serving model: PREDICTION_BACKEND defaults, hot-reloaded from the model registry (model_manager.py)
+_models = ModelManager()
+_models.start()  # deployed default now, registry version in the background (never on the request path)
+_monitors_started = False
+_drift_monitor = None
+_shadow_scorer = None
+_explanation_budget = LatencyBudget()
+_single_flight = SingleFlight()
+# Deadline, concurrency limit, circuit breakers and fallback tiers (resilience.py)
+_resilience = ResilientPredictor()
+
+METRICS_LOG_SECONDS = float(os.environ.get('METRICS_LOG_SECONDS', '300'))
+_last_metrics_log = time.monotonic()
+
+# Server-side cycle flags for known user_ids (cycle_index.py); None until the index is exported
+_cycle_index = load_cycle_index()
+
+# Non-blocking prediction log (PREDICTION_LOG_SINK env var); created at import so it can hook SIGTERM
+_prediction_log = create_prediction_logger()
+
+
+def get_backend():
+    """Current serving backend; callers keep the returned object for the whole request"""
+    global _monitors_started, _drift_monitor, _shadow_scorer
+    backend = _models.current()
+    if not _monitors_started:
+        _monitors_started = True
+        _resilience.warm_fallback(backend.name)
+        _shadow_scorer = create_shadow_scorer(backend.name, prediction_log=_prediction_log)
+        reference = load_reference() if os.environ.get('DRIFT_MONITOR', 'on') == 'on' else None
+        if reference:
+            _drift_monitor = DriftMonitor(reference, model_version=backend.version)
+    if _drift_monitor:
+        _drift_monitor.model_version = backend.version  # follows hot reloads
+    return backend
+
+
+def observe_predictions(request_id, contexts, predictions, elapsed_ms):
+    """Feed served primary-model predictions to drift monitoring and shadow scoring (non-blocking)"""
+    served = [i for i, prediction in enumerate(predictions) if not prediction['degraded']]
+    if not served:
+        return
+    contexts = [contexts[i] for i in served]
+    predictions = [predictions[i] for i in served]
+    if _drift_monitor:
+        _drift_monitor.observe(contexts, predictions)
+    if _shadow_scorer:
+        _shadow_scorer.submit(request_id, contexts, predictions, elapsed_ms)
+
+
+def service_stats():
+    """Counters of the serving components (admission/fallbacks, coalescing, prediction log, shadow scoring)"""
+    return {
+        'resilience': _resilience.stats(),
+        'coalescing': _single_flight.stats(),
+        'prediction_log': _prediction_log.stats() if _prediction_log else None,
+        'shadow': _shadow_scorer.summary() if _shadow_scorer else None,
+    }
+
+
+def _maybe_log_metrics():
+    # One structured log line per METRICS_LOG_SECONDS (usable as a log-based metric)
+    global _last_metrics_log
+    now = time.monotonic()
+    if now - _last_metrics_log >= METRICS_LOG_SECONDS:
+        _last_metrics_log = now
+        print(json.dumps({'severity': 'INFO', 'message': '📊 Prediction API stats', 'stats': service_stats()}))
+
+
+CYCLE_FIELDS = ('user_cycle_length', 'user_period_length', 'is_period_day', 'is_ovulation_day')
+
+
+def cycle_from_index(request_json, on_date):
+    """Indexed cycle lengths and flags of request_json's user_id on on_date, or None"""
+    user_id = request_json.get('user_id')
+    if _cycle_index is None or not user_id or all(field in request_json for field in CYCLE_FIELDS):
+        return None
+    # Valid client lengths take part in the projection; invalid ones are rejected by parse_context
+    cycle_length = request_json.get('user_cycle_length')
+    period_length = request_json.get('user_period_length')
+    return _cycle_index.derive(
+        user_id, on_date,
+        cycle_length if isinstance(cycle_length, int) and 21 <= cycle_length <= 45 else None,
+        period_length if isinstance(period_length, int) and 2 <= period_length <= 10 else None)
+
+
+def parse_context(request_json):
+    """
+    Extract and validate request parameters.
+    Returns (context, None) on success or (None, error message) on invalid input.
+    """
+    on_date = request_json.get('date')  # Optional ISO date the cycle flags are for, default today (UTC)
+    try:
+        on_date = date.fromisoformat(on_date) if on_date is not None else datetime.now(timezone.utc).date()
+    except (TypeError, ValueError):
+        return None, 'date must be an ISO date (YYYY-MM-DD) or null'
+
+    # Cycle fields the client leaves out come from the cycle index; client values always win
+    derived = cycle_from_index(request_json, on_date)
+    cycle = dict(derived or {})
+    cycle.update({field: request_json[field] for field in CYCLE_FIELDS if field in request_json})
+    # The derived cycle day feeds the model (features.raw_features) unless client flags contradict it
+    if derived and any(bool(cycle[flag]) != derived[flag] for flag in ('is_period_day', 'is_ovulation_day')):
+        derived = None
+
+    context = {
+        'user_id': request_json.get('user_id'),  # Optional
+        'user_age': request_json.get('user_age', 28),
+        'user_cycle_length': cycle.get('user_cycle_length', 30),
+        'user_period_length': cycle.get('user_period_length', 5),
+        'is_period_day': cycle.get('is_period_day', False),
+        'is_ovulation_day': cycle.get('is_ovulation_day', False),
+        'current_pain_level': request_json.get('current_pain_level'),  # Can be None
+        'current_flow_level': request_json.get('current_flow_level'),  # Can be None
+        'has_medications': request_json.get('has_medications', False),
+        'medication_count': request_json.get('medication_count', 0),
+        'user_experience': request_json.get('user_experience', 'experienced_user'),
+        'time_of_day': request_json.get('time_of_day', 'afternoon'),
+        'previous_tens_level': request_json.get('previous_tens_level', 5),
+        'tens_mode': request_json.get('tens_mode', 'continuous'),
+        'explain': request_json.get('explain', False),
+        'explain_top_k': request_json.get('explain_top_k', DEFAULT_TOP_K),
+        'cycle': {
+            'source': 'index' if derived else 'request',
+            'cycle_day': derived['cycle_day'] if derived else None,
+            'cycle_phase': derived['cycle_phase'] if derived else None,
+        },
+    }
+
+    if not isinstance(context['user_age'], int) or not (13 <= context['user_age'] <= 80):
+        return None, 'user_age must be an integer between 13 and 80'
+
+    if not isinstance(context['user_cycle_length'], int) or not (21 <= context['user_cycle_length'] <= 45):
+        return None, 'user_cycle_length must be an integer between 21 and 45'
+
+    if not isinstance(context['user_period_length'], int) or not (2 <= context['user_period_length'] <= 10):
+        return None, 'user_period_length must be an integer between 2 and 10'
+
+    if not isinstance(context['is_period_day'], bool):
+        return None, 'is_period_day must be a boolean'
+
+    if not isinstance(context['is_ovulation_day'], bool):
+        return None, 'is_ovulation_day must be a boolean'
+
+    pain = context['current_pain_level']
+    if pain is not None and (not isinstance(pain, int) or not (0 <= pain <= 10)):
+        return None, 'current_pain_level must be an integer between 0 and 10 or null'
+
+    flow = context['current_flow_level']
+    if flow is not None and (not isinstance(flow, int) or not (0 <= flow <= 5)):
+        return None, 'current_flow_level must be an integer between 0 and 5 or null'
+
+    if not isinstance(context['has_medications'], bool):
+        return None, 'has_medications must be a boolean'
+
+    if not isinstance(context['medication_count'], int) or context['medication_count'] < 0:
+        return None, 'medication_count must be a non-negative integer'
+
+    if context['user_experience'] not in ['new_user', 'learning_user', 'experienced_user']:
+        return None, 'user_experience must be one of: new_user, learning_user, experienced_user'
+
+    if context['time_of_day'] not in ['morning', 'afternoon', 'evening', 'night']:
+        return None, 'time_of_day must be one of: morning, afternoon, evening, night'
+
+    if not isinstance(context['previous_tens_level'], int) or not (0 <= context['previous_tens_level'] <= 10):
+        return None, 'previous_tens_level must be an integer between 0 and 10'
+
+    if context['tens_mode'] not in ['continuous', 'burst', 'modulation', 'strength']:
+        return None, 'tens_mode must be one of: continuous, burst, modulation, strength'
+
+    if not isinstance(context['explain'], bool):
+        return None, 'explain must be a boolean'
+
+    if not isinstance(context['explain_top_k'], int) or not (1 <= context['explain_top_k'] <= 10):
+        return None, 'explain_top_k must be an integer between 1 and 10'
+
+    return context, None
+
+
+def explain_predictions(backend, contexts, predictions, elapsed_ms):
+    """
+    Feature-contribution explanations for the contexts that asked for them.
+    Returns (explanations or None per context, status).
+    """
+    wanted = [i for i, context in enumerate(contexts) if context['explain']]
+    if not wanted:
+        return [None] * len(contexts), None
+    if any(predictions[i].get('degraded') for i in wanted):
+        return [None] * len(contexts), 'skipped_degraded'
+    if not hasattr(backend, 'explain'):
+        return [None] * len(contexts), 'unsupported_backend'
+    if not _explanation_budget.allow(elapsed_ms):
+        return [None] * len(contexts), 'skipped_latency_budget'
+
+    start = time.perf_counter()
+    top_k = max(contexts[i]['explain_top_k'] for i in wanted)
+    explained = backend.explain([contexts[i] for i in wanted], [predictions[i] for i in wanted], top_k)
+    _explanation_budget.record((time.perf_counter() - start) * 1000)
+
+    explanations = [None] * len(contexts)
+    for i, explanation in zip(wanted, explained):
+        k = contexts[i]['explain_top_k']
+        explanations[i] = {head: items[:k] if items else items for head, items in explanation.items()}
+    return explanations, 'ok'
+
+
+def log_prediction(request_id, context, result, backend, latency_ms, status_code):
+    """Queue one predictions_log row (returns immediately)"""
+    if _prediction_log is None:
+        return
+    _prediction_log.log({
+        'request_id': request_id,
+        'logged_at': int(time.time() * 1_000_000),
+        'user_id': context.get('user_id') if context else None,
+        # Degraded answers are attributed to the tier that served them (resilience.py)
+        'backend': result.get('served_by') or (backend.name if backend else None),
+        'role': 'primary',
+        'model_version': result.get('model_version') or (backend.version if backend else None),
+        'latency_ms': latency_ms,
+        'status_code': status_code,
+        'inputs': context,
+        'outputs': result,
+    })
+
+
+def build_recommendation(context, prediction, model_version, explanations=None, explanation_status=None):
+    """Apply the hierarchical rules and build the API response for one prediction"""
+    is_period_day = context['is_period_day']
+    is_ovulation_day = context['is_ovulation_day']
+    current_pain_level = context['current_pain_level']
+    has_medications = context['has_medications']
+    user_experience = context['user_experience']
+
+    predicted_mode = prediction['mode']
+    predicted_tens = prediction['tens']
+    predicted_heat = prediction['heat']
+
+    # Apply hierarchical logic (TENS off when mode=0)
+    recommended_heat_level, _, recommended_tens_level = recommended_settings(prediction)
+
+    # Calculate confidence and explanations
+    confidence_score = 0.75  # Base confidence
+    if is_period_day and current_pain_level and current_pain_level >= 7:
+        confidence_score = 0.95
+    elif is_period_day and current_pain_level and current_pain_level >= 4:
+        confidence_score = 0.85
+    elif user_experience == 'experienced_user':
+        confidence_score = 0.80
+    elif predicted_mode == 0:
+        confidence_score = 0.90  # High confidence for off mode
+
+    # Generate explanation
+    if predicted_mode == 0:
+        explanation = "TENS therapy not recommended at this time - consider heat therapy only"
+    elif predicted_mode == 1 and is_period_day and current_pain_level and current_pain_level >= 8:
+        explanation = "Low intensity TENS recommended for severe period pain"
+    elif predicted_mode == 2 and is_period_day and current_pain_level and current_pain_level >= 6:
+        explanation = "Medium intensity TENS recommended for moderate period pain"
+    elif predicted_mode == 3 and is_period_day and current_pain_level and current_pain_level >= 6:
+        explanation = "High intensity TENS recommended for significant period pain"
+    elif is_period_day and current_pain_level and current_pain_level >= 8:
+        explanation = "High period pain detected - stronger therapy recommended for effective relief"
+    elif is_period_day and current_pain_level and current_pain_level >= 6:
+        explanation = "Moderate period pain - adjusted therapy for menstrual comfort"
+    elif is_period_day:
+        explanation = "Period day detected - gentle therapy optimized for menstrual cycle"
+    elif is_ovulation_day:
+        explanation = "Ovulation day - therapy adjusted for mid-cycle comfort"
+    elif has_medications and current_pain_level and current_pain_level >= 6:
+        explanation = "Pain medication usage considered - complementary therapy level"
+    elif user_experience == 'new_user':
+        explanation = "Gentle introduction setting for new user comfort and safety"
+    elif user_experience == 'experienced_user':
+        explanation = "Personalized setting based on your therapy history and preferences"
+    else:
+        explanation = "Intelligent recommendation based on your profile and current context"
+
+    # Model-based explanation when feature contributions are available
+    if explanations:
+        explanation = summarize(explanations) or explanation
+
+    # Additional guidance
+    if predicted_mode == 0:
+        guidance = "Focus on heat therapy and consider non-TENS pain management options"
+    elif is_period_day and current_pain_level and current_pain_level >= 6:
+        guidance = "Consider combining with heat therapy for enhanced relief"
+    elif current_pain_level and current_pain_level >= 8:
+        guidance = "Monitor comfort level and adjust as needed during session"
+    elif user_experience == 'new_user':
+        guidance = "Start with shorter sessions (15-20 minutes) to build tolerance"
+    elif predicted_mode >= 2:
+        guidance = "Ensure proper electrode placement for optimal effectiveness"
+    else:
+        guidance = "Adjust based on comfort and effectiveness during therapy"
+
+    result = {
+        'recommended_tens_mode': predicted_mode,
+        'recommended_tens_level': recommended_tens_level,
+        'recommended_heat_level': recommended_heat_level,
+        'confidence_score': confidence_score,
+        'recommendation_explanation': explanation,
+        'additional_guidance': guidance,
+        'context_used': {
+            'is_period_day': is_period_day,
+            'is_ovulation_day': is_ovulation_day,
+            'current_pain_level': current_pain_level,
+            'has_medications': has_medications,
+            'user_experience': user_experience,
+            'time_of_day': context['time_of_day'],
+            'tens_mode': context['tens_mode'],
+            'predicted_mode': predicted_mode,
+            'cycle': context.get('cycle')
+        },
+        'prediction_timestamp': datetime.utcnow().isoformat(timespec='microseconds'),
+        'model_version': prediction.get('model_version', model_version),
+        'raw_mode_prediction': predicted_mode,
+        'raw_tens_prediction': predicted_tens,
+        'raw_heat_prediction': predicted_heat,
+        'degraded': prediction.get('degraded', False),
+        'served_by': prediction.get('served_by')
+    }
+    if result['degraded']:
+        result['degraded_reason'] = prediction.get('degraded_reason')
+    if context['explain']:
+        result['feature_contributions'] = explanations
+        result['explanation_status'] = explanation_status
+    return result
 
 
 @functions_framework.http
 def predict_tens_level(request):
     """
-    Cloud Function to predict TENS level using the trained BigQuery ML model.
+    Cloud Function to predict TENS level using the configured prediction backend.
     Expects a POST request with JSON body containing user parameters.
     """
 
@@ -30,338 +369,50 @@ def predict_tens_level(request):
     if request.method != 'POST':
         return (jsonify({'error': 'Method not allowed. Use POST.'}), 405, headers)
 
+    request_id = request.headers.get('X-Request-Id') or uuid.uuid4().hex
+    request_start = time.perf_counter()
+    context = None
+    backend = None
+
     try:
         # Parse request data
         request_json = request.get_json(silent=True)
         if not request_json:
             return (jsonify({'error': 'Invalid JSON in request body'}), 400, headers)
 
-        # Extract parameters with defaults
-        user_id = request_json.get('user_id')  # Optional
-        user_age = request_json.get('user_age', 28)
-        user_cycle_length = request_json.get('user_cycle_length', 30)
-        user_period_length = request_json.get('user_period_length', 5)
-        is_period_day = request_json.get('is_period_day', False)
-        is_ovulation_day = request_json.get('is_ovulation_day', False)
-        current_pain_level = request_json.get('current_pain_level')  # Can be None
-        current_flow_level = request_json.get('current_flow_level')  # Can be None
-        has_medications = request_json.get('has_medications', False)
-        medication_count = request_json.get('medication_count', 0)
-        user_experience = request_json.get('user_experience', 'experienced_user')
-        time_of_day = request_json.get('time_of_day', 'afternoon')
-        previous_tens_level = request_json.get('previous_tens_level', 5)
-        tens_mode = request_json.get('tens_mode', 'continuous')  # New parameter
-
-        # Validate required parameters
-        if not isinstance(user_age, int) or not (13 <= user_age <= 80):
-            return (jsonify({'error': 'user_age must be an integer between 13 and 80'}), 400, headers)
-
-        if not isinstance(user_cycle_length, int) or not (21 <= user_cycle_length <= 45):
-            return (jsonify({'error': 'user_cycle_length must be an integer between 21 and 45'}), 400, headers)
-
-        if not isinstance(user_period_length, int) or not (2 <= user_period_length <= 10):
-            return (jsonify({'error': 'user_period_length must be an integer between 2 and 10'}), 400, headers)
-
-        if not isinstance(is_period_day, bool):
-            return (jsonify({'error': 'is_period_day must be a boolean'}), 400, headers)
-
-        if not isinstance(is_ovulation_day, bool):
-            return (jsonify({'error': 'is_ovulation_day must be a boolean'}), 400, headers)
-
-        if current_pain_level is not None and (not isinstance(current_pain_level, int) or not (0 <= current_pain_level <= 10)):
-            return (jsonify({'error': 'current_pain_level must be an integer between 0 and 10 or null'}), 400, headers)
-
-        if current_flow_level is not None and (not isinstance(current_flow_level, int) or not (0 <= current_flow_level <= 5)):
-            return (jsonify({'error': 'current_flow_level must be an integer between 0 and 5 or null'}), 400, headers)
-
-        if not isinstance(has_medications, bool):
-            return (jsonify({'error': 'has_medications must be a boolean'}), 400, headers)
-
-        if not isinstance(medication_count, int) or medication_count < 0:
-            return (jsonify({'error': 'medication_count must be a non-negative integer'}), 400, headers)
-
-        if user_experience not in ['new_user', 'learning_user', 'experienced_user']:
-            return (jsonify({'error': 'user_experience must be one of: new_user, learning_user, experienced_user'}), 400, headers)
-
-        if time_of_day not in ['morning', 'afternoon', 'evening', 'night']:
-            return (jsonify({'error': 'time_of_day must be one of: morning, afternoon, evening, night'}), 400, headers)
-
-        if not isinstance(previous_tens_level, int) or not (0 <= previous_tens_level <= 10):
-            return (jsonify({'error': 'previous_tens_level must be an integer between 0 and 10'}), 400, headers)
-
-        if tens_mode not in ['continuous', 'burst', 'modulation', 'strength']:
-            return (jsonify({'error': 'tens_mode must be one of: continuous, burst, modulation, strength'}), 400, headers)
-
-                # Step 1: Predict TENS mode using the trained model
-        mode_query = f"""
-        SELECT predicted_tens_mode
-        FROM ML.PREDICT(
-          MODEL `junoplus-dev.junoplus_analytics.tens_mode_model`,
-          (SELECT
-            {user_age} as age,
-            {user_cycle_length} as cycle_length,
-            {user_period_length} as period_length,
-            {str(is_period_day).lower()} as is_period_day,
-            {str(is_ovulation_day).lower()} as is_ovulation_day,
-            {current_pain_level if current_pain_level is not None else 'NULL'} as pain_level,
-            {current_flow_level if current_flow_level is not None else 'NULL'} as flow_level,
-            {str(has_medications).lower()} as has_medications,
-            {medication_count} as medication_count,
-            CASE
-              WHEN '{user_experience}' = 'new_user' THEN 0
-              WHEN '{user_experience}' = 'experienced_user' THEN 1
-              WHEN '{user_experience}' = 'expert_user' THEN 2
-              ELSE 1
-            END as user_experience_encoded,
-            CASE
-              WHEN '{time_of_day}' = 'morning' THEN 0
-              WHEN '{time_of_day}' = 'afternoon' THEN 1
-              WHEN '{time_of_day}' = 'evening' THEN 2
-              WHEN '{time_of_day}' = 'night' THEN 3
-              ELSE 1
-            END as time_of_day_encoded,
-            {previous_tens_level} as previous_tens_level,
-            2 as previous_heat_level
-          )
-        )
-        """
-
-        # Execute mode prediction
-        mode_job = client.query(mode_query)
-        mode_results = list(mode_job.result())
-        if not mode_results:
-            return (jsonify({'error': 'Mode prediction failed'}), 500, headers)
-
-        predicted_mode = int(mode_results[0]['predicted_tens_mode'])
-
-        # Step 2: Predict TENS level using the trained model
-        level_query = f"""
-        SELECT predicted_target_tens_level as tens_prediction
-        FROM ML.PREDICT(
-          MODEL `junoplus-dev.junoplus_analytics.tens_predictor_production_vertex`,
-          (SELECT
-            {user_age} as age,
-            {user_cycle_length} as cycle_length,
-            {user_period_length} as period_length,
-            {str(is_period_day).lower()} as is_period_day,
-            {str(is_ovulation_day).lower()} as is_ovulation_day,
-            {current_pain_level if current_pain_level is not None else 5} as period_pain_level,
-            {current_flow_level if current_flow_level is not None else 0} as flow_level,
-            {str(has_medications).lower()} as has_pain_medication,
-            {medication_count} as medication_count,
-            1.5 as recent_medication_usage,
-            CASE
-              WHEN '{time_of_day}' = 'morning' THEN 9
-              WHEN '{time_of_day}' = 'afternoon' THEN 14
-              WHEN '{time_of_day}' = 'evening' THEN 19
-              ELSE 22
-            END as session_hour,
-            EXTRACT(DAYOFWEEK FROM CURRENT_DATE()) as day_of_week,
-            CASE
-              WHEN '{user_experience}' = 'new_user' THEN 30
-              WHEN '{user_experience}' = 'learning_user' THEN 60
-              ELSE 180
-            END as days_since_signup,
-            {previous_tens_level} as initial_tens_level,
-            {current_pain_level if current_pain_level is not None else 5} as input_pain_level
-          )
-        )
-        """
-
-        # Execute level prediction
-        level_job = client.query(level_query)
-        level_results = list(level_job.result())
-        if not level_results:
-            return (jsonify({'error': 'Level prediction failed'}), 500, headers)
-
-        predicted_tens = float(level_results[0]['tens_prediction'])
-
-        # Step 3: Predict heat level using the trained model
-        heat_query = f"""
-        SELECT predicted_target_heat_level as heat_prediction
-        FROM ML.PREDICT(
-          MODEL `junoplus-dev.junoplus_analytics.heat_predictor_production_vertex`,
-          (SELECT
-            {user_age} as age,
-            {user_cycle_length} as cycle_length,
-            {user_period_length} as period_length,
-            {str(is_period_day).lower()} as is_period_day,
-            {str(is_ovulation_day).lower()} as is_ovulation_day,
-            {current_pain_level if current_pain_level is not None else 5} as period_pain_level,
-            {current_flow_level if current_flow_level is not None else 0} as flow_level,
-            {str(has_medications).lower()} as has_pain_medication,
-            {medication_count} as medication_count,
-            1.5 as recent_medication_usage,
-            CASE
-              WHEN '{time_of_day}' = 'morning' THEN 9
-              WHEN '{time_of_day}' = 'afternoon' THEN 14
-              WHEN '{time_of_day}' = 'evening' THEN 19
-              ELSE 22
-            END as session_hour,
-            EXTRACT(DAYOFWEEK FROM CURRENT_DATE()) as day_of_week,
-            CASE
-              WHEN '{user_experience}' = 'new_user' THEN 30
-              WHEN '{user_experience}' = 'learning_user' THEN 60
-              ELSE 180
-            END as days_since_signup,
-            {previous_tens_level} as initial_tens_level,
-            {current_pain_level if current_pain_level is not None else 5} as input_pain_level
-          )
-        )
-        """
-
-        # Execute heat prediction
-        heat_job = client.query(heat_query)
-        heat_results = list(heat_job.result())
-        if not heat_results:
-            return (jsonify({'error': 'Heat prediction failed'}), 500, headers)
-
-        predicted_heat = float(heat_results[0]['heat_prediction'])
-
-        # Step 2: Predict TENS level and heat level using existing models
-        level_query = f"""
-        SELECT
-          predicted_target_tens_level as tens_prediction
-        FROM ML.PREDICT(
-          MODEL `junoplus-dev.junoplus_analytics.tens_predictor_production_vertex`,
-          (SELECT
-            {user_age} as age,
-            {user_cycle_length} as cycle_length,
-            {user_period_length} as period_length,
-            {str(is_period_day).lower()} as is_period_day,
-            {str(is_ovulation_day).lower()} as is_ovulation_day,
-            {current_pain_level if current_pain_level is not None else 5} as period_pain_level,
-            {current_flow_level if current_flow_level is not None else 0} as flow_level,
-            {str(has_medications).lower()} as has_pain_medication,
-            {medication_count} as medication_count,
-            1.5 as recent_medication_usage,
-            CASE
-              WHEN '{time_of_day}' = 'morning' THEN 9
-              WHEN '{time_of_day}' = 'afternoon' THEN 14
-              WHEN '{time_of_day}' = 'evening' THEN 19
-              ELSE 22
-            END as session_hour,
-            EXTRACT(DAYOFWEEK FROM CURRENT_DATE()) as day_of_week,
-            CASE
-              WHEN '{user_experience}' = 'new_user' THEN 30
-              WHEN '{user_experience}' = 'learning_user' THEN 60
-              ELSE 180
-            END as days_since_signup,
-            {previous_tens_level} as initial_tens_level,
-            {current_pain_level if current_pain_level is not None else 5} as input_pain_level
-          )
-        )
-        """
-
-        # Execute level prediction
-        level_job = client.query(level_query)
-        level_results = list(level_job.result())
-        if not level_results:
-            return (jsonify({'error': 'Level prediction failed'}), 500, headers)
-
-        predicted_tens = float(level_results[0]['tens_prediction'])
-        
-        # For heat prediction, use a simple heuristic since the model might not exist
-        if current_pain_level and current_pain_level >= 8:
-            predicted_heat = 3
-        elif current_pain_level and current_pain_level >= 6:
-            predicted_heat = 2
-        elif is_period_day:
-            predicted_heat = 2
-        else:
-            predicted_heat = 1
-
-        # Step 3: Apply hierarchical logic
-        if predicted_mode == 0:
-            recommended_tens_level = 0  # TENS off when mode=0
-        else:
-            recommended_tens_level = round(max(1, min(10, predicted_tens)))
-
-        recommended_heat_level = round(max(0, min(3, predicted_heat)))
-
-        # Step 4: Calculate confidence and explanations
-        confidence_score = 0.75  # Base confidence
-        if is_period_day and current_pain_level and current_pain_level >= 7:
-            confidence_score = 0.95
-        elif is_period_day and current_pain_level and current_pain_level >= 4:
-            confidence_score = 0.85
-        elif user_experience == 'experienced_user':
-            confidence_score = 0.80
-        elif predicted_mode == 0:
-            confidence_score = 0.90  # High confidence for off mode
-
-        # Generate explanation
-        if predicted_mode == 0:
-            explanation = "TENS therapy not recommended at this time - consider heat therapy only"
-        elif predicted_mode == 1 and is_period_day and current_pain_level and current_pain_level >= 8:
-            explanation = "Low intensity TENS recommended for severe period pain"
-        elif predicted_mode == 2 and is_period_day and current_pain_level and current_pain_level >= 6:
-            explanation = "Medium intensity TENS recommended for moderate period pain"
-        elif predicted_mode == 3 and is_period_day and current_pain_level and current_pain_level >= 6:
-            explanation = "High intensity TENS recommended for significant period pain"
-        elif is_period_day and current_pain_level and current_pain_level >= 8:
-            explanation = "High period pain detected - stronger therapy recommended for effective relief"
-        elif is_period_day and current_pain_level and current_pain_level >= 6:
-            explanation = "Moderate period pain - adjusted therapy for menstrual comfort"
-        elif is_period_day:
-            explanation = "Period day detected - gentle therapy optimized for menstrual cycle"
-        elif is_ovulation_day:
-            explanation = "Ovulation day - therapy adjusted for mid-cycle comfort"
-        elif has_medications and current_pain_level and current_pain_level >= 6:
-            explanation = "Pain medication usage considered - complementary therapy level"
-        elif user_experience == 'new_user':
-            explanation = "Gentle introduction setting for new user comfort and safety"
-        elif user_experience == 'experienced_user':
-            explanation = "Personalized setting based on your therapy history and preferences"
-        else:
-            explanation = "Intelligent recommendation based on your profile and current context"
-
-        # Additional guidance
-        if predicted_mode == 0:
-            guidance = "Focus on heat therapy and consider non-TENS pain management options"
-        elif is_period_day and current_pain_level and current_pain_level >= 6:
-            guidance = "Consider combining with heat therapy for enhanced relief"
-        elif current_pain_level and current_pain_level >= 8:
-            guidance = "Monitor comfort level and adjust as needed during session"
-        elif user_experience == 'new_user':
-            guidance = "Start with shorter sessions (15-20 minutes) to build tolerance"
-        elif predicted_mode >= 2:
-            guidance = "Ensure proper electrode placement for optimal effectiveness"
-        else:
-            guidance = "Adjust based on comfort and effectiveness during therapy"
-
-        # Build response
-        result_dict = {
-            'recommended_tens_mode': predicted_mode,
-            'recommended_tens_level': recommended_tens_level,
-            'recommended_heat_level': recommended_heat_level,
-            'confidence_score': confidence_score,
-            'recommendation_explanation': explanation,
-            'additional_guidance': guidance,
-            'context_used': {
-                'is_period_day': is_period_day,
-                'is_ovulation_day': is_ovulation_day,
-                'current_pain_level': current_pain_level,
-                'has_medications': has_medications,
-                'user_experience': user_experience,
-                'time_of_day': time_of_day,
-                'tens_mode': tens_mode,
-                'predicted_mode': predicted_mode
-            },
-            'prediction_timestamp': '2025-01-01T00:00:00.000000',  # Placeholder
-            'model_version': 'multi_model_prediction',
-            'raw_mode_prediction': predicted_mode,
-            'raw_tens_prediction': predicted_tens,
-            'raw_heat_prediction': predicted_heat
-        }
+        context, error = parse_context(request_json)
+        if error:
+            return (jsonify({'error': error}), 400, headers)
+
+        backend = get_backend()
+        start = time.perf_counter()
+        # Identical concurrent requests share one prediction; the deadline budget starts at request_start
+        key = request_key(context, backend.version)
+        prediction, coalesced = _single_flight.do(
+            key, lambda: _resilience.predict(backend, context, key, started_at=request_start))
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if not coalesced:
+            observe_predictions(request_id, [context], [prediction], elapsed_ms)
+
+        explanations, explanation_status = explain_predictions(backend, [context], [prediction], elapsed_ms)
+        result_dict = build_recommendation(context, prediction, backend.version,
+                                           explanations[0], explanation_status)
+        result_dict['request_id'] = request_id
+
+        log_prediction(request_id, context, result_dict, backend,
+                       (time.perf_counter() - request_start) * 1000, 200)
+        _maybe_log_metrics()
 
         # Return successful response
+        if coalesced:
+            headers['X-Coalesced'] = 'true'
+        if prediction['degraded']:
+            headers['X-Degraded'] = prediction['degraded_reason']
         return (jsonify(result_dict), 200, headers)
 
     except Exception as e:
         print(f"Error processing request: {str(e)}")
-        return (jsonify({'error': f'Internal server error: {str(e)}'}), 500, headers)
-
-
-
-        
\ No newline at end of file
+        error_dict = {'error': 'Internal server error', 'request_id': request_id}
+        log_prediction(request_id, context, error_dict, backend,
+                       (time.perf_counter() - request_start) * 1000, 500)
+        return (jsonify(error_dict), 500, headers)
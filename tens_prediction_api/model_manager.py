@@ -0,0 +1,244 @@
+"""
+Hot model reload for the prediction API
+
+The active model comes from gold.model_registry (deployment_status = 'active'
+for the serving backend) or, when MODEL_MANIFEST is set, from a local JSON
+manifest with the same fields:
+
+    {"model_id": "tens_lgbm_20261019", "serving_backend": "lightgbm",
+     "model_uri": "gs://junoplus-models/tens/lgbm_20261019/", "serving_config": {}}
+
+start() (called at import by main.py) loads the deployed default eagerly, so
+no request waits on the registry; the active version is then looked up in the
+background (registry queries time out after MODEL_REGISTRY_TIMEOUT_SECONDS)
+and the thread polls the source every MODEL_POLL_SECONDS. A new version
+is downloaded and loaded off the request path, checked on a small canary
+input set, and then swapped in with a single reference assignment. Requests
+take the current backend once at the start, so in-flight requests finish on
+the version they started with. If a version fails to load or validate, the
+serving version is kept and the failed one is not retried.
+"""
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from backends import BACKENDS, create_backend
+from shared_assets import preloaded
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ID = os.environ.get('PROJECT_ID', 'junoplus-dev')
+MODEL_REGISTRY_TABLE = os.environ.get('MODEL_REGISTRY_TABLE', f'{PROJECT_ID}.junoplus_analytics_gold.model_registry')
+POLL_SECONDS = float(os.environ.get('MODEL_POLL_SECONDS', '60'))
+REGISTRY_TIMEOUT_SECONDS = float(os.environ.get('MODEL_REGISTRY_TIMEOUT_SECONDS', '10'))
+ARTIFACT_DIR = os.environ.get('MODEL_ARTIFACT_DIR', os.path.join(tempfile.gettempdir(), 'tens_models'))
+
+_CANARY_BASE = {
+    'user_id': None, 'user_age': 28, 'user_cycle_length': 30, 'user_period_length': 5,
+    'is_period_day': False, 'is_ovulation_day': False, 'current_pain_level': None,
+    'current_flow_level': None, 'has_medications': False, 'medication_count': 0,
+    'user_experience': 'experienced_user', 'time_of_day': 'afternoon', 'previous_tens_level': 5,
+    'tens_mode': 'continuous', 'explain': False, 'explain_top_k': 3,
+}
+
+# Representative requests every candidate model must score sensibly before it serves
+CANARY_CONTEXTS = [
+    {**_CANARY_BASE},
+    {**_CANARY_BASE, 'is_period_day': True, 'current_pain_level': 8, 'current_flow_level': 3,
+     'has_medications': True, 'medication_count': 2},
+    {**_CANARY_BASE, 'is_ovulation_day': True, 'current_pain_level': 4, 'time_of_day': 'morning'},
+    {**_CANARY_BASE, 'user_experience': 'new_user', 'user_age': 19, 'previous_tens_level': 0,
+     'time_of_day': 'night'},
+    {**_CANARY_BASE, 'user_age': 45, 'user_cycle_length': 40, 'current_pain_level': 10,
+     'current_flow_level': 5, 'user_experience': 'learning_user', 'time_of_day': 'evening'},
+]
+
+
+class RegistrySource:
+    """Active model entry for a serving backend from gold.model_registry"""
+
+    def __init__(self, backend_name, table=MODEL_REGISTRY_TABLE, client=None, timeout=REGISTRY_TIMEOUT_SECONDS):
+        from google.cloud import bigquery
+        self.backend_name = backend_name
+        self.table = table
+        self.timeout = timeout
+        self.client = client or bigquery.Client(project=PROJECT_ID)
+
+    def active(self):
+        from google.cloud import bigquery
+        query = f"""
+            SELECT model_id, serving_backend, model_uri, TO_JSON_STRING(serving_config) as serving_config
+            FROM `{self.table}`
+            WHERE deployment_status = 'active'
+              AND serving_backend = @backend
+            ORDER BY last_updated DESC
+            LIMIT 1
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('backend', 'STRING', self.backend_name)
+        ])
+        job_config.job_timeout_ms = int(self.timeout * 1000)
+        job = self.client.query(query, job_config=job_config, timeout=self.timeout)
+        rows = list(job.result(timeout=self.timeout))
+        if not rows:
+            return None
+        row = rows[0]
+        return {
+            'model_id': row['model_id'],
+            'serving_backend': row['serving_backend'],
+            'model_uri': row['model_uri'],
+            'serving_config': json.loads(row['serving_config']) if row['serving_config'] else {},
+        }
+
+
+class ManifestSource:
+    """Local JSON manifest stand-in for the registry"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def active(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return json.load(f)
+
+
+def fetch_artifacts(model_uri, model_id):
+    """Local path for a model URI; gs:// prefixes are downloaded once per model_id"""
+    if not model_uri or not model_uri.startswith('gs://'):
+        return model_uri
+
+    from google.cloud import storage
+    target = os.path.join(ARTIFACT_DIR, model_id)
+    if os.path.isdir(target):
+        return target
+
+    bucket_name, _, prefix = model_uri[len('gs://'):].partition('/')
+    tmp_target = f"{target}.tmp-{os.getpid()}"
+    bucket = storage.Client(project=PROJECT_ID).bucket(bucket_name)
+    for blob in bucket.list_blobs(prefix=prefix):
+        if blob.name.endswith('/'):
+            continue
+        path = os.path.join(tmp_target, os.path.relpath(blob.name, prefix) if prefix else blob.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        blob.download_to_filename(path)
+    if not os.path.isdir(tmp_target):
+        raise FileNotFoundError(f"No artifacts under {model_uri}")
+    shutil.rmtree(target, ignore_errors=True)
+    os.rename(tmp_target, target)
+    return target
+
+
+def load_backend(entry):
+    """Instantiate the backend described by a registry / manifest entry"""
+    name = entry['serving_backend']
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown serving_backend '{name}' for {entry['model_id']}")
+    shared = preloaded(name, entry['model_id'])
+    if shared is not None:
+        return shared
+    config = dict(entry.get('serving_config') or {})
+    path = fetch_artifacts(entry.get('model_uri'), entry['model_id'])
+
+    if name == 'bigquery':
+        return BACKENDS[name](version=entry['model_id'], **config)
+    if name == 'lightgbm':
+        return BACKENDS[name](model_dir=path, version=entry['model_id'])
+    if path and os.path.isdir(path):
+        path = os.path.join(path, config.get('model_file', BACKENDS[name].model_file))
+    return BACKENDS[name](model_path=path, version=entry['model_id'])
+
+
+def validate_backend(backend, contexts=CANARY_CONTEXTS):
+    """Raise if the backend cannot score the canary set with in-range outputs"""
+    predictions = backend.predict(contexts)
+    if len(predictions) != len(contexts):
+        raise ValueError(f"{len(predictions)} predictions for {len(contexts)} canary inputs")
+    for prediction in predictions:
+        for key, upper in (('mode', 3), ('tens', 10), ('heat', 3)):
+            value = prediction[key]
+            if value is None or math.isnan(value) or not (0 <= value <= upper):
+                raise ValueError(f"Canary {key} prediction out of range: {value}")
+
+
+class ModelManager:
+    """Holds the serving backend and swaps in new registry versions without downtime"""
+
+    def __init__(self, backend_name=None, source=None, poll_seconds=POLL_SECONDS):
+        self.backend_name = backend_name or os.environ.get('PREDICTION_BACKEND', 'bigquery')
+        if source is None:
+            manifest = os.environ.get('MODEL_MANIFEST')
+            source = ManifestSource(manifest) if manifest else RegistrySource(self.backend_name)
+        self.source = source
+        self.poll_seconds = poll_seconds
+        self.failed_versions = set()
+        self._backend = None
+        self._load_lock = threading.Lock()
+        self._poller = None
+
+    def current(self):
+        """Backend for one request; hold on to it for the whole request"""
+        backend = self._backend
+        if backend is None:
+            backend = self.start()
+        return backend
+
+    def start(self):
+        """Serve the deployed default now; load the active registry version and poll in the background"""
+        with self._load_lock:
+            if self._backend is None:
+                try:
+                    self._backend = create_backend(self.backend_name)
+                    logger.info(f"✅ Serving deployed default model {self._backend.version}")
+                except Exception as e:
+                    logger.error(f"❌ Deployed default unavailable, loading the registry version: {str(e)}")
+                    self.refresh()
+                    if self._backend is None:
+                        raise RuntimeError(f"No servable {self.backend_name} model") from e
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name='model-manager', daemon=True)
+                self._poller.start()
+        return self._backend
+
+    def refresh(self):
+        """Load, validate and swap in the active version if it changed; returns True on swap"""
+        entry = self.source.active()
+        if not entry:
+            return False
+        version = entry['model_id']
+        current = self._backend
+        if (current is not None and current.version == version) or version in self.failed_versions:
+            return False
+
+        logger.info(f"🔄 Loading model {version} ({entry['serving_backend']})...")
+        start = time.perf_counter()
+        try:
+            candidate = load_backend(entry)
+            validate_backend(candidate)
+        except Exception as e:
+            self.failed_versions.add(version)
+            logger.error(f"❌ Model {version} rejected, keeping {current.version if current else 'defaults'}: {str(e)}")
+            return False
+
+        # Single reference assignment: new requests see the new model, in-flight ones keep theirs
+        self._backend = candidate
+        logger.info(f"✅ Serving model {version} (loaded and validated in {time.perf_counter() - start:.1f}s)")
+        return True
+
+    def _poll(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"❌ Model registry unavailable, serving the deployed defaults: {str(e)}")
+        while self.poll_seconds > 0:
+            time.sleep(self.poll_seconds)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"❌ Model registry poll failed: {str(e)}")
@@ -0,0 +1,250 @@
+"""
+Asynchronous prediction log for the TENS recommendation API
+
+Requests put one record on a bounded in-memory queue (put_nowait, never
+blocks). A background worker batches records and writes them through the
+BigQuery Storage Write API (default stream) into `predictions_log`.
+
+    - flush when PREDICTION_LOG_BATCH_SIZE records are waiting or
+      PREDICTION_LOG_FLUSH_SECONDS have passed since the last flush
+    - records arriving while the queue is full are dropped and counted
+    - remaining records are flushed at interpreter exit / SIGTERM
+
+Records hold `inputs` / `outputs` as dicts; they are JSON-encoded by the worker.
+
+PREDICTION_LOG_SINK selects the sink: `bigquery` (default), `local:<path>`
+(JSON lines, for local runs and tests) or `off`.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ID = os.environ.get('PROJECT_ID', 'junoplus-dev')
+PREDICTION_LOG_TABLE = os.environ.get('PREDICTION_LOG_TABLE', f'{PROJECT_ID}.junoplus_analytics.predictions_log')
+QUEUE_SIZE = int(os.environ.get('PREDICTION_LOG_QUEUE_SIZE', '10000'))
+BATCH_SIZE = int(os.environ.get('PREDICTION_LOG_BATCH_SIZE', '500'))
+FLUSH_SECONDS = float(os.environ.get('PREDICTION_LOG_FLUSH_SECONDS', '5'))
+
+# predictions_log columns -> protobuf field types (TIMESTAMP as epoch micros, JSON as string)
+LOG_FIELDS = [
+    ('request_id', 'string'),
+    ('logged_at', 'int64'),
+    ('user_id', 'string'),
+    ('backend', 'string'),
+    ('role', 'string'),
+    ('model_version', 'string'),
+    ('latency_ms', 'double'),
+    ('status_code', 'int64'),
+    ('inputs', 'string'),
+    ('outputs', 'string'),
+]
+JSON_FIELDS = ('inputs', 'outputs')
+
+
+class LocalSink:
+    """Stand-in sink: keeps rows in memory and optionally appends them to a JSON lines file"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.rows = []
+        self._lock = threading.Lock()
+
+    def write(self, rows):
+        with self._lock:
+            self.rows.extend(rows)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    for row in rows:
+                        f.write(json.dumps(row) + '\n')
+
+    def close(self):
+        pass
+
+
+class StorageWriteSink:
+    """Appends rows to the table's default stream with the BigQuery Storage Write API"""
+
+    def __init__(self, table=PREDICTION_LOG_TABLE):
+        from google.cloud import bigquery_storage_v1
+        from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+        project, dataset, table_name = table.split('.')
+        self.client = bigquery_storage_v1.BigQueryWriteClient()
+        self.stream_name = f"{self.client.table_path(project, dataset, table_name)}/streams/_default"
+
+        # Row message built at runtime so no generated _pb2 module has to ship with the function
+        type_map = {
+            'string': descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+            'int64': descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+            'double': descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+        }
+        self.descriptor = descriptor_pb2.DescriptorProto(name='PredictionLogRow')
+        for number, (name, field_type) in enumerate(LOG_FIELDS, start=1):
+            self.descriptor.field.add(name=name, number=number, type=type_map[field_type],
+                                      label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL)
+        pool = descriptor_pool.DescriptorPool()
+        pool.Add(descriptor_pb2.FileDescriptorProto(name='prediction_log.proto', message_type=[self.descriptor]))
+        self.row_class = message_factory.GetMessageClass(pool.FindMessageTypeByName('PredictionLogRow'))
+        self.stream = None
+
+    def _open(self):
+        from google.cloud.bigquery_storage_v1 import types, writer
+
+        template = types.AppendRowsRequest(write_stream=self.stream_name)
+        proto_data = types.AppendRowsRequest.ProtoData()
+        proto_data.writer_schema = types.ProtoSchema(proto_descriptor=self.descriptor)
+        template.proto_rows = proto_data
+        return writer.AppendRowsStream(self.client, template)
+
+    def write(self, rows):
+        from google.cloud.bigquery_storage_v1 import types
+
+        proto_rows = types.ProtoRows()
+        for row in rows:
+            proto_rows.serialized_rows.append(
+                self.row_class(**{k: v for k, v in row.items() if v is not None}).SerializeToString())
+        request = types.AppendRowsRequest(proto_rows=types.AppendRowsRequest.ProtoData(rows=proto_rows))
+
+        if self.stream is None:
+            self.stream = self._open()
+        try:
+            self.stream.send(request).result()
+        except Exception:
+            # Reopen on the next batch; the connection may have been closed server-side
+            self.close()
+            raise
+
+    def close(self):
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            finally:
+                self.stream = None
+
+
+class PredictionLogger:
+    """Bounded queue + background batch writer; log() never blocks the request"""
+
+    def __init__(self, sink, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self._lock = threading.Lock()  # dropped is counted on request threads
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._worker = threading.Thread(target=self._run, name='prediction-log', daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+        _chain_sigterm(self.close)
+
+    def log(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _drain(self, limit):
+        rows = []
+        while len(rows) < limit:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _write(self, rows):
+        if not rows:
+            return
+        try:
+            # JSON columns are serialized here, off the request path
+            rows = [{**row, **{key: json.dumps(row[key], default=str) for key in JSON_FIELDS
+                               if row.get(key) is not None}} for row in rows]
+            self.sink.write(rows)
+            self.written += len(rows)
+        except Exception as e:
+            self.failed += len(rows)
+            logger.error(f"❌ Prediction log flush failed ({len(rows)} rows): {str(e)}")
+
+    def _run(self):
+        while not self._stopped.is_set():
+            # Collect until the batch is full (size trigger) or the window ends (time trigger)
+            rows = []
+            deadline = time.monotonic() + self.flush_seconds
+            while len(rows) < self.batch_size and not self._stopped.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout=min(remaining, 0.5)))
+                except queue.Empty:
+                    continue
+            with self._flush_lock:
+                self._write(rows)
+
+    def flush(self):
+        """Write everything queued now (called on shutdown)"""
+        with self._flush_lock:
+            while True:
+                rows = self._drain(self.batch_size)
+                if not rows:
+                    break
+                self._write(rows)
+
+    def close(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._worker.join(timeout=10)
+        self.flush()
+        self.sink.close()
+        if self.dropped or self.failed:
+            logger.warning(f"⚠️  Prediction log closed: {self.written} written, "
+                           f"{self.dropped} dropped, {self.failed} failed")
+
+    def stats(self):
+        with self._lock:
+            dropped = self.dropped
+        return {'queued': self._queue.qsize(), 'written': self.written,
+                'dropped': dropped, 'failed': self.failed}
+
+
+def _chain_sigterm(callback):
+    """Run callback on SIGTERM before the previous handler (Cloud Run sends SIGTERM on shutdown)"""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handler(signum, frame):
+        callback()
+        if callable(previous):
+            previous(signum, frame)
+        elif previous == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, handler)
+
+
+def create_prediction_logger(spec=None):
+    """PredictionLogger for PREDICTION_LOG_SINK (bigquery | local[:<path>] | off), or None; raises on other values"""
+    spec = spec or os.environ.get('PREDICTION_LOG_SINK', 'bigquery')
+    if spec == 'off':
+        return None
+    if spec == 'local' or spec.startswith('local:'):
+        _, _, path = spec.partition(':')
+        return PredictionLogger(LocalSink(path or None))
+    if spec == 'bigquery':
+        return PredictionLogger(StorageWriteSink())
+    raise ValueError(f"Unknown PREDICTION_LOG_SINK '{spec}'. Choose from: bigquery, local[:<path>], off")
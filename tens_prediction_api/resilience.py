@@ -0,0 +1,296 @@
+"""
+Admission control, deadlines, circuit breakers and fallback tiers
+
+Every prediction gets a REQUEST_DEADLINE_MS budget. The primary backend runs
+on a bounded worker pool:
+
+    - admission: at most MAX_CONCURRENT_PREDICTIONS backend calls in flight
+      (slots are held until the backend call really returns, also for awaited
+      BigQuery jobs a timed-out request no longer waits for, so a hanging
+      backend sheds load instead of piling up threads or jobs); requests
+      turned away here, by the deadline or by an open breaker count as 'shed'
+    - deadline: the request stops waiting for the primary when the budget
+      minus FALLBACK_RESERVE_MS is used up
+    - circuit breaker per backend: after BREAKER_FAILURE_THRESHOLD consecutive
+      failures/timeouts calls are skipped for BREAKER_RESET_SECONDS, then one
+      probe call decides whether to close it again
+
+When the primary is shed, open, slow or failing, the answer comes from the
+first fallback tier that works:
+
+    1. local model (FALLBACK_BACKEND, default lightgbm) if it is not the primary
+    2. the cached result of an identical recent request
+    3. the pain/period heuristic (backends.heuristic_prediction)
+
+Fallback answers are marked degraded with the reason and tier that served them.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from backends import create_backend, heuristic_prediction
+
+logger = logging.getLogger(__name__)
+
+REQUEST_DEADLINE_MS = float(os.environ.get('REQUEST_DEADLINE_MS', '3000'))
+FALLBACK_RESERVE_MS = float(os.environ.get('FALLBACK_RESERVE_MS', '200'))
+MAX_CONCURRENT_PREDICTIONS = int(os.environ.get('MAX_CONCURRENT_PREDICTIONS', '16'))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', '30'))
+FALLBACK_BACKEND = os.environ.get('FALLBACK_BACKEND', 'lightgbm')
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', '2048'))
+RESULT_CACHE_TTL_SECONDS = float(os.environ.get('RESULT_CACHE_TTL_SECONDS', '3600'))
+
+
+def _consume_result(future):
+    # Retrieve the outcome of a backend call nobody waits for any more (no 'never retrieved' warning)
+    if not future.cancelled():
+        future.exception()
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open -> half-open (one probe) -> closed"""
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logger.info(f"✅ Circuit breaker {self.name} closed")
+            self.state = 'closed'
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    logger.warning(f"⚠️  Circuit breaker {self.name} opened after {self.failures} failure(s)")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+class ResultCache:
+    """Bounded LRU of recent successful predictions with a TTL"""
+
+    def __init__(self, size=RESULT_CACHE_SIZE, ttl_seconds=RESULT_CACHE_TTL_SECONDS):
+        self.size = size
+        self.ttl_seconds = ttl_seconds
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, key, prediction):
+        with self._lock:
+            self._items[key] = (time.monotonic(), prediction)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            stored_at, prediction = item
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._items[key]
+                return None
+            return prediction
+
+
+class ResilientPredictor:
+    """Runs the primary backend under a deadline / limiter / breaker, with fallback tiers"""
+
+    def __init__(self, deadline_ms=REQUEST_DEADLINE_MS, max_concurrent=MAX_CONCURRENT_PREDICTIONS,
+                 fallback_backend=FALLBACK_BACKEND):
+        self.deadline_ms = deadline_ms
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='predict')
+        self.breakers = {}
+        self.cache = ResultCache()
+        self.fallback_name = fallback_backend
+        self._fallback_backend = None
+        self.counters = {'primary': 0, 'local_model': 0, 'cache': 0, 'heuristic': 0, 'shed': 0, 'timeouts': 0}
+        self._lock = threading.Lock()  # counters are updated from request threads and executor workers
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] += n
+
+    def breaker(self, name):
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            breaker = self.breakers.setdefault(name, CircuitBreaker(name))
+        return breaker
+
+    def warm_fallback(self, primary_name):
+        """Load the local fallback model in the background so the first degraded request is fast"""
+        if self.fallback_name and self.fallback_name != primary_name:
+            threading.Thread(target=self._load_fallback, name='fallback-load', daemon=True).start()
+
+    def _load_fallback(self):
+        try:
+            self._fallback_backend = create_backend(self.fallback_name)
+            logger.info(f"✅ Fallback backend {self.fallback_name} ready ({self._fallback_backend.version})")
+        except Exception as e:
+            logger.error(f"❌ Fallback backend {self.fallback_name} unavailable: {str(e)}")
+
+    def _run_slot(self, backend, contexts):
+        try:
+            return backend.predict(contexts)
+        finally:
+            self._slots.release()
+
+    def _admit(self, backend, budget_ms):
+        """Take a slot and pass the breaker; returns (breaker, None) or (None, reason)"""
+        if budget_ms <= 0:
+            self._count('shed')
+            return None, 'deadline'
+        if not self._slots.acquire(blocking=False):
+            self._count('shed')
+            return None, 'overloaded'
+        breaker = self.breaker(backend.name)
+        if not breaker.allow():
+            self._slots.release()
+            self._count('shed')
+            return None, 'circuit_open'
+        return breaker, None
+
+    def _budget_ms(self, started_at):
+        return self.deadline_ms - FALLBACK_RESERVE_MS - (time.perf_counter() - started_at) * 1000
+
+    def _primary_succeeded(self, backend, breaker, keys, predictions):
+        breaker.record_success()
+        predictions = [{**prediction, 'model_version': backend.version} for prediction in predictions]
+        for key, prediction in zip(keys, predictions):
+            self.cache.put(key, prediction)
+        self._count('primary', len(predictions))
+        return [{**prediction, 'degraded': False, 'degraded_reason': None, 'served_by': backend.name}
+                for prediction in predictions]
+
+    def _primary_failed(self, backend, breaker, error):
+        breaker.record_failure()
+        if error is None:
+            self._count('timeouts')
+            return 'deadline'
+        logger.error(f"❌ Backend {backend.name} failed: {str(error)}")
+        return 'backend_error'
+
+    def _degraded(self, backend, contexts, keys, reason):
+        """Degraded predictions from the first tier that works, per context"""
+        results = [None] * len(contexts)
+
+        # Tier 1: local model (only once warm_fallback has loaded it; never loaded on the request path)
+        fallback = self._fallback_backend
+        if fallback is not None and fallback.name != backend.name and self.breaker(fallback.name).allow():
+            breaker = self.breaker(fallback.name)
+            try:
+                predictions = fallback.predict(contexts)
+                breaker.record_success()
+                self._count('local_model', len(predictions))
+                return [{**prediction, 'degraded': True, 'degraded_reason': reason, 'served_by': fallback.name,
+                         'model_version': fallback.version}
+                        for prediction in predictions]
+            except Exception as e:
+                breaker.record_failure()
+                logger.error(f"❌ Fallback backend {fallback.name} failed: {str(e)}")
+
+        for i, (context, key) in enumerate(zip(contexts, keys)):
+            # Tier 2: cached result of an identical request (keeps the version that produced it)
+            cached = self.cache.get(key)
+            if cached is not None:
+                self._count('cache')
+                results[i] = {**cached, 'degraded': True, 'degraded_reason': reason, 'served_by': 'cache'}
+                continue
+            # Tier 3: heuristic
+            self._count('heuristic')
+            results[i] = {**heuristic_prediction(context), 'degraded': True, 'degraded_reason': reason,
+                          'served_by': 'heuristic', 'model_version': 'heuristic'}
+        return results
+
+    def predict(self, backend, context, key, started_at=None):
+        """Prediction dict with 'degraded', 'degraded_reason', 'served_by' and the serving tier's 'model_version' set"""
+        return self.predict_many(backend, [context], [key], started_at)[0]
+
+    def predict_many(self, backend, contexts, keys, started_at=None):
+        """Primary predictions for a batch, or degraded ones when the primary cannot answer in time"""
+        started_at = started_at or time.perf_counter()
+        breaker, reason = self._admit(backend, self._budget_ms(started_at))
+        if breaker is None:
+            return self._degraded(backend, contexts, keys, reason)
+
+        future = self._executor.submit(self._run_slot, backend, contexts)
+        try:
+            predictions = future.result(timeout=max(0, self._budget_ms(started_at)) / 1000)
+        except FutureTimeout:
+            return self._degraded(backend, contexts, keys, self._primary_failed(backend, breaker, None))
+        except Exception as e:
+            return self._degraded(backend, contexts, keys, self._primary_failed(backend, breaker, e))
+        return self._primary_succeeded(backend, breaker, keys, predictions)
+
+    async def predict_async(self, backend, contexts, keys, started_at):
+        """
+        predict_many for an event loop: backends with predict_async (BigQuery) are awaited,
+        CPU-bound local backends and fallbacks run on the worker pool.
+        """
+        loop = asyncio.get_running_loop()
+        breaker, reason = self._admit(backend, self._budget_ms(started_at))
+        if breaker is None:
+            return await loop.run_in_executor(None, self._degraded, backend, contexts, keys, reason)
+
+        if hasattr(backend, 'predict_async'):
+            # Shielded: a timed-out request stops waiting, but the job keeps its slot until it finishes
+            call = asyncio.ensure_future(self._release_after(backend.predict_async(contexts)))
+            call.add_done_callback(_consume_result)
+            call = asyncio.shield(call)
+        else:
+            call = loop.run_in_executor(self._executor, self._run_slot, backend, contexts)
+        try:
+            predictions = await asyncio.wait_for(call, timeout=max(0, self._budget_ms(started_at)) / 1000)
+        except asyncio.TimeoutError:
+            reason = self._primary_failed(backend, breaker, None)
+        except Exception as e:
+            reason = self._primary_failed(backend, breaker, e)
+        else:
+            return self._primary_succeeded(backend, breaker, keys, predictions)
+        return await loop.run_in_executor(None, self._degraded, backend, contexts, keys, reason)
+
+    async def _release_after(self, coroutine):
+        try:
+            return await coroutine
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            **counters,
+            'breakers': {name: b.state for name, b in self.breakers.items()},
+        }
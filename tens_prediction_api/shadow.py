@@ -0,0 +1,219 @@
+"""
+Shadow scoring: compare secondary prediction backends on live traffic
+
+The primary backend serves the response. A SHADOW_SAMPLE_RATE fraction of
+requests is queued (non-blocking) for the backends in SHADOW_BACKENDS, which
+a background worker loads lazily and scores off the response path. For each
+shadow backend it keeps:
+
+    - agreement with the primary on the final heat / mode / tens settings
+    - a fixed-bucket latency histogram (the primary's latency is tracked too)
+    - error and dropped-request counts
+
+A summary is logged as one JSON line every SHADOW_REPORT_SECONDS, and each
+shadow prediction is written to predictions_log with role='shadow' and the
+primary's request_id, so agreement can also be analysed in BigQuery
+(gold.shadow_agreement_v1).
+"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from backends import create_backend, recommended_settings
+
+logger = logging.getLogger(__name__)
+
+SHADOW_BACKENDS = [name for name in os.environ.get('SHADOW_BACKENDS', '').split(',') if name]
+SAMPLE_RATE = float(os.environ.get('SHADOW_SAMPLE_RATE', '0.1'))
+REPORT_SECONDS = float(os.environ.get('SHADOW_REPORT_SECONDS', '300'))
+QUEUE_SIZE = 1000
+
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is open-ended
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram"""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+
+    def add(self, latency_ms):
+        index = len(LATENCY_BUCKETS_MS)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.total += 1
+        self.sum_ms += latency_ms
+
+    def percentile(self, pct):
+        """Upper bound of the bucket containing the percentile"""
+        if not self.total:
+            return None
+        target = pct / 100 * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else float('inf')
+
+    def summary(self):
+        return {
+            'count': self.total,
+            'mean_ms': round(self.sum_ms / self.total, 2) if self.total else None,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'buckets_ms': LATENCY_BUCKETS_MS,
+            'counts': list(self.counts),
+        }
+
+
+class ShadowStats:
+    """Agreement and latency counters for one shadow backend"""
+
+    def __init__(self):
+        self.compared = 0
+        self.errors = 0
+        self.agree = {'heat': 0, 'mode': 0, 'tens': 0, 'all': 0}
+        self.latency = LatencyHistogram()
+
+    def record(self, primary, shadow, latency_ms):
+        self.compared += 1
+        self.latency.add(latency_ms)
+        matches = [p == s for p, s in zip(recommended_settings(primary), recommended_settings(shadow))]
+        for head, match in zip(('heat', 'mode', 'tens'), matches):
+            self.agree[head] += match
+        self.agree['all'] += all(matches)
+
+    def summary(self):
+        return {
+            'compared': self.compared,
+            'errors': self.errors,
+            'agreement': {head: round(count / self.compared, 4) if self.compared else None
+                          for head, count in self.agree.items()},
+            'latency': self.latency.summary(),
+        }
+
+
+class ShadowScorer:
+    """Samples requests and scores them on secondary backends in a background thread"""
+
+    def __init__(self, primary_name, shadow_names, sample_rate=SAMPLE_RATE, prediction_log=None,
+                 report_seconds=REPORT_SECONDS):
+        self.primary_name = primary_name
+        self.shadow_names = [name for name in shadow_names if name != primary_name]
+        self.sample_rate = sample_rate
+        self.prediction_log = prediction_log
+        self.report_seconds = report_seconds
+        self.backends = {}
+        self.stats = {name: ShadowStats() for name in self.shadow_names}
+        self.primary_latency = LatencyHistogram()
+        self.sampled = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._worker = threading.Thread(target=self._run, name='shadow-scoring', daemon=True)
+        self._worker.start()
+
+    def submit(self, request_id, contexts, predictions, primary_latency_ms):
+        """Called on the request path: O(1), never blocks (the lock only guards counter updates)"""
+        with self._lock:
+            self.primary_latency.add(primary_latency_ms)
+        if random.random() >= self.sample_rate:
+            return
+        try:
+            self._queue.put_nowait((request_id, contexts, predictions))
+            with self._lock:
+                self.sampled += 1
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _backend(self, name):
+        # Loaded on the worker so model loading never delays a response
+        if name not in self.backends:
+            self.backends[name] = create_backend(name)
+        return self.backends[name]
+
+    def _score(self, request_id, contexts, primary_predictions):
+        for name in self.shadow_names:
+            stats = self.stats[name]
+            try:
+                backend = self._backend(name)
+                start = time.perf_counter()
+                shadow_predictions = backend.predict(contexts)
+                latency_ms = (time.perf_counter() - start) * 1000
+            except Exception as e:
+                with self._lock:
+                    stats.errors += 1
+                logger.error(f"❌ Shadow backend {name} failed: {str(e)}")
+                continue
+
+            with self._lock:
+                for primary, shadow in zip(primary_predictions, shadow_predictions):
+                    stats.record(primary, shadow, latency_ms / len(contexts))
+
+            if self.prediction_log:
+                for context, shadow in zip(contexts, shadow_predictions):
+                    heat, mode, tens = recommended_settings(shadow)
+                    self.prediction_log.log({
+                        'request_id': request_id,
+                        'logged_at': int(time.time() * 1_000_000),
+                        'user_id': context.get('user_id'),
+                        'backend': name,
+                        'role': 'shadow',
+                        'model_version': backend.version,
+                        'latency_ms': latency_ms / len(contexts),
+                        'status_code': 200,
+                        'inputs': None,
+                        'outputs': {'recommended_heat_level': heat, 'recommended_tens_mode': mode,
+                                    'recommended_tens_level': tens, 'raw_mode_prediction': shadow['mode'],
+                                    'raw_tens_prediction': shadow['tens'], 'raw_heat_prediction': shadow['heat']},
+                    })
+
+    def _run(self):
+        last_report = time.monotonic()
+        while True:
+            try:
+                request_id, contexts, predictions = self._queue.get(timeout=5)
+                self._score(request_id, contexts, predictions)
+            except queue.Empty:
+                pass
+            if time.monotonic() - last_report >= self.report_seconds:
+                self.report()
+                last_report = time.monotonic()
+
+    def summary(self):
+        with self._lock:
+            return {
+                'primary': self.primary_name,
+                'sample_rate': self.sample_rate,
+                'sampled': self.sampled,
+                'dropped': self.dropped,
+                'primary_latency': self.primary_latency.summary(),
+                'shadows': {name: stats.summary() for name, stats in self.stats.items()},
+            }
+
+    def report(self):
+        """Log the summary as one structured line (parsed by Cloud Logging)"""
+        summary = self.summary()
+        if any(s['compared'] or s['errors'] for s in summary['shadows'].values()):
+            print(json.dumps({'severity': 'INFO', 'message': '📊 Shadow scoring summary', 'shadow': summary}))
+        return summary
+
+
+def create_shadow_scorer(primary_name, prediction_log=None):
+    """ShadowScorer for SHADOW_BACKENDS, or None when shadow mode is off"""
+    shadow_names = [name for name in SHADOW_BACKENDS if name != primary_name]
+    if not shadow_names or SAMPLE_RATE <= 0:
+        return None
+    return ShadowScorer(primary_name, shadow_names, prediction_log=prediction_log)
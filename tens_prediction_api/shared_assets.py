@@ -0,0 +1,157 @@
+"""
+Read-only serving assets shared between worker processes
+
+With several worker processes, each one would otherwise unpickle its own copy
+of the models. preload() runs once in a pre-fork parent (gunicorn.conf.py): it
+loads the serving model (the active registry / manifest version, else the
+deployed default), the local fallback and the shadow backends, then freezes
+them out of the garbage collector. Workers forked afterwards get them from
+create_backend / model_manager.load_backend instead of loading again, so the
+model memory (LightGBM trees live in native buffers that inference only reads)
+stays shared copy-on-write pages. Versions hot-reloaded later are loaded per
+worker.
+
+Lookup tables are stored as directories of .npy arrays (save_arrays) and opened
+memory-mapped (open_arrays): every process maps the same page-cache pages.
+
+memory_report() gives RSS / PSS / USS (unique set size: memory only that
+process holds) of this process, its parent and its sibling workers, from
+/proc/<pid>/smaps_rollup (Linux).
+"""
+import gc
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# (backend name, version) -> backend loaded in the pre-fork parent; version None is the deployed default
+_preloaded = {}
+
+
+def preload():
+    """Load the serving, fallback and shadow backends in the pre-fork parent; returns the loaded keys"""
+    # One OpenMP thread while loading: a thread pool started before fork is not inherited by the workers
+    os.environ.setdefault('OMP_NUM_THREADS', '1')
+    from backends import create_backend
+    from model_manager import ManifestSource, RegistrySource, load_backend
+
+    primary = os.environ.get('PREDICTION_BACKEND', 'bigquery')
+    try:
+        manifest = os.environ.get('MODEL_MANIFEST')
+        entry = (ManifestSource(manifest) if manifest else RegistrySource(primary)).active()
+        if entry:
+            _preloaded[(entry['serving_backend'], entry['model_id'])] = load_backend(entry)
+    except Exception as e:
+        logger.warning(f"⚠️  Could not preload the active {primary} model: {str(e)}")
+
+    names = [primary, os.environ.get('FALLBACK_BACKEND', 'lightgbm')]
+    names += [name for name in os.environ.get('SHADOW_BACKENDS', '').split(',') if name]
+    for name in dict.fromkeys(names):
+        if not name or name == 'bigquery' or (name, None) in _preloaded:
+            continue  # disabled, or nothing held in memory
+        try:
+            _preloaded[(name, None)] = create_backend(name)
+        except Exception as e:
+            logger.warning(f"⚠️  Could not preload {name}: {str(e)}")
+
+    # Objects in the permanent generation are never traversed by the collector,
+    # so garbage collections in the workers do not write to (and copy) their pages
+    gc.collect()
+    gc.freeze()
+    loaded = [f"{name}@{version or 'default'}" for name, version in _preloaded]
+    logger.info(f"📦 Preloaded {len(loaded)} backend(s) for the workers: {', '.join(loaded) or 'none'}")
+    return loaded
+
+
+def preloaded(name, version=None):
+    """Backend loaded by preload() for (name, version), or None"""
+    return _preloaded.get((name, version))
+
+
+def is_shared(backend):
+    return any(backend is shared for shared in _preloaded.values())
+
+
+def save_arrays(directory, arrays, metadata=None):
+    """Write {name: numpy array} as <directory>/<name>.npy (+ metadata.json), replacing the directory atomically"""
+    tmp_dir = f"{directory}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f'{name}.npy'), np.ascontiguousarray(array), allow_pickle=False)
+    with open(os.path.join(tmp_dir, 'metadata.json'), 'w') as f:
+        json.dump(metadata or {}, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(tmp_dir, directory)
+
+
+def open_arrays(directory):
+    """({name: read-only memory-mapped array}, metadata) of a save_arrays directory"""
+    arrays = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.npy'):
+            arrays[filename[:-4]] = np.load(os.path.join(directory, filename), mmap_mode='r', allow_pickle=False)
+    metadata_path = os.path.join(directory, 'metadata.json')
+    metadata = {}
+    if os.path.exists(metadata_path):
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+    return arrays, metadata
+
+
+def process_memory(pid):
+    """RSS / PSS / USS / shared MB of a process from /proc/<pid>/smaps_rollup, or None if unreadable"""
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    except OSError:
+        return None
+    return {
+        'pid': pid,
+        'rss_mb': round(fields.get('Rss', 0.0), 1),
+        'pss_mb': round(fields.get('Pss', 0.0), 1),
+        'uss_mb': round(fields.get('Private_Clean', 0.0) + fields.get('Private_Dirty', 0.0), 1),
+        'shared_mb': round(fields.get('Shared_Clean', 0.0) + fields.get('Shared_Dirty', 0.0), 1),
+    }
+
+
+def _children(ppid):
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # pid (comm) state ppid ...; comm may contain spaces
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == ppid:
+                    pids.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return sorted(pids)
+
+
+def memory_report():
+    """Memory of this worker, its parent and its sibling workers (USS is what each worker adds)"""
+    pid, ppid = os.getpid(), os.getppid()
+    workers = [m for m in (process_memory(p) for p in _children(ppid)) if m]
+    for worker in workers:
+        worker['self'] = worker['pid'] == pid
+    return {
+        'parent': process_memory(ppid),
+        'workers': workers,
+        'totals': {
+            'workers': len(workers),
+            'rss_mb': round(sum(w['rss_mb'] for w in workers), 1),
+            'uss_mb': round(sum(w['uss_mb'] for w in workers), 1),
+            'pss_mb': round(sum(w['pss_mb'] for w in workers), 1),
+        },
+        'preloaded': [f"{name}@{version or 'default'}" for name, version in _preloaded],
+    }
@@ -0,0 +1,92 @@
+"""
+Single-flight coalescing of identical in-flight predictions
+
+Concurrent requests with the same canonical key (prediction inputs + model
+version) share one backend call: the first caller (leader) runs it, the
+others (followers) wait for its result. Followers wait at most
+COALESCE_WAIT_SECONDS and then run their own prediction, so a slow leader
+never holds them longer than that. A leader's exception is re-raised in
+every follower that was waiting on it.
+"""
+import hashlib
+import json
+import os
+import threading
+
+COALESCE_WAIT_SECONDS = float(os.environ.get('COALESCE_WAIT_SECONDS', '10'))
+
+# Request fields that do not change the prediction
+NON_PREDICTIVE_FIELDS = {'user_id', 'explain', 'explain_top_k'}
+
+
+def request_key(context, model_version):
+    """Canonical key for a validated context under a model version"""
+    canonical = {k: v for k, v in context.items() if k not in NON_PREDICTIVE_FIELDS}
+    payload = json.dumps([model_version, canonical], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'followers')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """Deduplicates concurrent calls per key; thread-safe"""
+
+    def __init__(self, wait_seconds=COALESCE_WAIT_SECONDS):
+        self.wait_seconds = wait_seconds
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.follower_timeouts = 0
+
+    def do(self, key, fn):
+        """Run fn() once per key among concurrent callers; returns (result, shared)"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+            else:
+                call.followers += 1
+                leader = False
+
+        if not leader:
+            if call.done.wait(self.wait_seconds):
+                with self._lock:
+                    self.coalesced += 1
+                if call.error is not None:
+                    raise call.error
+                return call.result, True
+            with self._lock:
+                self.follower_timeouts += 1
+            return fn(), False
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            # Unregister before waking followers so later requests start a fresh call
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'follower_timeouts': self.follower_timeouts,
+                'in_flight': len(self._calls),
+            }
@@ -0,0 +1,47 @@
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from backends import LightGBMBackend  # noqa: E402
+from drift import SERVING_DEFAULT_FEATURES  # noqa: E402
+from explanations import summarize  # noqa: E402
+from features import CATEGORICAL_COLUMNS, raw_features  # noqa: E402
+
+SHIPPED_MODELS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'models', 'hierarchical_approach')
+
+
+def _source_feature(feature):
+    return next((c for c in CATEGORICAL_COLUMNS if feature.startswith(f'{c}_')), feature)
+
+
+def _context(**overrides):
+    context = {
+        'user_id': None, 'user_age': 28, 'user_cycle_length': 30, 'user_period_length': 5,
+        'is_period_day': True, 'is_ovulation_day': False, 'current_pain_level': 8, 'current_flow_level': 2,
+        'has_medications': False, 'medication_count': 0, 'user_experience': 'experienced_user',
+        'time_of_day': 'evening', 'previous_tens_level': 5, 'tens_mode': 'continuous',
+        'explain': True, 'explain_top_k': 3, 'cycle': None,
+    }
+    context.update(overrides)
+    return context
+
+
+def test_explanations_only_use_request_features():
+    backend = LightGBMBackend(model_dir=SHIPPED_MODELS)
+    contexts = [_context(), _context(current_pain_level=2, is_period_day=False, time_of_day='morning'),
+                _context(has_medications=True, medication_count=2, user_experience='new_user')]
+    received = set(raw_features(contexts[0]))
+    predictions = backend.predict(contexts)
+
+    for explanations in backend.explain(contexts, predictions, top_k=3):
+        for head, items in explanations.items():
+            for item in items or []:
+                assert item['value'] is not None and not math.isnan(item['value'])
+                assert not SERVING_DEFAULT_FEATURES.match(item['feature'])
+                assert _source_feature(item['feature']) in received, item['feature']
+            assert items is None or len(items) == 3
+        sentence = summarize(explanations) or ''
+        for leaky in ('pain reduction', 'recent medication usage', 'usual TENS mode'):
+            assert leaky not in sentence